@@ -0,0 +1,322 @@
+"""
+decode.py - Read the oheap format written by encode.py back into py_meta
+objects.
+"""
+
+import mmap
+
+from asdl import asdl_ as asdl
+from asdl import encode
+from asdl import py_meta
+
+
+class Error(Exception):
+  """The buffer isn't a valid oheap file for the schema."""
+  pass
+
+
+def ClassesByDescriptor(root):
+  """Map descriptor IDs to the classes that py_meta.MakeTypes() made.
+
+  Args:
+    root: the module the types were added to, e.g. osh/ast_.py
+  """
+  classes = {}
+  for name in dir(root):
+    cls = getattr(root, name)
+    if (isinstance(cls, type) and issubclass(cls, py_meta.Obj) and
+        cls.DESCRIPTOR is not None):
+      classes[id(cls.DESCRIPTOR)] = cls
+  return classes
+
+
+# Kinds of slots in a record.
+_INT = 0
+_MAYBE_INT = 1
+_REF = 2
+
+
+def _SlotKind(desc):
+  if isinstance(desc, (asdl.IntType, asdl.BoolType, asdl.UserType)):
+    return _INT
+  if isinstance(desc, asdl.Sum) and asdl.is_simple(desc):
+    return _INT
+  if (isinstance(desc, asdl.MaybeType) and
+      isinstance(desc.desc, (asdl.IntType, asdl.UserType))):
+    return _MAYBE_INT
+  return _REF
+
+
+def ReadHeader(buf):
+  """Return the encode.Params and root ref of an oheap buffer."""
+  magic = bytes(buf[:4])
+  if magic == b'OHP\x01':
+    if len(buf) < 8:
+      raise Error('Truncated oheap header')
+    enc = encode.Params(alignment=buf[4])
+    root_ref = int.from_bytes(buf[5:8], 'little')
+  elif magic == b'OHP\x02':
+    if len(buf) < 12:
+      raise Error('Truncated oheap header')
+    enc = encode.Params(alignment=buf[4], int_width=buf[5], ref_width=buf[6])
+    root_ref = int.from_bytes(buf[8:12], 'little')
+  else:
+    raise Error('Invalid oheap header')
+  if enc.alignment == 0:
+    raise Error('Invalid alignment')
+  return enc, root_ref
+
+
+class Decoder(object):
+  """Decodes a whole tree eagerly.
+
+  The layout mirrors EncodeObj(): a record is an optional tag byte, then one
+  int or ref per field.  Ints are signed; refs are block indexes.  Either may
+  be varints, so the slots of a record are read front to back.
+  """
+
+  def __init__(self, buf, root, enc=None):
+    """
+    Args:
+      buf: bytes or mmap.  Only the parts that are decoded are copied.
+      root: module with the py_meta types of the schema
+      enc: encode.Params the buffer was written with
+    """
+    self.buf = buf
+    self.enc = enc or encode.Params()
+    self.classes = ClassesByDescriptor(root)
+    self.layouts = {}  # class -> list of (name, slot kind, desc)
+    self.strs = {}  # ref -> str
+
+    if self.enc.int_width == encode.VARINT:
+      self._Int = self._Varint
+      self._MaybeInt = self._MaybeVarint
+    if self.enc.ref_width == encode.VARINT:
+      self._Ref = self._UnsignedVarint
+    self.readers = (self._Int, self._MaybeInt, self._Ref)  # by slot kind
+
+  #
+  # Each reader takes a byte position and returns (value, next position).
+  #
+
+  def _Int(self, pos):
+    end = pos + self.enc.int_width
+    return int.from_bytes(self.buf[pos:end], 'little', signed=True), end
+
+  def _MaybeInt(self, pos):
+    n, pos = self._Int(pos)
+    return (None if n == self.enc.null_int else n), pos
+
+  def _Ref(self, pos):
+    end = pos + self.enc.ref_width
+    return int.from_bytes(self.buf[pos:end], 'little'), end
+
+  def _UnsignedVarint(self, pos):
+    buf = self.buf
+    n = 0
+    shift = 0
+    while True:
+      b = buf[pos]
+      pos += 1
+      n |= (b & 0x7F) << shift
+      if b < 0x80:
+        return n, pos
+      shift += 7
+
+  def _Varint(self, pos):
+    n, pos = self._UnsignedVarint(pos)
+    return (n >> 1) ^ -(n & 1), pos  # undo zig-zag
+
+  def _MaybeVarint(self, pos):
+    n, pos = self._UnsignedVarint(pos)
+    if n == 0:
+      return None, pos
+    n -= 1
+    return (n >> 1) ^ -(n & 1), pos
+
+  def _Str(self, ref):
+    # Strings are immutable, and shared when the encoder deduplicated them.
+    try:
+      return self.strs[ref]
+    except KeyError:
+      pass
+    pos = ref * self.enc.alignment
+    end = self.buf.find(b'\0', pos)
+    s = self.buf[pos:end].decode('utf-8')
+    self.strs[ref] = s
+    return s
+
+  def _Enum(self, desc, enum_id):
+    cls = self.classes[id(desc)]
+    return getattr(cls, desc.types[enum_id - 1].name)
+
+  def _Array(self, ref, item_desc):
+    pos = ref * self.enc.alignment
+    n, pos = self._Int(pos)
+
+    read = self._Int if _SlotKind(item_desc) == _INT else self._Ref
+    items = []
+    for i in range(n):
+      val, pos = read(pos)
+      items.append(self.DecodeField(val, item_desc))
+    return items
+
+  def Layout(self, cls):
+    """Return a list of (field name, slot kind, descriptor)."""
+    try:
+      return self.layouts[cls]
+    except KeyError:
+      pass
+    layout = []
+    for name in cls.FIELDS:
+      desc = cls.DESCRIPTOR_LOOKUP[name]
+      layout.append((name, _SlotKind(desc), desc))
+    self.layouts[cls] = layout
+    return layout
+
+  def ReadRecord(self, ref, desc):
+    """Return the class of a record and the raw values of its slots."""
+    pos = ref * self.enc.alignment
+    if isinstance(desc, asdl.Sum):
+      tag = self.buf[pos]
+      pos += self.enc.tag_width
+      try:
+        desc = desc.types[tag - 1]
+      except IndexError:
+        raise Error('Invalid tag %d at block %d' % (tag, ref))
+    cls = self.classes[id(desc)]
+
+    readers = self.readers
+    slots = []
+    for _, kind, _ in self.Layout(cls):
+      val, pos = readers[kind](pos)
+      slots.append(val)
+    return cls, slots
+
+  def DecodeField(self, val, desc):
+    """Decode a field, given the raw value of its slot and its descriptor."""
+    if isinstance(desc, asdl.IntType):
+      return val
+
+    if isinstance(desc, asdl.BoolType):
+      return bool(val)
+
+    if isinstance(desc, asdl.Sum) and asdl.is_simple(desc):
+      return self._Enum(desc, val)
+
+    if isinstance(desc, asdl.StrType):
+      return self._Str(val)
+
+    if isinstance(desc, asdl.ArrayType):
+      return self._Array(val, desc.desc)
+
+    if isinstance(desc, asdl.MaybeType):
+      # Inline ints are None; refs are 0.
+      if val is None or val == 0 and _SlotKind(desc) == _REF:
+        return None
+      return self.DecodeField(val, desc.desc)
+
+    if isinstance(desc, asdl.UserType):
+      # Assume Id for now, like the encoder.
+      return desc.typ(val)
+
+    return self.DecodeObj(val, desc)
+
+  def DecodeObj(self, ref, desc):
+    """
+    Args:
+      ref: block index of the record
+      desc: asdl.Sum or asdl.Product the record was declared as
+
+    Returns:
+      py_meta.CompoundObj
+    """
+    cls, slots = self.ReadRecord(ref, desc)
+    # Positional, since defaults count as assigned for kwargs.
+    args = [
+        self.DecodeField(val, field_desc)
+        for val, (_, _, field_desc) in zip(slots, self.Layout(cls))]
+    return cls(*args)
+
+
+class _LazyObj(object):
+  """Mixed into a py_meta class to make a proxy for an encoded record.
+
+  Fields are decoded on first access and then stored like normal fields, so
+  they can also be assigned.
+  """
+
+  def __init__(self, decoder, slots):
+    d = self.__dict__
+    d['_decoder'] = decoder
+    d['_slots'] = slots  # raw values, which are cheap to read
+    d['_assigned'] = {}  # for CheckedObj.__setattr__
+
+  def __getattr__(self, name):
+    # Only called for fields that haven't been decoded yet.
+    d = self.__dict__
+    if '_decoder' not in d:  # e.g. during copy/pickle
+      raise AttributeError(name)
+    layout = d['_decoder'].Layout(self._CLASS)
+    for (field_name, _, desc), val in zip(layout, d['_slots']):
+      if field_name == name:
+        val = d['_decoder'].DecodeField(val, desc)
+        # Bypass type checking.  With __slots__, this fills the slot.
+        object.__setattr__(self, name, val)
+        return val
+    raise AttributeError('Object of type %r has no attribute %r' %
+                         (self.__class__.__name__, name))
+
+
+class LazyDecoder(Decoder):
+  """Decodes records into proxies whose fields are decoded when accessed.
+
+  The proxies are instances of subclasses of the py_meta classes, so
+  isinstance(), .tag, and the formatter work the same.  Subtrees that aren't
+  visited are never decoded.
+  """
+
+  def __init__(self, buf, root, enc=None):
+    Decoder.__init__(self, buf, root, enc=enc)
+    self.proxy_classes = {}  # class -> proxy class
+
+  def DecodeObj(self, ref, desc):
+    cls, slots = self.ReadRecord(ref, desc)
+    try:
+      proxy_cls = self.proxy_classes[cls]
+    except KeyError:
+      # Same name, so it prints the same.
+      proxy_cls = type(cls.__name__, (_LazyObj, cls),
+                       {'_CLASS': cls, '__module__': cls.__module__})
+      self.proxy_classes[cls] = proxy_cls
+    return proxy_cls(self, slots)
+
+
+def DecodeRoot(buf, desc, root, lazy=False):
+  """Decode a buffer written by encode.EncodeRoot() or EncodeTree().
+
+  The encoding parameters are read from the header.
+
+  Args:
+    buf: bytes or mmap
+    desc: asdl descriptor of the root object, e.g. ast.command.DESCRIPTOR
+    root: module with the py_meta types of the schema
+    lazy: if True, return a proxy that decodes fields when they're accessed.
+      The buffer must stay open as long as the tree is used.
+
+  Returns:
+    py_meta.CompoundObj
+  """
+  enc, root_ref = ReadHeader(buf)
+  decoder_cls = LazyDecoder if lazy else Decoder
+  d = decoder_cls(buf, root, enc=enc)
+  return d.DecodeObj(root_ref, desc)
+
+
+def DecodeFile(path, desc, root):
+  """Map an oheap file and return a lazy proxy for its root object."""
+  with open(path, 'rb') as f:
+    # The map has its own reference to the file, so f can be closed.  It's
+    # unmapped when the last proxy is garbage collected.
+    buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  return DecodeRoot(buf, desc, root, lazy=True)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+decode_test.py: Tests for decode.py
+"""
+
+import io
+import os
+import tempfile
+import unittest
+
+from asdl import arith_ast
+from asdl import decode  # module under test
+from asdl import encode
+from asdl import py_meta
+
+
+def _Encode(obj, dedup=False):
+  f = io.BytesIO()
+  encode.EncodeRoot(obj, encode.Params(), encode.BinOutput(f, dedup=dedup))
+  return f.getvalue()
+
+
+def _RoundTrip(obj, desc):
+  return decode.DecodeRoot(_Encode(obj), desc, arith_ast)
+
+
+def _MakeTree():
+  return arith_ast.Slice(
+      arith_ast.ArithBinary(
+          arith_ast.op_id.Plus, arith_ast.ArithVar('x'),
+          arith_ast.Const(-1)),
+      None,
+      arith_ast.FuncCall('f', [arith_ast.Const(1), arith_ast.Const(2)]),
+      None)
+
+
+class DecoderTest(unittest.TestCase):
+
+  def testRoundTrip(self):
+    obj = _MakeTree()
+    actual = _RoundTrip(obj, arith_ast.arith_expr.DESCRIPTOR)
+    self.assertEqual(obj, actual)
+    self.assertIs(arith_ast.op_id.Plus, actual.a.op_id)
+    self.assertEqual(None, actual.begin)
+
+    obj = arith_ast.source_location('foo.sh', 1, 2, 3)
+    self.assertEqual(
+        obj, _RoundTrip(obj, arith_ast.source_location.DESCRIPTOR))
+
+  def testDedup(self):
+    def MakeSum():
+      return arith_ast.ArithBinary(
+          arith_ast.op_id.Plus, arith_ast.ArithVar('x'), arith_ast.Const(0))
+
+    args = [MakeSum() for _ in range(10)]
+    obj = arith_ast.FuncCall('x', args)
+
+    buf = _Encode(obj, dedup=True)
+    self.assertLess(len(buf), len(_Encode(obj)))
+    self.assertEqual(1, buf.count(b'x\0'))  # one copy of the string
+
+    actual = decode.DecodeRoot(buf, arith_ast.arith_expr.DESCRIPTOR, arith_ast)
+    self.assertEqual(obj, actual)
+    # Decoded subtrees are still distinct objects, so they can be mutated.
+    self.assertIsNot(actual.args[0], actual.args[1])
+
+  def testLazy(self):
+    obj = _MakeTree()
+    buf = _Encode(obj)
+    lazy = decode.DecodeRoot(
+        buf, arith_ast.arith_expr.DESCRIPTOR, arith_ast, lazy=True)
+
+    self.assertTrue(isinstance(lazy, arith_ast.Slice))
+    self.assertEqual(arith_ast.arith_expr_e.Slice, lazy.tag)
+    self.assertEqual('Slice', lazy.__class__.__name__)
+
+    # Only what's visited is decoded.
+    func_call = lazy.end
+    self.assertNotIn('a', lazy.__dict__)
+    self.assertNotIn('args', func_call.__dict__)
+    self.assertEqual('f', func_call.name)
+    self.assertEqual(2, func_call.args[1].i)
+
+    # Fields can be assigned, like normal objects.
+    func_call.name = 'g'
+    self.assertEqual('g', func_call.name)
+    func_call.name = 'f'
+
+    self.assertEqual(obj, lazy)
+    self.assertEqual(repr(obj), repr(lazy))
+    self.assertRaises(AttributeError, getattr, lazy, 'nonexistent')
+
+  def testFastClasses(self):
+    class Root(object):
+      pass
+    py_meta.MakeTypes(arith_ast.module, Root, check_types=False)
+
+    obj = _MakeTree()
+    lazy = decode.DecodeRoot(
+        _Encode(obj), Root.arith_expr.DESCRIPTOR, Root, lazy=True)
+    self.assertTrue(isinstance(lazy, Root.Slice))
+    self.assertEqual('f', lazy.end.name)
+    self.assertIs(lazy.end, lazy.end)  # decoded once
+    self.assertEqual(repr(obj), repr(lazy))
+
+  def testDecodeFile(self):
+    fd, path = tempfile.mkstemp()
+    os.write(fd, _Encode(_MakeTree()))
+    os.close(fd)
+    self.addCleanup(os.remove, path)
+
+    lazy = decode.DecodeFile(path, arith_ast.arith_expr.DESCRIPTOR, arith_ast)
+    self.assertEqual('x', lazy.a.left.name)
+
+  def testWidths(self):
+    obj = _MakeTree()
+    desc = arith_ast.arith_expr.DESCRIPTOR
+
+    # EncodeTree() writes the same bytes as EncodeRoot() by default.
+    f = io.BytesIO()
+    encode.EncodeTree(obj, encode.Params(), f)
+    self.assertEqual(_Encode(obj), f.getvalue())
+
+    for enc in (encode.Params(ref_width=4),
+                encode.Params(int_width=encode.VARINT, ref_width=encode.VARINT),
+                encode.Params(alignment=1, int_width=encode.VARINT,
+                              ref_width=encode.VARINT)):
+      for dedup in (False, True):
+        f = io.BytesIO()
+        encode.EncodeTree(obj, enc, f, dedup=dedup)
+        buf = f.getvalue()
+        self.assertEqual(b'OHP\x02', buf[:4])
+        self.assertEqual(obj, decode.DecodeRoot(buf, desc, arith_ast))
+        lazy = decode.DecodeRoot(buf, desc, arith_ast, lazy=True)
+        self.assertEqual(-1, lazy.a.right.i)
+        self.assertEqual(obj, lazy)
+
+  def testDeepTree(self):
+    # Deeper than the recursion limit, like a long && chain.
+    obj = arith_ast.Const(0)
+    for i in range(5000):
+      obj = arith_ast.ArithUnary(arith_ast.op_id.Minus, obj)
+
+    f = io.BytesIO()
+    enc = encode.Params(int_width=encode.VARINT, ref_width=encode.VARINT)
+    encode.EncodeTree(obj, enc, f, dedup=True)
+    lazy = decode.DecodeRoot(
+        f.getvalue(), arith_ast.arith_expr.DESCRIPTOR, arith_ast, lazy=True)
+    for i in range(5000):
+      lazy = lazy.a
+    self.assertEqual(0, lazy.i)
+
+  def testInvalid(self):
+    self.assertRaises(
+        decode.Error, decode.DecodeRoot, b'XXX\x01\x04\x00\x00\x00',
+        arith_ast.arith_expr.DESCRIPTOR, arith_ast)
+
+
+if __name__ == '__main__':
+  unittest.main()
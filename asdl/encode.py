@@ -11,13 +11,21 @@ _DEFAULT_ALIGNMENT = 4
 
 
 class BinOutput:
-  """Write aligned blocks here.  Keeps track of block indexes for refs."""
+  """Write aligned blocks here.  Keeps track of block indexes for refs.
 
-  def __init__(self, f, alignment=_DEFAULT_ALIGNMENT):
+  With dedup=True, a block identical to one already written isn't written
+  again; the ref to the first one is returned.  Children are written before
+  their parents, so identical refs mean identical subtrees, and this
+  hash-conses whole subtrees (e.g. tokens and literal words) as well as
+  strings.  Decoders don't need to know.
+  """
+
+  def __init__(self, f, alignment=_DEFAULT_ALIGNMENT, dedup=False):
     self.f = f
     # index of last block, to return as a ref.
     self.last_block = 0
     self.alignment = alignment
+    self.blocks = {} if dedup else None  # bytes -> ref
 
   def WriteRootRef(self, chunk):
     self.f.seek(5)  # seek past 'OHP\x01\x04'
@@ -25,13 +33,24 @@ class BinOutput:
     assert len(chunk) == 3
     self.f.write(chunk)
 
-  def Write(self, chunk):
+  def Write(self, chunk, share=True):
     """
     Return a block pointer/index.
+
+    Args:
+      share: False for blocks that will be modified, like the header
     """
     # Input should be padded
     a = self.alignment
     assert len(chunk) % self.alignment == 0
+
+    if self.blocks is not None and share:
+      key = bytes(chunk)
+      ref = self.blocks.get(key)
+      if ref is not None:
+        return ref
+      self.blocks[key] = self.last_block
+
     self.f.write(chunk)
 
     ref = self.last_block
@@ -43,6 +62,23 @@ class BinOutput:
     return ref
 
 
+# Pass as int_width or ref_width for variable-length (LEB128) encoding.
+VARINT = 0
+
+
+def _Varint(n, chunk):
+  """Unsigned LEB128."""
+  while n >= 0x80:
+    chunk.append((n & 0x7F) | 0x80)
+    n >>= 7
+  chunk.append(n)
+
+
+def _ZigZag(n):
+  """Map signed to unsigned: 0, -1, 1, -2 ... -> 0, 1, 2, 3 ..."""
+  return n * 2 if n >= 0 else -n * 2 - 1
+
+
 class Params:
   """Encoding parameters.
 
@@ -50,38 +86,72 @@ class Params:
   only global one is the ref/pointer alignment.  4 and 8 are the most likely
   choices, and 4 is probably fine, because you have 64 MB of addressable memory
   with 24 bit pointers.
+
+  The 24 bit defaults are what the C++ code in gen_cpp.py reads.  For bigger
+  trees, use 4 byte refs (16 GB addressable), or VARINT for the smallest
+  files.  Anything but the defaults is written with a version 2 header that
+  records the widths.
   """
 
-  def __init__(self, alignment=_DEFAULT_ALIGNMENT):
+  def __init__(self, alignment=_DEFAULT_ALIGNMENT, int_width=3, ref_width=3):
     self.alignment = alignment
     self.pointer_type = 'uint32_t'
 
     self.tag_width = 1  # for ArithVar vs ArithWord.
-    self.ref_width = 3  # 24 bits
-    self.int_width = 3  # 24 bits
+    self.ref_width = ref_width  # 24 bits by default
+    self.int_width = int_width  # 24 bits by default
     # used for fd, line/col
     # also I guess steuff like SimpleCommand
     self.index_width = 2  # 16 bits, e.g. max 64K entries in an array
 
-    self.max_int = 1 << (self.ref_width * 8)
+    # Ints are signed, e.g. -1 for a missing span ID.  The most negative
+    # value is reserved to encode None for optional ints.  (Varints encode
+    # None as 0 instead, and have no maximum.)
+    self.max_int = 1 << (self.int_width * 8 - 1) if int_width else None
+    self.null_int = -self.max_int if int_width else None
+    self.max_ref = 1 << (self.ref_width * 8) if ref_width else None
     self.max_index = 1 << (self.index_width * 8)
     self.max_tag = 1 << (self.tag_width * 8)
 
+  def Version(self):
+    """Return the format version, which is 1 if C++ can read it."""
+    return 1 if (self.int_width, self.ref_width) == (3, 3) else 2
+
   def Tag(self, i, chunk):
     if i > self.max_tag:
       raise AssertionError('Invalid id %r' % i)
     chunk.append(i & 0xFF)
 
-  def Int(self, n, chunk):
-    if n > self.max_int:
-      raise Error('%d is too big to fit in %d bytes' % (n, self.int_width))
-
-    for i in range(self.int_width):
-      chunk.append(n & 0xFF)
+  def _LittleEndian(self, n, width, chunk):
+    for i in range(width):
+      chunk.append(n & 0xFF)  # two's complement for negative numbers
       n >>= 8
 
+  def Int(self, n, chunk):
+    if self.int_width == VARINT:
+      _Varint(_ZigZag(n), chunk)
+      return
+    if not (self.null_int < n < self.max_int):
+      raise RuntimeError(
+          '%d is too big to fit in %d bytes' % (n, self.int_width))
+    self._LittleEndian(n, self.int_width, chunk)
+
+  def MaybeInt(self, n, chunk):
+    if self.int_width == VARINT:
+      _Varint(0 if n is None else _ZigZag(n) + 1, chunk)
+    elif n is None:
+      self._LittleEndian(self.null_int, self.int_width, chunk)
+    else:
+      self.Int(n, chunk)
+
   def Ref(self, n, chunk):
-    self.Int(n, chunk)
+    if self.ref_width == VARINT:
+      _Varint(n, chunk)
+      return
+    if not (0 <= n < self.max_ref):
+      raise RuntimeError(
+          'Ref %d is too big to fit in %d bytes' % (n, self.ref_width))
+    self._LittleEndian(n, self.ref_width, chunk)
 
   def _Pad(self, chunk):
     n = len(chunk)
@@ -233,7 +303,15 @@ def EncodeObj(obj, enc, out):
       elif isinstance(item_desc, asdl.Product):
         ok = True
 
-      # TODO: Fix this for span_id.  Need to extract a method.
+      # Optional ints and Ids, like token.span_id, are inline.
+      if isinstance(item_desc, asdl.IntType):
+        enc.MaybeInt(field_val, this_chunk)
+        continue
+      if isinstance(item_desc, asdl.UserType):
+        enc.MaybeInt(
+            None if field_val is None else field_val.enum_value, this_chunk)
+        continue
+
       if not ok:
         raise AssertionError(
             "Currently not encoding simple optional types: %s", field_val)
@@ -259,10 +337,11 @@ def EncodeObj(obj, enc, out):
 
 
 def EncodeRoot(obj, enc, out):
-  ref = out.Write(b'OHP\x01')  # header, version 1
+  assert enc.Version() == 1, 'Use EncodeTree() for other widths'
+  ref = out.Write(b'OHP\x01', share=False)  # header, version 1
   assert ref == 0
   # 4-byte alignment, then 3 byte placeholder for the root ref.
-  ref = out.Write(b'\4\0\0\0')
+  ref = out.Write(b'\4\0\0\0', share=False)
   assert ref == 1
 
   root_ref = EncodeObj(obj, enc, out)
@@ -271,3 +350,167 @@ def EncodeRoot(obj, enc, out):
   out.WriteRootRef(chunk)  # back up and write it
 
   #print("Root obj ref:", root_ref)
+
+
+def _IsInline(desc):
+  """Is a field of this type stored in the record, rather than referenced?"""
+  if isinstance(desc, (asdl.IntType, asdl.BoolType, asdl.UserType)):
+    return True
+  if isinstance(desc, asdl.Sum) and asdl.is_simple(desc):
+    return True
+  if isinstance(desc, asdl.MaybeType):
+    return isinstance(desc.desc, (asdl.IntType, asdl.UserType))
+  return False
+
+
+class _TreeEncoder(object):
+  """Writes a whole tree into one buffer, without recursion.
+
+  The output is the same as EncodeObj()'s: children are written before
+  parents.  Each object and array is a generator that yields its children
+  and is sent back their refs, so deep trees like long && chains don't hit
+  Python's recursion limit.
+  """
+
+  def __init__(self, enc, dedup):
+    self.enc = enc
+    self.buf = bytearray()
+    self.blocks = {} if dedup else None  # bytes -> ref
+
+  def _Pad(self):
+    n = len(self.buf) % self.enc.alignment
+    if n:
+      self.buf.extend(bytes(self.enc.alignment - n))
+
+  def _EndBlock(self, start):
+    """Pad the block that starts at a byte offset and return its ref."""
+    self._Pad()
+    if self.blocks is not None:
+      key = bytes(self.buf[start:])
+      ref = self.blocks.get(key)
+      if ref is not None:
+        del self.buf[start:]  # already written
+        return ref
+      self.blocks[key] = start // self.enc.alignment
+    return start // self.enc.alignment
+
+  def _Str(self, s):
+    start = len(self.buf)
+    self.enc.Str(s, self.buf)
+    return self._EndBlock(start)
+
+  def _ArrayGen(self, obj_list, item_desc):
+    enc = self.enc
+    refs = None
+    if not (isinstance(item_desc, (asdl.IntType, asdl.BoolType)) or
+            (isinstance(item_desc, asdl.Sum) and asdl.is_simple(item_desc))):
+      refs = []
+      for item in obj_list:
+        refs.append((yield item))
+
+    start = len(self.buf)
+    enc.Int(len(obj_list), self.buf)  # Length prefix
+    if refs is not None:
+      for ref in refs:
+        enc.Ref(ref, self.buf)
+    elif isinstance(item_desc, asdl.Sum):
+      for item in obj_list:
+        enc.Int(item.enum_id, self.buf)
+    else:
+      for item in obj_list:
+        enc.Int(item, self.buf)
+    return self._EndBlock(start)
+
+  def _ObjGen(self, obj):
+    """Yields children to encode, then writes the record."""
+    assert isinstance(obj, py_meta.CompoundObj), \
+      '%r is not a compound obj (%r)' % (obj, obj.__class__)
+
+    # The value of each field: an int for inline fields, or a ref.
+    slots = []
+    for name in obj.FIELDS:
+      desc = obj.DESCRIPTOR_LOOKUP[name]
+      field_val = getattr(obj, name)
+
+      if isinstance(desc, (asdl.IntType, asdl.BoolType)):
+        slots.append(field_val)
+      elif isinstance(desc, asdl.Sum) and asdl.is_simple(desc):
+        slots.append(field_val.enum_id)
+      elif isinstance(desc, asdl.UserType):
+        slots.append(field_val.enum_value)
+      elif isinstance(desc, asdl.StrType):
+        slots.append(self._Str(field_val))
+      elif isinstance(desc, asdl.ArrayType):
+        slots.append((yield (field_val, desc.desc)))
+      elif isinstance(desc, asdl.MaybeType):
+        item_desc = desc.desc
+        if isinstance(item_desc, asdl.UserType):
+          slots.append(None if field_val is None else field_val.enum_value)
+        elif isinstance(item_desc, asdl.IntType):
+          slots.append(field_val)
+        elif isinstance(item_desc, (asdl.Sum, asdl.Product)) and not (
+            isinstance(item_desc, asdl.Sum) and asdl.is_simple(item_desc)):
+          slots.append(0 if field_val is None else (yield field_val))
+        else:
+          raise AssertionError(
+              "Currently not encoding simple optional types: %s", field_val)
+      else:
+        slots.append((yield field_val))
+
+    enc = self.enc
+    start = len(self.buf)
+    if isinstance(obj.DESCRIPTOR, asdl.Constructor):
+      enc.Tag(obj.tag, self.buf)
+    for name, val in zip(obj.FIELDS, slots):
+      desc = obj.DESCRIPTOR_LOOKUP[name]
+      if isinstance(desc, asdl.MaybeType) and _IsInline(desc):
+        enc.MaybeInt(val, self.buf)
+      elif _IsInline(desc):
+        enc.Int(val, self.buf)
+      else:
+        enc.Ref(val, self.buf)
+    return self._EndBlock(start)
+
+  def _Gen(self, item):
+    if isinstance(item, tuple):  # (list, item descriptor)
+      return self._ArrayGen(*item)
+    return self._ObjGen(item)
+
+  def Encode(self, obj):
+    """Encode a tree and return the file contents."""
+    enc = self.enc
+    if enc.Version() == 1:
+      self.buf.extend(b'OHP\x01')
+      self.buf.extend(bytes([enc.alignment, 0, 0, 0]))
+      root_pos, root_width = 5, 3
+    else:
+      self.buf.extend(b'OHP\x02')
+      self.buf.extend(bytes([enc.alignment, enc.int_width, enc.ref_width, 0]))
+      self.buf.extend(bytes(4))
+      root_pos, root_width = 8, 4
+    self._Pad()
+
+    stack = [self._Gen(obj)]
+    ref = None
+    while stack:
+      try:
+        child = stack[-1].send(ref)
+      except StopIteration as e:
+        stack.pop()
+        ref = e.value
+      else:
+        stack.append(self._Gen(child))
+        ref = None
+
+    self.buf[root_pos : root_pos + root_width] = ref.to_bytes(
+        root_width, 'little')
+    return self.buf
+
+
+def EncodeTree(obj, enc, f, dedup=False):
+  """Encode a tree with any Params, writing to the file once.
+
+  Unlike EncodeRoot(), this doesn't recurse and writes to one buffer.  See
+  BinOutput for dedup.
+  """
+  f.write(_TreeEncoder(enc, dedup).Encode(obj))
@@ -27,6 +27,26 @@ class EncoderTest(unittest.TestCase):
 
     #p.Block([b'a', b'bc'])
 
+  def testSignedInt(self):
+    p = encode.Params()
+
+    chunk = bytearray()
+    p.Int(-1, chunk)
+    self.assertEqual(b'\xff\xff\xff', chunk)
+
+    # The most negative value is reserved for None.
+    chunk = bytearray()
+    p.MaybeInt(None, chunk)
+    self.assertEqual(b'\x00\x00\x80', chunk)
+    self.assertRaises(RuntimeError, p.Int, p.null_int, bytearray())
+    self.assertRaises(RuntimeError, p.Int, 1 << 23, bytearray())
+
+    # Refs are unsigned.
+    chunk = bytearray()
+    p.Ref((1 << 24) - 1, chunk)
+    self.assertEqual(b'\xff\xff\xff', chunk)
+    self.assertRaises(RuntimeError, p.Ref, -1, bytearray())
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+gen_python.py
+
+Turn an ASDL schema into a Python module with the same classes that
+py_meta.MakeTypes() makes in fast mode (check_types=False).
+
+Importing the generated module is much faster than parsing the schema and
+making the classes at startup.  It's built by './build.sh py-asdl', and only
+used if it was generated from the current schema.  See
+py_meta.ImportGenerated().
+
+Usage:
+  asdl/gen_python.py py osh/osh.asdl id=core.id_kind.Id > _devbuild/osh_asdl.py
+"""
+
+import importlib
+import sys
+
+from asdl import asdl_ as asdl
+from asdl import py_meta
+from asdl.gen_cpp import FormatLines
+
+
+class GenPythonVisitor(object):
+  """Print a module with descriptors, then classes.
+
+  Descriptors come first, because ASDL allows forward references.
+  """
+
+  def __init__(self, f, app_types=None, app_imports=None):
+    """
+    Args:
+      f: output file
+      app_types: dict of type name -> asdl.UserType, like MakeTypes()
+      app_imports: dict of type name -> module to import the class from.
+        Classes made by py_meta don't know their module.
+    """
+    self.f = f
+    self.app_types = app_types or {}
+    self.app_imports = app_imports or {}
+    self.module = None
+    self.names = []  # for __all__
+
+  def Emit(self, s, depth=0):
+    for line in FormatLines(s, depth, reflow=False):
+      self.f.write(line)
+
+  def _DescName(self, type_name):
+    return '_%s_desc' % type_name
+
+  def _FieldDesc(self, field):
+    """Return an expression for the descriptor of a field."""
+    if field.type in asdl.DESCRIPTORS_BY_NAME:
+      expr = 'asdl.DESCRIPTORS_BY_NAME[%r]' % field.type
+    elif field.type in self.module.types:
+      expr = self._DescName(field.type)
+    elif field.type in self.app_types:
+      expr = '_app_types[%r]' % field.type
+    else:
+      raise AssertionError('Unknown type %r' % field.type)
+    if field.opt:
+      expr = 'asdl.MaybeType(%s)' % expr
+    if field.seq:
+      expr = 'asdl.ArrayType(%s)' % expr
+    return expr
+
+  def _EmitFields(self, fields, depth):
+    for f in fields:
+      args = [repr(f.type), repr(f.name)]
+      if f.seq:
+        args.append('seq=True')
+      if f.opt:
+        args.append('opt=True')
+      self.Emit('asdl.Field(%s),' % ', '.join(args), depth)
+
+  def VisitModule(self, module, schema_path):
+    self.module = module
+
+    self.Emit('"""')
+    self.Emit('Generated by asdl/gen_python.py from %s.  Don\'t edit.' %
+              schema_path)
+    self.Emit('"""')
+    self.Emit('')
+    self.Emit('from asdl import asdl_ as asdl')
+    self.Emit('from asdl import py_meta')
+    for name, typ in sorted(self.app_types.items(),
+                            key=lambda p: p[1].typ.__name__):
+      if typ.typ.__name__ in module.types:
+        raise RuntimeError('App type %r is shadowed' % typ.typ.__name__)
+      mod_name = self.app_imports.get(name, typ.typ.__module__)
+      self.Emit('from %s import %s' % (mod_name, typ.typ.__name__))
+    self.Emit('')
+    self.Emit('SCHEMA_DIGEST = %r' % py_meta.SchemaDigest(schema_path))
+    self.Emit('')
+    self.Emit('_UNSET = py_meta._UNSET')
+    self.Emit('_app_types = {%s}' % ', '.join(
+        '%r: asdl.UserType(%s)' % (name, typ.typ.__name__)
+        for name, typ in sorted(self.app_types.items())))
+    self.Emit('')
+
+    #
+    # Descriptors
+    #
+
+    for defn in module.dfns:
+      typ = defn.value
+      desc_name = self._DescName(defn.name)
+      if isinstance(typ, asdl.Sum):
+        self.Emit('%s = asdl.Sum([' % desc_name)
+        for cons in typ.types:
+          if cons.fields:
+            self.Emit('asdl.Constructor(%r, [' % cons.name, 1)
+            self._EmitFields(cons.fields, 2)
+            self.Emit(']),', 1)
+          else:
+            self.Emit('asdl.Constructor(%r),' % cons.name, 1)
+        self.Emit('])')
+      elif isinstance(typ, asdl.Product):
+        self.Emit('%s = asdl.Product([' % desc_name)
+        self._EmitFields(typ.fields, 1)
+        self.Emit('])')
+      else:
+        raise AssertionError(typ)
+    self.Emit('')
+    self.Emit('')
+
+    #
+    # Classes
+    #
+
+    for defn in module.dfns:
+      typ = defn.value
+      if isinstance(typ, asdl.Sum):
+        if asdl.is_simple(typ):
+          self.VisitSimpleSum(typ, defn.name)
+        else:
+          self.VisitCompoundSum(typ, defn.name)
+      else:
+        self.EmitClass(defn.name, 'py_meta.CompoundObj',
+                       self._DescName(defn.name), typ.fields)
+
+    self.Emit('__all__ = [')
+    for name in self.names:
+      self.Emit('%r,' % name, 1)
+    self.Emit(']')
+
+  def VisitSimpleSum(self, sum, name):
+    self.Emit('class %s(py_meta.SimpleObj):' % name)
+    self.Emit('DESCRIPTOR = %s' % self._DescName(name), 1)
+    self.Emit('')
+    for i, cons in enumerate(sum.types):
+      self.Emit('%s.%s = %s(%d, %r)' % (name, cons.name, name, i + 1, cons.name))
+    self.Emit('')
+    self.Emit('')
+    self.names.append(name)
+
+  def VisitCompoundSum(self, sum, name):
+    desc_name = self._DescName(name)
+
+    self.Emit('class %s(py_meta.CompoundObj):' % name)
+    self.Emit('__slots__ = ()', 1)
+    self.Emit('DESCRIPTOR = %s' % desc_name, 1)
+    self.Emit('')
+    self.Emit('')
+    self.names.append(name)
+
+    for i, cons in enumerate(sum.types):
+      self.EmitClass(cons.name, name, '%s.types[%d]' % (desc_name, i),
+                     cons.fields, tag=i + 1)
+
+    # e.g. arith_expr_e.Const == 1
+    enum_name = name + '_e'
+    self.Emit('class %s(object):' % enum_name)
+    for i, cons in enumerate(sum.types):
+      self.Emit('%s = %d' % (cons.name, i + 1), 1)
+    self.Emit('')
+    self.Emit('')
+    self.names.append(enum_name)
+
+  def EmitClass(self, name, base, desc_expr, fields, tag=None):
+    # Add 'int* spids', like _MakeFieldDescriptors().
+    field_names = [f.name for f in fields] + ['spids']
+
+    self.Emit('class %s(%s):' % (name, base))
+    self.Emit('__slots__ = %r' % (tuple(field_names), ), 1)
+    self.Emit('DESCRIPTOR = %s' % desc_expr, 1)
+    if tag is not None:
+      self.Emit('tag = %d' % tag, 1)
+    self.Emit('FIELDS = %r' % field_names, 1)
+    self.Emit('DESCRIPTOR_LOOKUP = {', 1)
+    for f in fields:
+      self.Emit('%r: %s,' % (f.name, self._FieldDesc(f)), 2)
+    self.Emit("'spids': asdl.ArrayType(asdl.IntType()),", 2)
+    self.Emit('}', 1)
+    self.Emit('')
+
+    # InitSource() only looks at whether fields are Maybe or Array.
+    desc_lookup = {f.name: self._KindDesc(f) for f in fields}
+    desc_lookup['spids'] = asdl.ArrayType(None)
+    self.f.write(py_meta.InitSource(field_names, desc_lookup, indent='  '))
+    self.Emit('')
+    self.Emit('')
+    self.names.append(name)
+
+  def _KindDesc(self, field):
+    if field.seq:
+      return asdl.ArrayType(None)
+    if field.opt:
+      return asdl.MaybeType(None)
+    return None
+
+
+def _ParseAppTypes(args):
+  """Turn args like id=core.id_kind.Id into a dict of asdl.UserType.
+
+  Also returns the module each one was imported from.
+  """
+  app_types = {}
+  app_imports = {}
+  for arg in args:
+    name, path = arg.split('=', 1)
+    mod_name, cls_name = path.rsplit('.', 1)
+    cls = getattr(importlib.import_module(mod_name), cls_name)
+    app_types[name] = asdl.UserType(cls)
+    app_imports[name] = mod_name
+  return app_types, app_imports
+
+
+def main(argv):
+  try:
+    action = argv[1]
+  except IndexError:
+    raise RuntimeError('Action required')
+
+  if action == 'py':
+    schema_path = argv[2]
+    app_types, app_imports = _ParseAppTypes(argv[3:])
+
+    module = asdl.parse(schema_path)
+    if not asdl.check(module, app_types):
+      raise RuntimeError('ASDL file is invalid')
+
+    v = GenPythonVisitor(sys.stdout, app_types, app_imports)
+    v.VisitModule(module, schema_path)
+
+  else:
+    raise RuntimeError('Invalid action %r' % action)
+
+
+if __name__ == '__main__':
+  try:
+    main(sys.argv)
+  except RuntimeError as e:
+    print('FATAL: %s' % e, file=sys.stderr)
+    sys.exit(1)
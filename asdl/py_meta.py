@@ -26,6 +26,8 @@ implementation has to differ from what's generated by asdl_c.py.  More simply
 put: an op is Add() and not Add, an instance of a class, not an integer value.
 """
 
+import hashlib
+import importlib
 import io
 import sys
 
@@ -96,11 +98,21 @@ def _CheckType(value, expected_desc):
       'Invalid descriptor %r: %r' % (expected_desc.__class__, expected_desc))
 
 
+# If true, MakeTypes() makes classes that check the type of every field
+# assignment.  Otherwise they have __slots__ and plain attributes, which is
+# much faster and smaller.  bin/oil.py turns this off before the schemas are
+# loaded; tests keep it on.
+CHECK_TYPES = True
+
+
 class Obj:
   # NOTE: We're using CAPS for these static fields, since they are constant at
   # runtime after metaprogramming.
   DESCRIPTOR = None  # Used for type checking
 
+  # Empty, so subclasses can choose between __dict__ and __slots__.
+  __slots__ = ()
+
 
 class SimpleObj(Obj):
   """An enum value.
@@ -118,8 +130,11 @@ class SimpleObj(Obj):
 class CompoundObj(Obj):
   """A compound object with fields, e.g. a Product or Constructor.
 
-  Uses some metaprogramming.
+  Uses some metaprogramming.  The methods here work for both the checked
+  classes (CheckedObj) and the fast ones (_MakeFastInit).
   """
+  __slots__ = ()
+
   FIELDS = []  # ordered list of field names
   DESCRIPTOR_LOOKUP = {}  # field name: (asdl.Type | int | str)
 
@@ -127,13 +142,6 @@ class CompoundObj(Obj):
   # set for product types.
   tag = None
 
-  def __init__(self, *args, **kwargs):
-    # The user must specify ALL required fields or NONE.
-    self._assigned = {f: False for f in self.FIELDS}
-    self._SetDefaults()
-    if args or kwargs:
-      self._Init(args, kwargs)
-
   def __eq__(self, other):
     if not isinstance(other, CompoundObj):
       return False
@@ -152,6 +160,39 @@ class CompoundObj(Obj):
 
     return True
 
+  def CheckUnassigned(self):
+    """See if there are unassigned fields, for later encoding."""
+    unassigned = []
+    for name in self.FIELDS:
+      if not hasattr(self, name):
+        desc = self.DESCRIPTOR_LOOKUP[name]
+        if not isinstance(desc, asdl.MaybeType):
+          unassigned.append(name)
+    if unassigned:
+      raise ValueError("Fields %r were't be assigned" % unassigned)
+
+  def __repr__(self):
+    ast_f = fmt.TextOutput(io.StringIO())  # No color by default.
+    #ast_f = fmt.AnsiOutput(io.StringIO())
+    tree = fmt.MakeTree(self)
+    fmt.PrintTree(tree, ast_f)
+    s, _ = ast_f.GetRaw()
+    return s
+
+
+class CheckedObj(CompoundObj):
+  """A CompoundObj that checks the type of every field assignment.
+
+  Instances have a __dict__, and remember which fields were assigned.
+  """
+
+  def __init__(self, *args, **kwargs):
+    # The user must specify ALL required fields or NONE.
+    self._assigned = {f: False for f in self.FIELDS}
+    self._SetDefaults()
+    if args or kwargs:
+      self._Init(args, kwargs)
+
   def _SetDefaults(self):
     for name in self.FIELDS:
       #print("%r wasn't assigned" % name)
@@ -177,17 +218,6 @@ class CompoundObj(Obj):
         # If anything was set, then required fields raise an error.
         raise ValueError("Field %r is required and wasn't initialized" % name)
 
-  def CheckUnassigned(self):
-    """See if there are unassigned fields, for later encoding."""
-    unassigned = []
-    for name in self.FIELDS:
-      if not self._assigned[name]:
-        desc = self.DESCRIPTOR_LOOKUP[name]
-        if not isinstance(desc, asdl.MaybeType):
-          unassigned.append(name)
-    if unassigned:
-      raise ValueError("Fields %r were't be assigned" % unassigned)
-
   def __setattr__(self, name, value):
     if name == '_assigned':
       self.__dict__[name] = value
@@ -205,13 +235,60 @@ class CompoundObj(Obj):
     self._assigned[name] = True  # check this later when encoding
     self.__dict__[name] = value
 
-  def __repr__(self):
-    ast_f = fmt.TextOutput(io.StringIO())  # No color by default.
-    #ast_f = fmt.AnsiOutput(io.StringIO())
-    tree = fmt.MakeTree(self)
-    fmt.PrintTree(tree, ast_f)
-    s, _ = ast_f.GetRaw()
-    return s
+
+_UNSET = object()  # default for required fields in fast __init__
+
+
+def InitSource(field_names, desc_lookup, indent=''):
+  """Return the source of a fast __init__ that assigns fields directly.
+
+  It has the same signature as CheckedObj's: either all required fields are
+  passed, or none, and they're assigned later.  Maybe fields default to None
+  and arrays to a new empty list.  Nothing is checked.
+
+  Like collections.namedtuple, we generate source, because a generic loop
+  over FIELDS costs more than the assignments themselves.  gen_python.py
+  writes the same source to a file.
+  """
+  params = ['self']
+  body = []
+  for name in field_names:
+    desc = desc_lookup[name]
+    if isinstance(desc, asdl.MaybeType):
+      params.append('%s=None' % name)
+      body.append('self.%s = %s' % (name, name))
+    elif isinstance(desc, asdl.ArrayType):
+      params.append('%s=None' % name)
+      body.append('self.%s = [] if %s is None else %s' % (name, name, name))
+    else:
+      params.append('%s=_UNSET' % name)
+      body.append('if %s is not _UNSET: self.%s = %s' % (name, name, name))
+  if not body:
+    body.append('pass')
+
+  lines = ['%sdef __init__(%s):' % (indent, ', '.join(params))]
+  lines.extend('%s  %s' % (indent, line) for line in body)
+  return '\n'.join(lines) + '\n'
+
+
+def _MakeFastInit(class_name, field_names, desc_lookup):
+  src = InitSource(field_names, desc_lookup)
+  namespace = {'_UNSET': _UNSET}
+  exec(compile(src, '<py_meta %s>' % class_name, 'exec'), namespace)
+  return namespace['__init__']
+
+
+def _MakeClass(name, base, class_attr, check_types):
+  """Make a class for a Product or Constructor."""
+  if check_types:
+    if base is CompoundObj:
+      base = CheckedObj
+  else:
+    field_names = class_attr['FIELDS']
+    class_attr['__slots__'] = tuple(field_names)
+    class_attr['__init__'] = _MakeFastInit(
+        name, field_names, class_attr['DESCRIPTOR_LOOKUP'])
+  return type(name, (base, ), class_attr)
 
 
 def _MakeFieldDescriptors(module, fields, app_types, add_spids=True):
@@ -253,13 +330,16 @@ def _MakeFieldDescriptors(module, fields, app_types, add_spids=True):
   return class_attr
 
 
-def MakeTypes(module, root, app_types=None):
+def MakeTypes(module, root, app_types=None, check_types=None):
   """
   Args:
     module: asdl.Module
     root: an object/package to add types to
+    check_types: whether to make checked classes; defaults to CHECK_TYPES
   """
   app_types = app_types or {}
+  if check_types is None:
+    check_types = CHECK_TYPES
   for defn in module.dfns:
     typ = defn.value
 
@@ -284,7 +364,14 @@ def MakeTypes(module, root, app_types=None):
 
         # e.g. for arith_expr
         # Should this be arith_expr_t?  It is in C++.
-        base_class = type(defn.name, (CompoundObj, ), {})
+        # DESCRIPTOR is overridden by each constructor, but the decoder needs
+        # the Sum.
+        base_attr = {'DESCRIPTOR': sum_type}
+        if check_types:
+          base_class = type(defn.name, (CheckedObj, ), base_attr)
+        else:
+          base_attr['__slots__'] = ()
+          base_class = type(defn.name, (CompoundObj, ), base_attr)
         setattr(root, defn.name, base_class)
 
         # Make a type and a enum tag for each alternative.
@@ -298,7 +385,7 @@ def MakeTypes(module, root, app_types=None):
           class_attr['DESCRIPTOR'] = cons  # asdl.Constructor
           class_attr['tag'] = tag
 
-          cls = type(cons.name, (base_class, ), class_attr)
+          cls = _MakeClass(cons.name, base_class, class_attr, check_types)
           setattr(root, cons.name, cls)
 
         # e.g. arith_expr_e.Const == 1
@@ -310,8 +397,36 @@ def MakeTypes(module, root, app_types=None):
       class_attr = _MakeFieldDescriptors(module, typ.fields, app_types)
       class_attr['DESCRIPTOR'] = typ
 
-      cls = type(defn.name, (CompoundObj, ), class_attr)
+      cls = _MakeClass(defn.name, CompoundObj, class_attr, check_types)
       setattr(root, defn.name, cls)
 
     else:
       raise AssertionError(typ)
+
+
+# Change this when gen_python.py's output changes, so old generated modules
+# aren't used.
+_GEN_VERSION = 1
+
+
+def SchemaDigest(schema_path):
+  """Identifies the schema a module was generated from."""
+  h = hashlib.sha1(b'%d\n' % _GEN_VERSION)
+  with open(schema_path, 'rb') as f:
+    h.update(f.read())
+  return h.hexdigest()
+
+
+def ImportGenerated(mod_name, schema_path):
+  """Import a module that gen_python.py generated from a schema.
+
+  Returns:
+    The module, or None if it wasn't built or the schema changed since.
+  """
+  try:
+    mod = importlib.import_module(mod_name)
+  except ImportError:
+    return None
+  if mod.SCHEMA_DIGEST != SchemaDigest(schema_path):
+    return None
+  return mod
@@ -3,13 +3,60 @@
 py_meta_test.py: Tests for py_meta.py
 """
 
-import re
+import os
 import unittest
 
+from asdl import asdl_ as asdl
 from asdl import py_meta  # module under test
 
+
+def _MakeRoot(check_types):
+  class Root(object):
+    pass
+  schema_path = os.path.join(os.path.dirname(__file__), 'arith.asdl')
+  py_meta.MakeTypes(asdl.parse(schema_path), Root, check_types=check_types)
+  return Root
+
+
 class AsdlTest(unittest.TestCase):
-  pass
+
+  def testModes(self):
+    checked = _MakeRoot(True)
+    fast = _MakeRoot(False)
+
+    for root in (checked, fast):
+      n = root.ArithBinary(root.op_id.Plus, root.Const(1), root.Const(2))
+      self.assertTrue(isinstance(n, root.arith_expr))
+      self.assertTrue(isinstance(n, py_meta.CompoundObj))
+      self.assertEqual(root.arith_expr_e.ArithBinary, n.tag)
+      self.assertEqual(2, n.right.i)
+      self.assertEqual([], n.spids)
+
+      # Defaults, and assigning fields later.
+      s = root.Slice()
+      self.assertEqual(None, s.begin)
+      self.assertRaises(AttributeError, getattr, s, 'a')
+      self.assertRaises(ValueError, s.CheckUnassigned)
+      s.a = root.ArithVar('x')
+      s.CheckUnassigned()
+
+      s2 = root.Slice(a=root.ArithVar('x'))
+      self.assertEqual(s, s2)
+      self.assertIsNot(s.spids, s2.spids)
+
+      self.assertRaises(AttributeError, setattr, n, 'nonexistent', 1)
+
+    # Only checked classes check types.
+    self.assertRaises(AssertionError, checked.Const, 'invalid')
+    self.assertEqual('invalid', fast.Const('invalid').i)
+
+    # Fast objects have no __dict__.
+    self.assertTrue(hasattr(checked.Const(1), '__dict__'))
+    self.assertFalse(hasattr(fast.Const(1), '__dict__'))
+
+    # They print the same.
+    self.assertEqual(repr(checked.FuncCall('f', [checked.Const(1)])),
+                     repr(fast.FuncCall('f', [fast.Const(1)])))
 
 
 if __name__ == '__main__':
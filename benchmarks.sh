@@ -0,0 +1,29 @@
+#!/bin/bash
+#
+# Performance benchmarks.
+#
+# Usage:
+#   ./benchmarks.sh <function name>
+
+set -o nounset
+set -o pipefail
+set -o errexit
+
+export PYTHONPATH=.
+
+# Compare lexer engines on the scripts in tests/.
+#
+# NOTE: 09-here-doc.sh is skipped because the parser doesn't terminate on it.
+lexer-tests() {
+  core/lexer_bench.py $(ls tests/*.sh | grep -v 09-here-doc.sh) *.sh
+}
+
+# Compare lexer engines on a wild.sh corpus, e.g.
+#
+#   ./benchmarks.sh lexer-wild ~/src/aboriginal-1.4.5
+lexer-wild() {
+  local src=$1
+  core/lexer_bench.py $(find $src -name '*.sh' -a -type f)
+}
+
+"$@"
@@ -31,6 +31,11 @@ import traceback  # for debugging
 this_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
 sys.path.append(os.path.join(this_dir, '..'))
 
+# Make fast classes for the ASDL schemas, before they're loaded.  Unit tests
+# check the type of every field assignment.
+from asdl import py_meta
+py_meta.CHECK_TYPES = False
+
 from asdl import format as fmt
 from asdl import encode
 
@@ -40,11 +45,13 @@ from core import lexer  # for tracing
 
 from osh import ast_ as ast
 from osh import parse_lib
+from osh import parse_cache
 from osh import fix
 
 from core import builtin
 from core import completion
 from core import cmd_exec
+from core import process
 from core.alloc import Pool
 from core import reader
 from core.id_kind import Id
@@ -60,7 +67,21 @@ class UsageError(RuntimeError):
   """ Exception for incorrect command line usage. """
 
 
-def InteractiveLoop(opts, ex, c_parser, w_parser, line_reader):
+def _FreeCommand(arena, mark, node, ex):
+  """Free the lines and spans of a command that was executed.
+
+  Only the ones that its function definitions refer to are kept, since those
+  functions can be called later.  That includes functions in files it
+  sourced.
+  """
+  func_defs = cmd_parse.FindFuncDefs(node) + ex.TakeSourcedFuncDefs()
+  if func_defs:
+    arena.Compact(mark, func_defs)
+  else:
+    arena.PopToMark(mark)
+
+
+def InteractiveLoop(opts, ex, c_parser, w_parser, line_reader, arena):
   # Is this correct?  Are there any non-ANSI terminals?  I guess you can pass
   # -i but redirect stdout.
   if opts.ast_output == '-':
@@ -72,6 +93,7 @@ def InteractiveLoop(opts, ex, c_parser, w_parser, line_reader):
     ast_f = None
 
   while True:
+    mark = arena.Mark()
     try:
       w = c_parser.Peek()
     except KeyboardInterrupt:
@@ -83,6 +105,7 @@ def InteractiveLoop(opts, ex, c_parser, w_parser, line_reader):
     c_id = word.CommandId(w)
     if c_id == Id.Op_Newline:
       print('nothing to execute')
+      arena.PopToMark(mark)
     elif c_id == Id.Eof_Real:
       print('EOF')
       break
@@ -104,10 +127,11 @@ def InteractiveLoop(opts, ex, c_parser, w_parser, line_reader):
       if opts.print_status:
         print('STATUS', repr(status))
 
-    # Reset prompt and clear memory.  TODO: If there are any function
-    # definitions ANYWHERE in the node, you should not clear the underlying
-    # memory.  We still need to execute those strings!
-    line_reader.Reset()
+      # Clear memory, so a long session doesn't grow without bound.
+      _FreeCommand(arena, mark, node, ex)
+      del node
+
+    line_reader.Reset()  # back to PS1
 
     # Reset internal newline state.
     # NOTE: It would actually be correct to reinitialize all objects (except
@@ -117,6 +141,51 @@ def InteractiveLoop(opts, ex, c_parser, w_parser, line_reader):
     c_parser.Reset()
 
 
+def BatchLoop(ex, c_parser, w_parser, arena):
+  """Parse and execute one command line at a time, for non-interactive shells.
+
+  Unlike ParseWholeFile(), the first command runs before the rest of the file
+  is read, and the lines and spans of each command are freed after it runs,
+  except those of function bodies.
+
+  Returns:
+    exit status of the last command, or 2 for a parse error.
+  """
+  status = 0
+  while True:
+    mark = arena.Mark()
+
+    w = c_parser.Peek()
+    if w is None:
+      ui.PrintError(c_parser.Error(), arena, sys.stderr)
+      return 2  # parse error is code 2
+
+    c_id = word.CommandId(w)
+    if c_id == Id.Eof_Real:
+      break
+
+    if c_id != Id.Op_Newline:  # skip blank lines
+      node = c_parser.ParseCommandLine()
+      if not node:
+        ui.PrintError(c_parser.Error(), arena, sys.stderr)
+        return 2
+
+      status, is_fatal = ex.ExecuteAndCatch(node)
+      if is_fatal:
+        break
+
+      _FreeCommand(arena, mark, node, ex)
+      del node
+    else:
+      arena.PopToMark(mark)  # the blank or comment line
+
+    # Clear internal newline state, like InteractiveLoop.
+    w_parser.Reset()
+    c_parser.Reset()
+
+  return status
+
+
 def Options():
   """Returns an option parser instance."""
   p = optparse.OptionParser()
@@ -198,7 +267,9 @@ def OshMain(argv):
   # It uses a different memory-management model.  It's a batch program and not
   # an interactive program.
 
-  pool = Pool()
+  # Only osh-to-oil needs every line of the file; error messages can read
+  # them from disk again.
+  pool = Pool(retain_file_lines=opts.fix)
   arena = pool.NewArena()
 
   # TODO: Maybe wrap this initialization sequence up in an oil_State, like
@@ -215,28 +286,36 @@ def OshMain(argv):
   # TODO: How to get a handle to initialized builtins here?
   # tokens.py has it.  I think you just make a separate table, with
   # metaprogramming.
+  # Opt-in with $OSH_PARSE_CACHE.
+  cache_dir = parse_cache.DefaultDir()
+  p_cache = parse_cache.ParseCache(cache_dir) if cache_dir else None
+
   ex = cmd_exec.Executor(
       mem, builtins, funcs, comp_lookup, exec_opts,
-      parse_lib.MakeParserForExecutor)
+      parse_lib.MakeParserForExecutor, parse_cache=p_cache, arena=arena)
+  # Reap background jobs when they exit.
+  process.JOB_STATE.InitSigChld()
 
   # NOTE: The rc file can contain both commands and functions... ideally we
   # would only want to save nodes/lines for the functions.
   try:
     rc_path = 'oilrc'
-    with open(rc_path) as f:
-      contents = f.read()
-    arena.AddSourcePath(rc_path)
-    #print(repr(contents))
-
-    rc_line_reader = reader.StringLineReader(contents, arena=arena)
-    _, rc_c_parser = parse_lib.MakeParserForTop(rc_line_reader)
-    rc_node = rc_c_parser.ParseWholeFile()
+    rc_node = p_cache and p_cache.Load(rc_path, arena=arena)
     if not rc_node:
-      # TODO: Error should return a token, and then the token should have a
-      # arena index, and then look that up in the arena.
-      err = rc_c_parser.Error()
-      ui.PrintError(err, arena, sys.stderr)
-      return 2  # parse error is code 2
+      mark = arena.Mark()
+      rc_line_reader = reader.FileLineReader(rc_path, arena=arena)
+
+      _, rc_c_parser = parse_lib.MakeParserForTop(rc_line_reader, arena=arena)
+      rc_node = rc_c_parser.ParseWholeFile()
+      if not rc_node:
+        # TODO: Error should return a token, and then the token should have a
+        # arena index, and then look that up in the arena.
+        err = rc_c_parser.Error()
+        ui.PrintError(err, arena, sys.stderr)
+        return 2  # parse error is code 2
+      if p_cache:
+        p_cache.Save(rc_path, rc_line_reader.file_stat, rc_node, arena=arena,
+                     mark=mark)
 
     status = ex.Execute(rc_node)
     #print('oilrc:', status, cflow, file=sys.stderr)
@@ -263,12 +342,10 @@ def OshMain(argv):
         interactive = True
       else:
         arena.AddSourcePath('<stdin>')
-        line_reader = reader.StringLineReader(sys.stdin.read(), arena=arena)
+        line_reader = reader.StreamLineReader(sys.stdin, arena=arena)
         interactive = False
     else:
-      arena.AddSourcePath(script_name)
-      with open(script_name) as f:
-        line_reader = reader.StringLineReader(f.read(), arena=arena)
+      line_reader = reader.FileLineReader(script_name, arena=arena)
       interactive = False
 
   # TODO: assert arena.NumSourcePaths() == 1
@@ -282,14 +359,14 @@ def OshMain(argv):
     completion.Init(builtins, mem, funcs, comp_lookup, status_lines, ev)
 
     # TODO: Could instantiate "printer" instead of showing ops
-    InteractiveLoop(opts, ex, c_parser, w_parser, line_reader)
+    InteractiveLoop(opts, ex, c_parser, w_parser, line_reader, arena)
     status = 0  # TODO: set code
-  else:
-    # Parse the whole thing up front
-    #print('Parsing file')
+  elif opts.do_exec and not opts.ast_output and not opts.fix:
+    # Nothing needs the whole tree, so stream it.
+    status = BatchLoop(ex, c_parser, w_parser, arena)
 
-    # TODO: Do I need ParseAndEvalLoop?  How is it different than
-    # InteractiveLoop?
+  else:
+    # Parse the whole thing up front, for --ast-output, --fix, and --no-exec.
     node = c_parser.ParseWholeFile()
     if not node:
       err = c_parser.Error()
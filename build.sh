@@ -36,9 +36,37 @@ test-pylibc() {
   core/libc_test.py
 }
 
+# Generate Python modules for the ASDL schemas and the Id table, so the shell
+# doesn't build them at startup.  They're ignored when the schemas change, so
+# run this again after changing them.
+py-asdl() {
+  export PYTHONPATH=.
+  local out=_devbuild/gen
+  mkdir -p $out
+  touch _devbuild/__init__.py $out/__init__.py
+
+  # Write to temp files, since the generators import the old modules.
+  core/id_kind_gen.py py > $out/id_kind_table.py.tmp
+  asdl/gen_python.py py osh/osh.asdl id=core.id_kind.Id > $out/osh_asdl.py.tmp
+  asdl/gen_python.py py core/runtime.asdl > $out/runtime_asdl.py.tmp
+  # Keep in sync with _AppTypes() in core/ovm.py.
+  asdl/gen_python.py py ovm/ovm.asdl id=core.id_kind.Id \
+    osh_word=osh.ast_.word osh_redir=osh.ast_.redir \
+    osh_env_pair=osh.ast_.env_pair osh_assign_pair=osh.ast_.assign_pair \
+    osh_token=osh.ast_.token osh_arith_expr=osh.ast_.arith_expr \
+    osh_bool_expr=osh.ast_.bool_expr closure=builtins.object \
+    > $out/ovm_asdl.py.tmp
+
+  local name
+  for name in id_kind_table osh_asdl runtime_asdl ovm_asdl; do
+    mv $out/$name.py.tmp $out/$name.py
+  done
+  ls -l $out
+}
+
 clean() {
   rm -f --verbose core/libc.so
-  rm -r -f --verbose build
+  rm -r -f --verbose build _devbuild
 }
 
 "$@"
@@ -8,6 +8,30 @@ Right after executing, you remove the arena from the pool.
 Better names?  I think pool is the higher level, and arena is the lower level.
 """
 
+import array
+import os
+
+from asdl import py_meta
+from core import reader
+from osh import ast_ as ast
+
+
+def _ReadLineAt(fd, offset):
+  """Read the bytes of the line at an offset, including its newline."""
+  chunks = []
+  while True:
+    chunk = os.pread(fd, 4096, offset)
+    if not chunk:
+      break
+    i = chunk.find(b'\n')
+    if i != -1:
+      chunks.append(chunk[:i + 1])
+      break
+    chunks.append(chunk)
+    offset += len(chunk)
+  return b''.join(chunks)
+
+
 class Arena(object):
   """A collection of lines and line spans.
 
@@ -25,23 +49,47 @@ class Arena(object):
       penalize big comment blocks in .rc files and completion files!
 
   """
-  def __init__(self, arena_id):
+  def __init__(self, arena_id, retain_file_lines=True):
+    """
+    Args:
+      arena_id: an integer stored in tokens
+      retain_file_lines: if False, don't store the text of lines that came
+        from a file on disk.  GetLine() reads them again when needed.
+    """
     self.arena_id = arena_id  # an integer stored in tokens
+    self.retain_file_lines = retain_file_lines
 
     # Could be std::vector<char *> pointing into a std::string.
     # NOTE: lines are required for bootstrapping code within the binary, and
     # also required for interactive or stdin, but optional when code is on
     # disk.  We can go look it up later to save memory.
-    self.lines = []
+    self.lines = []  # None for lines that weren't retained
+    # Byte offset of each line in its source file, or -1 if it's not from a
+    # file we can read again.
+    self.line_offsets = array.array('q')
     self.next_line_id = 0
 
-    self.spans = []
+    # There's one span per token, so they're stored as parallel int columns
+    # rather than ast.line_span objects.  GetLineSpan() creates those on
+    # demand.
+    self.span_line_ids = array.array('i')
+    self.span_cols = array.array('i')
+    self.span_lengths = array.array('i')
     self.next_span_id = 0
 
-    self.debug_info = []  # list of (src_path index, physical line number)
+    # Debug info for each line: src_paths index and physical line number.
+    self.line_src_indices = array.array('i')
+    self.line_nums = array.array('i')
+
     self.src_paths = []  # list of source paths
+    # For each source path: (size, mtime in ns) if it's a file on disk, or
+    # None.  Used to check that a file hasn't changed before reading it again.
+    self.src_stats = []
     self.src_index = -1  # index of current source file
 
+    # The file we last read lines from again: (src_index, descriptor)
+    self.reload_cache = None
+
   def IsComplete(self):
     """Return whether we have a full set of lines -- none of which was cleared.
 
@@ -51,17 +99,42 @@ class Arena(object):
   def AddSourcePath(self, src_path):
     # TODO: Should this be part of the pool?
     self.src_paths.append(src_path)
-    self.src_index += 1
+    self.src_stats.append(None)
+    self.src_index = len(self.src_paths) - 1
+
+  def AddSourceFile(self, path, size, mtime_ns):
+    """Like AddSourcePath, for a regular file whose lines can be read again."""
+    self.src_paths.append(path)
+    self.src_stats.append((size, mtime_ns))
+    self.src_index = len(self.src_paths) - 1
+
+  def SourceIndex(self):
+    """Return the current source file, so it can be restored after a nested
+    one is read, e.g. by the source builtin."""
+    return self.src_index
 
-  def AddLine(self, line, line_num):
+  def RestoreSourceIndex(self, src_index):
+    """Make later lines belong to a source file added earlier."""
+    self.src_index = src_index
+
+  def AddLine(self, line, line_num, offset=-1):
     """
-    TODO: Add an option of whether to save the line?  You can retrieve it on
-    disk in many cases.
+    Args:
+      line: the line, used by the lexer
+      line_num: physical line number, for error messages
+      offset: byte offset in the current source file, or -1 if it's not from
+        a file.  If given, and we're not retaining file lines, the text isn't
+        stored.
     """
     line_id = self.next_line_id
-    self.lines.append(line)
+    if offset != -1 and not self.retain_file_lines:
+      self.lines.append(None)
+    else:
+      self.lines.append(line)
+    self.line_offsets.append(offset)
     self.next_line_id += 1
-    self.debug_info.append((self.src_index, line_num))
+    self.line_src_indices.append(self.src_index)
+    self.line_nums.append(line_num)
     return line_id
 
   def ClearLastLine(self):
@@ -74,26 +147,192 @@ class Arena(object):
     line contents.
     """
     assert line_id >= 0, line_id
-    return self.lines[line_id]
-
-  def AddLineSpan(self, line_span):
+    line = self.lines[line_id]
+    if line is None and self.line_offsets[line_id] != -1:
+      line = self._ReloadLine(line_id)
+    return line
+
+  def _ReloadLine(self, line_id):
+    """Read a line that we didn't retain from its file."""
+    src_index = self.line_src_indices[line_id]
+    path = self.src_paths[src_index]
+
+    if self.reload_cache and self.reload_cache[0] != src_index:
+      os.close(self.reload_cache[1])
+      self.reload_cache = None
+    try:
+      if self.reload_cache:
+        fd = self.reload_cache[1]
+      else:
+        fd = os.open(path, os.O_RDONLY)
+        # Only one descriptor is kept, not one for every file.
+        self.reload_cache = (src_index, fd)
+
+      # Check on every read, since the file can change between reads.  We
+      # pread() instead of keeping an mmap, which raises SIGBUS if the file
+      # is truncated.
+      st = os.fstat(fd)
+      if (st.st_size, st.st_mtime_ns) != self.src_stats[src_index]:
+        os.close(fd)
+        self.reload_cache = None
+        return '<%s changed on disk>\n' % path
+      line_bytes = _ReadLineAt(fd, self.line_offsets[line_id])
+    except OSError as e:
+      return '<%s: %s>\n' % (path, e)
+
+    line, _ = reader.DecodeLineAt(line_bytes, 0)
+    return line
+
+  def AddLineSpan(self, line_id, col, length):
     """
     TODO: Add an option of whether to save the line?  You can retrieve it on
     disk in many cases.
     """
     span_id = self.next_span_id
-    self.spans.append(line_span)
+    self.span_line_ids.append(line_id)
+    self.span_cols.append(col)
+    self.span_lengths.append(length)
     self.next_span_id += 1
     return span_id
 
   def GetLineSpan(self, span_id):
+    """Return an ast.line_span, e.g. for error messages."""
     assert span_id >= 0, span_id
-    return self.spans[span_id]
+    return ast.line_span(
+        self.span_line_ids[span_id], self.span_cols[span_id],
+        self.span_lengths[span_id])
+
+  def NumSpans(self):
+    return self.next_span_id
+
+  def Mark(self):
+    """Return a mark that PopToMark() can later free everything after.
+
+    This is like setstackmark() in dash.
+    """
+    return self.next_line_id, self.next_span_id
+
+  def PopToMark(self, mark):
+    """Free all lines and spans added since Mark() was called.
+
+    Their IDs will be reused, so nothing may refer to them anymore.  The
+    batch loop calls this after executing a top-level command that doesn't
+    define functions.
+    """
+    line_id, span_id = mark
+    del self.lines[line_id:]
+    del self.line_offsets[line_id:]
+    del self.line_src_indices[line_id:]
+    del self.line_nums[line_id:]
+    self.next_line_id = line_id
+
+    del self.span_line_ids[span_id:]
+    del self.span_cols[span_id:]
+    del self.span_lengths[span_id:]
+    self.next_span_id = span_id
+
+  def Compact(self, mark, nodes):
+    """Free lines and spans added since Mark(), except those nodes refer to.
+
+    The spans that are kept are renumbered to follow the mark, in order, and
+    so are their lines.  The span IDs in the nodes are rewritten in place.
+
+    This is used after executing a command that defined functions: only the
+    function bodies have to stay in memory.
+    """
+    line_mark, span_mark = mark
+
+    objs = _UniqueObjs(nodes)
+
+    # Find the spans to keep, which determine the lines to keep.
+    kept_spans = set()
+    for obj in objs:
+      span_id = getattr(obj, 'span_id', None)
+      if span_id is not None and span_id >= span_mark:
+        kept_spans.add(span_id)
+      for span_id in getattr(obj, 'spids', ()):
+        if span_id >= span_mark:
+          kept_spans.add(span_id)
+    kept_spans = sorted(kept_spans)
+    kept_lines = sorted(set(
+        self.span_line_ids[span_id] for span_id in kept_spans
+        if self.span_line_ids[span_id] >= line_mark))
+
+    span_map = {old: span_mark + i for i, old in enumerate(kept_spans)}
+    line_map = {old: line_mark + i for i, old in enumerate(kept_lines)}
+
+    # Copy the kept entries down.  IDs only decrease, so this is done in
+    # place.
+    for old in kept_lines:
+      new = line_map[old]
+      self.lines[new] = self.lines[old]
+      self.line_offsets[new] = self.line_offsets[old]
+      self.line_src_indices[new] = self.line_src_indices[old]
+      self.line_nums[new] = self.line_nums[old]
+
+    for old in kept_spans:
+      new = span_map[old]
+      line_id = self.span_line_ids[old]
+      self.span_line_ids[new] = line_map.get(line_id, line_id)
+      self.span_cols[new] = self.span_cols[old]
+      self.span_lengths[new] = self.span_lengths[old]
+
+    self.PopToMark(
+        (line_mark + len(kept_lines), span_mark + len(kept_spans)))
+
+    for obj in objs:
+      span_id = getattr(obj, 'span_id', None)
+      if span_id is not None and span_id >= span_mark:
+        obj.span_id = span_map[span_id]
+      spids = getattr(obj, 'spids', None)
+      if spids:
+        obj.spids = [span_map.get(span_id, span_id) for span_id in spids]
+
+  def GetSpans(self, mark):
+    """Return the lines and spans added since Mark(), e.g. for the parse cache.
+
+    Returns:
+      (line_nums, line_offsets, span_line_ids, span_cols, span_lengths)
+      arrays.  The line IDs are relative to the mark.
+    """
+    line_mark, span_mark = mark
+    span_line_ids = array.array(
+        'i', (line_id - line_mark for line_id in self.span_line_ids[span_mark:]))
+    return (self.line_nums[line_mark:], self.line_offsets[line_mark:],
+            span_line_ids, self.span_cols[span_mark:],
+            self.span_lengths[span_mark:])
+
+  def AddSpans(self, line_nums, line_offsets, span_line_ids, span_cols,
+               span_lengths):
+    """Add lines and spans returned by GetSpans() for the current source file.
+
+    The text of the lines isn't stored; GetLine() reads it from the file.
+
+    Returns:
+      The ID of the first span added.
+    """
+    line_base = self.next_line_id
+    span_base = self.next_span_id
+    n = len(line_nums)
+
+    self.lines.extend([None] * n)
+    self.line_offsets.extend(line_offsets)
+    self.line_src_indices.extend(array.array('i', [self.src_index]) * n)
+    self.line_nums.extend(line_nums)
+    self.next_line_id += n
+
+    self.span_line_ids.extend(
+        array.array('i', (line_base + line_id for line_id in span_line_ids)))
+    self.span_cols.extend(span_cols)
+    self.span_lengths.extend(span_lengths)
+    self.next_span_id += len(span_cols)
+    return span_base
 
   def GetDebugInfo(self, line_id):
     """Get the path and physical line number, for parse errors."""
     assert line_id >= 0
-    src_index, line_num = self.debug_info[line_id]
+    src_index = self.line_src_indices[line_id]
+    line_num = self.line_nums[line_id]
     try:
       path = self.src_paths[src_index]
     except IndexError:
@@ -102,6 +341,41 @@ class Arena(object):
     return path, line_num
 
 
+def _UniqueObjs(nodes):
+  """Return every ASDL object in the trees, each one once."""
+  objs = []
+  seen = set()
+  stack = list(nodes)
+  while stack:
+    obj = stack.pop()
+    if id(obj) in seen:
+      continue
+    seen.add(id(obj))
+    objs.append(obj)
+    for name in obj.FIELDS:
+      val = getattr(obj, name, None)  # may be unassigned
+      if isinstance(val, py_meta.CompoundObj):
+        stack.append(val)
+      elif isinstance(val, list):
+        stack.extend(v for v in val if isinstance(v, py_meta.CompoundObj))
+  return objs
+
+
+def ShiftSpanIds(nodes, delta):
+  """Add delta to every span ID in the trees, e.g. after Arena.AddSpans().
+
+  Missing span IDs (-1 or None) are left alone.
+  """
+  for obj in _UniqueObjs(nodes):
+    span_id = getattr(obj, 'span_id', None)
+    if span_id is not None and span_id != -1:
+      obj.span_id = span_id + delta
+    spids = getattr(obj, 'spids', None)
+    if spids:
+      obj.spids = [
+          span_id if span_id == -1 else span_id + delta for span_id in spids]
+
+
 # In C++, InteractiveLineReader and StringLineReader should use the same
 # representation: std::string with internal NULs to terminate lines, and then
 # std::vector<char*> that points into to it.
@@ -129,9 +403,14 @@ class Pool(object):
     We also want to clean up in embedded mode.  the oil_Init() and
     oil_Destroy() methods of the API should do this.
   """
-  def __init__(self):
+  def __init__(self, retain_file_lines=True):
+    """
+    Args:
+      retain_file_lines: policy for new arenas; see Arena.
+    """
     self.arenas = []
     self.next_arena_id = 0
+    self.retain_file_lines = retain_file_lines
 
   # NOTE: dash uses a similar scheme.  stalloc() / setstackmark() /
   # popstackmark() in memalloc.c.
@@ -140,7 +419,7 @@ class Pool(object):
   # only destroy the top/last arena.
   def NewArena(self):
     """Call this after parsing anything that you might want to destroy."""
-    a = Arena(self.next_arena_id)
+    a = Arena(self.next_arena_id, retain_file_lines=self.retain_file_lines)
     self.next_arena_id += 1
     self.arenas.append(a)
     return a
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+alloc_test.py: Tests for alloc.py
+"""
+
+import unittest
+
+from core import alloc  # module under test
+from core import reader
+
+from osh import ast_ as ast
+from osh import cmd_parse
+from osh import parse_lib
+
+
+def _Tokens(node, tokens):
+  """Collect the tokens in a tree."""
+  if isinstance(node, ast.token):
+    tokens.append(node)
+    return
+  for name in node.FIELDS:
+    val = getattr(node, name, None)
+    if isinstance(val, list):
+      for v in val:
+        if hasattr(v, 'FIELDS'):
+          _Tokens(v, tokens)
+    elif hasattr(val, 'FIELDS'):
+      _Tokens(val, tokens)
+
+
+class ArenaTest(unittest.TestCase):
+
+  def _Parse(self, arena, code_str):
+    arena.AddSourcePath('<test>')
+    line_reader = reader.StringLineReader(code_str, arena=arena)
+    _, c_parser = parse_lib.MakeParserForTop(line_reader, arena=arena)
+    return c_parser.ParseWholeFile()
+
+  def testPopToMark(self):
+    arena = alloc.Pool().NewArena()
+    self._Parse(arena, 'echo 1\n')
+    mark = arena.Mark()
+    self._Parse(arena, 'echo 2\necho 3\n')
+    arena.PopToMark(mark)
+    self.assertEqual(mark, arena.Mark())
+    self.assertEqual(mark[0], len(arena.lines))
+
+  def testCompact(self):
+    arena = alloc.Pool().NewArena()
+    self._Parse(arena, 'echo first\n')
+    mark = arena.Mark()
+
+    node = self._Parse(arena, '''\
+echo 1
+f() {
+  echo 2
+}
+echo 3; g() { echo "$@"; }
+''')
+    func_defs = cmd_parse.FindFuncDefs(node)
+    self.assertEqual(2, len(func_defs))
+    num_spans = arena.NumSpans()
+
+    arena.Compact(mark, func_defs)
+    self.assertLess(arena.NumSpans(), num_spans)
+    # Only lines with tokens in the function bodies remain.  (The closing
+    # brace of f isn't in the tree.)
+    self.assertEqual(
+        ['f() {\n', '  echo 2\n', 'echo 3; g() { echo "$@"; }\n'],
+        arena.lines[mark[0]:])
+
+    # Every token still points at its own text.
+    tokens = []
+    for func_def in func_defs:
+      _Tokens(func_def, tokens)
+    self.assertTrue(tokens)
+    for tok in tokens:
+      span = arena.GetLineSpan(tok.span_id)
+      self.assertEqual(tok.val, alloc.SpanValue(span, arena))
+
+    # Spans are dense after the mark, so more can be added.
+    self.assertEqual(arena.NumSpans(), len(arena.span_cols))
+    self._Parse(arena, 'echo 4\n')
+
+  def testCompactNothing(self):
+    arena = alloc.Pool().NewArena()
+    mark = arena.Mark()
+    self._Parse(arena, 'echo 1\n')
+    arena.Compact(mark, [])
+    self.assertEqual(mark, arena.Mark())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -104,32 +104,15 @@ import sys
 
 from core import util
 
-# NOTE: NONE is a special value.
-# TODO:
-# - Make a table of name to enum?  source, dot, etc.
-# - So you can just add "complete" and have it work.
+# NOTE: NONE is a special value.  BUILTINS below maps names to these.
 
 EBuiltin = util.Enum('EBuiltin', """
 NONE READ ECHO CD PUSHD POPD
-EXIT SOURCE DOT TRAP EVAL EXEC SET COMPLETE COMPGEN DEBUG_LINE
+EXIT SOURCE DOT TRAP EVAL EXEC SET COMPLETE COMPGEN DEBUG_LINE EXPORT
+HASH TYPE COMMAND JOBS WAIT SHOPT
 """.split())
 
 
-# These can't be redefined by functions.
-# http://pubs.opengroup.org/onlinepubs/9699919799/utilities/V3_chap02.html#tag_18_14
-# On the other hand, 'cd' CAN be redefined.
-# TODO:
-# - use these
-SPECIAL_BUILTINS = [
-    'break', ':', 'continue', '.', 'eval', 'exec', 'exit', 'export',
-    'readonly', 'return', 'set', 'shift', 'times', 'trap', 'unset',
-
-    # local and declare are not POSIX, but should be here since export and
-    # readonly are.
-    'local', 'declare',
-]
-
-
 # Should we use python3 argparse?  It has stuff like nargs.
 # choices, def
 # But it doesn't handle '+' probably.
@@ -194,7 +177,7 @@ class BuiltinDef(object):
   """Metadata for the builtin.  Not necessarily the implementation.
 
   Used for code gen."""
-  def __init__(self, name, arg_spec, special=False):
+  def __init__(self, name, arg_spec, builtin_id=EBuiltin.NONE, special=False):
     """
     Args:
       names: name to register
@@ -204,10 +187,15 @@ class BuiltinDef(object):
         Need to document usage line, and also exit status.
         Bash has a man page thing, but we don't need that.
 
-      special: Whether it's a special builtin.
+      builtin_id: EBuiltin the executor dispatches on, or NONE if it's not
+        implemented as a builtin (e.g. local is parsed as an assignment).
+      special: Whether it's a special builtin.  They're resolved before
+        functions.
     """
     self.name = name
     self.arg_spec = arg_spec
+    self.builtin_id = builtin_id
+    self.special = special
 
 
 NO_ARGS = ArgSpec("", "", "", [])
@@ -222,10 +210,15 @@ DECLARE_LOCAL_ARGS = ArgSpec("", "", "", [])
 # declare can be dynamic -- code='FOO=xx'; declare $code works.
 # Maybe only local and global, and declare is thed ynamic version
 
+# Special builtins can't be redefined by functions.  They're marked with
+# special=True.
+# http://pubs.opengroup.org/onlinepubs/9699919799/utilities/V3_chap02.html#tag_18_14
+# On the other hand, 'cd' CAN be redefined.
 BUILTINS = [
-    # local has options as 'declare'.
-    BuiltinDef("declare", DECLARE_LOCAL_ARGS),
-    BuiltinDef("local", DECLARE_LOCAL_ARGS),
+    # local and declare are not POSIX, but they're special since export and
+    # readonly are.  local has options as 'declare'.
+    BuiltinDef("declare", DECLARE_LOCAL_ARGS, special=True),
+    BuiltinDef("local", DECLARE_LOCAL_ARGS, special=True),
 
     BuiltinDef("readonly",
       ArgSpec(
@@ -243,35 +236,58 @@ BUILTINS = [
         """Exit Status: Returns success unless an invalid flag or NAME is
         given.
         """,
-        [])
-      ),
-    BuiltinDef("export", ArgSpec("", "", "", [])),
+        []),
+      special=True),
+    BuiltinDef("export", ArgSpec("", "", "", []), EBuiltin.EXPORT,
+               special=True),
 
-    BuiltinDef("read", NO_ARGS),
-    BuiltinDef("echo", NO_ARGS),
+    BuiltinDef("read", NO_ARGS, EBuiltin.READ),
+    BuiltinDef("echo", NO_ARGS, EBuiltin.ECHO),
 
-    BuiltinDef("cd", NO_ARGS),
-    BuiltinDef("pushd", NO_ARGS),
-    BuiltinDef("popd", NO_ARGS),
+    BuiltinDef("cd", NO_ARGS, EBuiltin.CD),
+    BuiltinDef("pushd", NO_ARGS, EBuiltin.PUSHD),
+    BuiltinDef("popd", NO_ARGS, EBuiltin.POPD),
 
-    BuiltinDef("exit", NO_ARGS),
+    BuiltinDef("exit", NO_ARGS, EBuiltin.EXIT, special=True),
 
     # These are aliases
-    BuiltinDef("source", NO_ARGS),
-    BuiltinDef(".", NO_ARGS),
+    BuiltinDef("source", NO_ARGS, EBuiltin.SOURCE),
+    BuiltinDef(".", NO_ARGS, EBuiltin.DOT, special=True),
 
-    BuiltinDef("trap", NO_ARGS),
-    BuiltinDef("eval", NO_ARGS),
-    BuiltinDef("exec", NO_ARGS),
+    BuiltinDef("trap", NO_ARGS, EBuiltin.TRAP, special=True),
+    BuiltinDef("eval", NO_ARGS, EBuiltin.EVAL, special=True),
+    BuiltinDef("exec", NO_ARGS, EBuiltin.EXEC, special=True),
 
-    BuiltinDef("set", NO_ARGS),
-    BuiltinDef("complete", NO_ARGS),
+    BuiltinDef("set", NO_ARGS, EBuiltin.SET, special=True),
+    BuiltinDef("shopt", NO_ARGS, EBuiltin.SHOPT),
 
-    # TODO: compgen should instead be a config file?
+    BuiltinDef("hash", NO_ARGS, EBuiltin.HASH),
+    BuiltinDef("type", NO_ARGS, EBuiltin.TYPE),
+    BuiltinDef("command", NO_ARGS, EBuiltin.COMMAND),
+
+    BuiltinDef("jobs", NO_ARGS, EBuiltin.JOBS),
+    BuiltinDef("wait", NO_ARGS, EBuiltin.WAIT),
+
+    BuiltinDef("complete", NO_ARGS, EBuiltin.COMPLETE),
+
+    # TODO: compgen should instead be a config file?  Not implemented yet, so
+    # it has no EBuiltin.
     BuiltinDef("compgen", NO_ARGS),
-    BuiltinDef("debug-line", NO_ARGS),
+    BuiltinDef("debug-line", NO_ARGS, EBuiltin.DEBUG_LINE),
+
+    # Special builtins that aren't implemented here.  break, continue and
+    # return are parsed as control flow.
+    BuiltinDef("break", NO_ARGS, special=True),
+    BuiltinDef(":", NO_ARGS, special=True),
+    BuiltinDef("continue", NO_ARGS, special=True),
+    BuiltinDef("return", NO_ARGS, special=True),
+    BuiltinDef("shift", NO_ARGS, special=True),
+    BuiltinDef("times", NO_ARGS, special=True),
+    BuiltinDef("unset", NO_ARGS, special=True),
 ]
 
+SPECIAL_BUILTINS = [b.name for b in BUILTINS if b.special]
+
 
 def HelpBuiltin():
   for b_def in BUILTINS:
@@ -293,68 +309,35 @@ class Builtins(object):
     # Is this what we want?
     names = set()
     names.update(b.name for b in BUILTINS)
-    names.update(SPECIAL_BUILTINS)
     # TODO: Also complete keywords first for, while, etc.  Bash/zsh/fish/yash
     # all do this.  Also do/done
 
     self.to_complete = sorted(names)
 
+    # name -> BuiltinDef, for the ones the executor implements.
+    self.by_name = {
+        b.name: b for b in BUILTINS if b.builtin_id != EBuiltin.NONE}
+
   def DebugLine(self, argv):
     # TODO: Maybe add a position flag?  Like debug-line -n 1 'foo'
     # And enforce that you get a single arg?
     self.status_line.Write('DEBUG: %s', ' '.join(argv[1:]))
+    return 0
 
   def GetNamesToComplete(self):
     """For completion of builtin names."""
     return self.to_complete
 
-  def Resolve(self, argv0):
-    # TODO: ResolveSpecialBuiltin first, then ResolveFunction, then
-    # ResolveOtherBuiltin.  In other words, you can't redefine special builtins
-    # with functions, but you can redefine other builtins.
-
-    # For completion, this is a flat list of names.  Although coloring them
-    # would be nice.
-
-    # TODO: Use BuiltinDef instances in BUILTINS to initialize.
-
-    if argv0 == "read":
-      return EBuiltin.READ
-    elif argv0 == "echo":
-      return EBuiltin.ECHO
-    elif argv0 == "cd":
-      return EBuiltin.CD
-    elif argv0 == "pushd":
-      return EBuiltin.PUSHD
-    elif argv0 == "popd":
-      return EBuiltin.POPD
-
-    elif argv0 == "exit":
-      return EBuiltin.EXIT
-
-    elif argv0 == "source":
-      return EBuiltin.SOURCE
-    elif argv0 == ".":
-      return EBuiltin.DOT
-
-    elif argv0 == "trap":
-      return EBuiltin.TRAP
-    elif argv0 == "eval":
-      return EBuiltin.EVAL
-    elif argv0 == "exec":
-      return EBuiltin.EXEC
-
-    elif argv0 == "set":
-      return EBuiltin.SET
-    elif argv0 == "complete":
-      return EBuiltin.COMPLETE
-    elif argv0 == "compgen":
-      return EBuiltin.COMPGEN
-
-    elif argv0 == "debug-line":
-      return EBuiltin.DEBUG_LINE
-
-    return EBuiltin.NONE
+  def Lookup(self, argv0):
+    """Find an implemented builtin by name.
+
+    This is called for every simple command, so it's one dict lookup.  The
+    caller checks b.special to decide whether it's resolved before functions.
+
+    Returns:
+      BuiltinDef, or None
+    """
+    return self.by_name.get(argv0)
 
 
 def main(argv):
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+builtin_test.py: Tests for builtin.py
+"""
+
+import unittest
+
+from core import builtin  # module under test
+from core.builtin import EBuiltin
+from core import ui
+
+
+class BuiltinsTest(unittest.TestCase):
+
+  def testLookup(self):
+    b = builtin.Builtins(ui.NullStatusLine())
+
+    b_def = b.Lookup('echo')
+    self.assertEqual(EBuiltin.ECHO, b_def.builtin_id)
+    self.assertEqual(False, b_def.special)
+
+    b_def = b.Lookup('.')
+    self.assertEqual(EBuiltin.DOT, b_def.builtin_id)
+    self.assertEqual(True, b_def.special)
+
+    self.assertEqual(EBuiltin.SOURCE, b.Lookup('source').builtin_id)
+
+    # Not implemented as builtins.
+    self.assertEqual(None, b.Lookup('local'))
+    self.assertEqual(None, b.Lookup('compgen'))
+    self.assertEqual(None, b.Lookup('ls'))
+
+  def testNamesToComplete(self):
+    b = builtin.Builtins(ui.NullStatusLine())
+    names = b.GetNamesToComplete()
+    self.assertTrue('compgen' in names)
+    self.assertTrue('break' in names)  # a special builtin
+
+  def testSpecialBuiltins(self):
+    self.assertEqual(
+        ['declare', 'local', 'readonly', 'export', 'exit', '.', 'trap', 'eval',
+         'exec', 'set', 'break', ':', 'continue', 'return', 'shift', 'times',
+         'unset'],
+        builtin.SPECIAL_BUILTINS)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -59,10 +59,13 @@ This just does head?  Last one wins.
 import os
 import stat
 import sys
+import tempfile
 
-from core import braces
+from core import compile
 from core import completion
 from core import expr_eval
+from core import reader
+from core import ui
 from core import word_eval
 from core import util
 
@@ -71,7 +74,9 @@ from core.id_kind import Id, RedirType, REDIR_TYPE
 from core.process import (
     FdState, Pipeline, Process,
     HereDocRedirect, DescriptorRedirect, FilenameRedirect,
-    FuncThunk, ExternalThunk, SubProgramThunk, BuiltinThunk)
+    FuncThunk, ExternalThunk, SubProgramThunk, BuiltinThunk,
+    CommandNotFoundThunk, JOB_STATE)
+from core import ovm
 from core import runtime
 try:
   from core import libc  # for fnmatch
@@ -79,8 +84,11 @@ except ImportError:
   from core import fake_libc as libc
 
 from osh import ast_ as ast
+from osh import cmd_parse
+from osh import parse_lib
 
-command_e = ast.command_e
+command_e = ovm.command_e
+args_e = ovm.args_e
 part_value_e = runtime.part_value_e
 value_e = runtime.value_e
 log = util.log
@@ -95,6 +103,12 @@ class ExecOpts(object):
     self.pipefail = False
     self.noglob = False  # -f
     self.bash_array = True
+    # shopt -s lastpipe: the last stage of a pipeline runs in this process.
+    self.lastpipe = False
+
+
+# Flags stored with each variable in Mem.
+EXPORTED = 1 << 0
 
 
 class Mem(object):
@@ -103,15 +117,35 @@ class Mem(object):
   Mem is better than "Env" -- Env implies OS stuff.
   """
 
-  def __init__(self, argv0, argv):
+  def __init__(self, argv0, argv, environ=None):
+    """
+    Args:
+      environ: dict of environment variables, os.environ by default
+    """
     self.top = {}  # string -> (flags, runtime.value)
     self.var_stack = [self.top]
+    # Name -> the innermost scope in var_stack that binds it, so Get() doesn't
+    # walk the stack.  Push() doesn't change it, and Pop() fixes up the names
+    # that were local to the popped scope.
+    self.visible = {}
+    # Exported variables for external commands, or None if an exported
+    # variable changed since it was computed.  See GetExported().
+    self.exported = None
     self.argv0 = argv0
     self.argv_stack = [argv]
     self.last_status = 0  # Mutable public variable
+    self.last_job_pid = None  # For $!
 
+    self._ImportEnviron(os.environ if environ is None else environ)
     self._InitDefaults()
 
+  def _ImportEnviron(self, environ):
+    """Import the environment once, instead of calling getenv() on misses."""
+    g = self.var_stack[0]
+    for name, s in environ.items():
+      g[name] = EXPORTED, runtime.Str(s)
+      self.visible[name] = g
+
   def _InitDefaults(self):
     # Default value; user may unset it.
     # $ echo -n "$IFS" | python -c 'import sys;print repr(sys.stdin.read())'
@@ -125,8 +159,72 @@ class Mem(object):
     self.argv_stack.append(argv)
 
   def Pop(self):
-    self.var_stack.pop()
+    popped = self.var_stack.pop()
     self.argv_stack.pop()
+    self.top = self.var_stack[-1]
+
+    # Names bound in the popped scope may now be visible in an outer one.
+    visible = self.visible
+    for name, (flags, _) in popped.items():
+      for scope in reversed(self.var_stack):
+        if name in scope:
+          visible[name] = scope
+          flags |= scope[name][0]
+          break
+      else:
+        del visible[name]
+      if flags & EXPORTED:
+        self.exported = None
+
+  def SetTemp(self, env):
+    """Bind exported variables for a builtin or function, e.g. FOO=x myfunc.
+
+    Returns:
+      What RestoreTemp() needs to undo it.
+    """
+    scope = self.top
+    saved = []
+    for name, s in env.items():
+      saved.append((name, scope.get(name), self.visible.get(name)))
+      scope[name] = EXPORTED, runtime.Str(s)
+      self.visible[name] = scope
+    self.exported = None
+    return scope, saved
+
+  def RestoreTemp(self, temp):
+    """Put back the bindings that SetTemp() replaced."""
+    scope, saved = temp
+    for name, binding, visible_scope in reversed(saved):
+      if binding is None:
+        scope.pop(name, None)
+      else:
+        scope[name] = binding
+      if visible_scope is None:
+        self.visible.pop(name, None)
+      else:
+        self.visible[name] = visible_scope
+    self.exported = None
+
+  def Snapshot(self):
+    """Save the variables, e.g. before a command sub runs in this process."""
+    scopes = [(scope, dict(scope)) for scope in self.var_stack]
+    return (scopes, dict(self.visible), list(self.argv_stack), self.exported,
+            self.last_status, self.last_job_pid)
+
+  def Restore(self, snapshot):
+    """Undo all changes since Snapshot()."""
+    scopes, visible, argv_stack, exported, last_status, last_job_pid = snapshot
+    # Restore the scopes in place, since self.visible refers to them.
+    for scope, saved in scopes:
+      scope.clear()
+      scope.update(saved)
+    self.var_stack = [scope for scope, _ in scopes]
+    self.top = self.var_stack[-1]
+    self.visible = visible
+    self.argv_stack = argv_stack
+    self.exported = exported
+    self.last_status = last_status
+    self.last_job_pid = last_job_pid
 
   def GetArgv0(self):
     """For $0."""
@@ -167,19 +265,14 @@ class Mem(object):
 
   def Get(self, name):
     # TODO: Don't implement dynamic scope
-    for i in range(len(self.var_stack) - 1, -1, -1):
-      scope = self.var_stack[i]
-      if name in scope:
-        # Don't need to use flags
-        _, value = scope[name]
-        return value
+    scope = self.visible.get(name)
+    if scope is None:
+      # The environment was imported into the global scope.
+      return runtime.Undef()
 
-    # Fall back on environment
-    v = os.getenv(name)
-    if v is not None:
-      return runtime.Str(v)
-
-    return runtime.Undef()
+    # Don't need to use flags
+    _, value = scope[name]
+    return value
 
   def SetGlobal(self, pairs, flags):
     """For completion."""
@@ -189,7 +282,11 @@ class Mem(object):
       assert value.tag in (value_e.Str, value_e.StrArray)
 
       # Assuming LeftVar for now.
-      g[lhs.name] = flags, value
+      name = lhs.name
+      old = g.get(name)
+      g[name] = self._InheritFlags(old, flags), value
+      if name not in self.visible:  # Don't unshadow a local.
+        self.visible[name] = g
 
   def SetLocal(self, pairs, flags):
     # TODO: respect flags
@@ -212,11 +309,61 @@ class Mem(object):
     for lhs, value in pairs:
       assert value.tag in (value_e.Str, value_e.StrArray)
       # Assuming LeftVar for now.
-      self.top[lhs.name] = flags, value
+      name = lhs.name
+      self.top[name] = self._InheritFlags(self._GetBinding(name), flags), value
+      self.visible[name] = self.top
 
   def SetSimpleVar(self, name, value):
     """Set a simple variable (not an array)."""
-    self.top[name] = 0, value
+    self.top[name] = self._InheritFlags(self._GetBinding(name), 0), value
+    self.visible[name] = self.top
+
+  def _GetBinding(self, name):
+    scope = self.visible.get(name)
+    return None if scope is None else scope[name]
+
+  def _InheritFlags(self, old, flags):
+    """Assigning to an exported variable keeps it exported, like bash.
+
+    Also a local that shadows an exported variable is exported.
+
+    Args:
+      old: the (flags, value) binding being replaced or shadowed, or None
+    """
+    if old is not None:
+      flags |= old[0] & EXPORTED
+    if flags & EXPORTED:
+      self.exported = None  # recompute
+    return flags
+
+  def SetExported(self, name, exported):
+    """For export and export -n.  Changes the flag on the visible binding."""
+    scope = self.visible.get(name)
+    if scope is None:
+      # TODO: bash remembers the flag until the variable is assigned.
+      return
+    flags, value = scope[name]
+    if exported:
+      flags |= EXPORTED
+    else:
+      flags &= ~EXPORTED
+    scope[name] = flags, value
+    self.exported = None
+
+  def GetExported(self):
+    """Return a dict of exported variables, for external commands.
+
+    It's cached until an exported variable changes, so launching a command
+    doesn't copy the environment.  The caller must not modify it.
+    """
+    if self.exported is None:
+      env = {}
+      for name, scope in self.visible.items():
+        flags, value = scope[name]
+        if flags & EXPORTED and value.tag == value_e.Str:
+          env[name] = value.s
+      self.exported = env
+    return self.exported
 
   # Are special vars here?  # like $? and $0 ?
   # IFS, PWD, etc.
@@ -250,6 +397,69 @@ class DirStack:
     return 0
 
 
+class CommandHash(object):
+  """Command name -> absolute path, like bash's hash table.
+
+  External commands are looked up in the parent, so the child can execve()
+  the path directly, and a missing command doesn't need a fork.
+  """
+
+  def __init__(self, mem):
+    self.mem = mem
+    self.table = {}
+    # The $PATH value the table was made with.  Assigning to PATH makes a new
+    # runtime.Str, which invalidates the table.
+    self.path_val = None
+
+  def _CheckPath(self):
+    val = self.mem.Get('PATH')
+    if val.tag != value_e.Str:
+      val = None  # unset or array: use the default path
+    if val is not self.path_val:
+      self.table.clear()
+      self.path_val = val
+
+  def _Search(self, name):
+    """
+    Returns:
+      (path or None, whether the result can be cached)
+    """
+    path_str = self.path_val.s if self.path_val is not None else os.defpath
+    for d in path_str.split(':'):
+      full_path = os.path.join(d or '.', name)
+      if os.path.isfile(full_path) and os.access(full_path, os.X_OK):
+        # Relative entries like . depend on the current directory.
+        return full_path, os.path.isabs(full_path)
+    return None, False
+
+  def Lookup(self, name):
+    """
+    Returns:
+      The path to execute, or None if it's not found.
+    """
+    if '/' in name:
+      return name  # not searched or hashed
+    self._CheckPath()
+    full_path = self.table.get(name)
+    if full_path is None:
+      full_path, cacheable = self._Search(name)
+      if cacheable:
+        self.table[name] = full_path
+    return full_path
+
+  def IsHashed(self, name):
+    self._CheckPath()
+    return name in self.table
+
+  def Clear(self):
+    """For hash -r."""
+    self.table.clear()
+
+  def Items(self):
+    self._CheckPath()
+    return sorted(self.table.items())
+
+
 class _FatalError(RuntimeError):
   """Internal exception for fatal errors."""
   pass
@@ -283,6 +493,36 @@ class _ControlFlow(RuntimeError):
     return self.arg
 
 
+def _ReadLine(fd):
+  """Read a line from a descriptor, without reading past the newline.
+
+  Unlike sys.stdin.readline(), nothing is left in a buffer, so the next
+  command sees the rest of the input.  This matters when fd 0 is redirected
+  in this process, e.g. with lastpipe.
+
+  Returns:
+    The line including the newline, or '' at EOF.
+  """
+  try:
+    start = os.lseek(fd, 0, os.SEEK_CUR)
+  except OSError:  # a pipe or terminal: read one byte at a time, like shells
+    start = None
+
+  chunks = []
+  while True:
+    byte_str = os.read(fd, 1 if start is None else 4096)
+    if not byte_str:
+      break
+    i = byte_str.find(b'\n')
+    if i != -1:
+      chunks.append(byte_str[:i+1])
+      if start is not None:  # seek back to just after the newline
+        os.lseek(fd, i + 1 - len(byte_str), os.SEEK_CUR)
+      break
+    chunks.append(byte_str)
+  return b''.join(chunks).decode('utf-8')
+
+
 class Executor(object):
   """Executes the program by tree-walking.
 
@@ -290,7 +530,7 @@ class Executor(object):
   CompoundWord/WordPart.
   """
   def __init__(self, mem, builtins, funcs, comp_lookup, exec_opts,
-      make_parser):
+      make_parser, parse_cache=None, arena=None):
     """
     Args:
       mem: Mem instance for storing variables
@@ -298,6 +538,8 @@ class Executor(object):
       funcs: registry of functions (these names are completed)
       comp_lookup: completion pattern/action
       make_parser: Callback for creating a new command parser (eval and source)
+      parse_cache: optional ParseCache for sourced files
+      arena: optional Arena for the lines and spans of sourced files
     """
     self.mem = mem
     self.builtins = builtins
@@ -308,6 +550,11 @@ class Executor(object):
     # This is for shopt and set -o.  They are initialized by flags.
     self.exec_opts = exec_opts
     self.make_parser = make_parser
+    self.parse_cache = parse_cache
+    self.arena = arena
+    # ast.FuncDef nodes from sourced files, whose spans the caller must keep
+    # when it frees the arena.  See TakeSourcedFuncDefs().
+    self.sourced_func_defs = []
 
     self.ev = word_eval.NormalWordEvaluator(mem, exec_opts, self)
 
@@ -324,13 +571,48 @@ class Executor(object):
 
     # sleep 5 & puts a (PID, job#) entry here.  And then "jobs" displays it.
     self.jobs = {}
+    # PID -> status of jobs that finished before 'wait', removed from
+    # self.jobs by _PruneJobs().
+    self.job_statuses = {}
 
     self.dir_stack = DirStack()
+    self.cmd_hash = CommandHash(mem)
+
+    # EBuiltin -> function that takes argv and returns a status.  Names are
+    # resolved to EBuiltin by the table in builtin.py.
+    self.builtin_funcs = {
+        EBuiltin.READ: self._Read,
+        EBuiltin.ECHO: self._Echo,
+        EBuiltin.CD: self._Cd,
+        EBuiltin.PUSHD: self.dir_stack.Pushd,
+        EBuiltin.POPD: self.dir_stack.Popd,
+        EBuiltin.EXIT: self._Exit,
+        EBuiltin.SOURCE: self._Source,
+        EBuiltin.DOT: self._Source,
+        EBuiltin.TRAP: self._Trap,
+        EBuiltin.EVAL: self._Eval,
+        EBuiltin.EXEC: self._Exec,  # may never return
+        EBuiltin.SET: self._Set,
+        EBuiltin.SHOPT: self._Shopt,
+        EBuiltin.EXPORT: self._Export,
+        EBuiltin.HASH: self._Hash,
+        EBuiltin.TYPE: self._Type,
+        EBuiltin.COMMAND: self._Command,
+        EBuiltin.JOBS: self._Jobs,
+        EBuiltin.WAIT: self._Wait,
+        EBuiltin.COMPLETE: self._Complete,
+        EBuiltin.DEBUG_LINE: self.builtins.DebugLine,
+    }
 
     self.traceback = None
     self.traceback_msg = ''
     self.error_stack = []
 
+    # How many command subs are running in this process, and a temp file for
+    # the stdout of each one.  See _CaptureInProcess().
+    self.capture_depth = 0
+    self.capture_files = []
+
   def Error(self):
     return self.error_stack
 
@@ -345,7 +627,7 @@ class Executor(object):
 
   def _Read(self, argv):
     names = argv[1:]
-    line = sys.stdin.readline()
+    line = _ReadLine(0)
     if not line:  # EOF
       return 1
     # TODO: split line and do that logic
@@ -395,6 +677,23 @@ class Executor(object):
         raise NotImplementedError(name)
     return 0
 
+  def _Shopt(self, argv):
+    try:
+      flag = argv[1]
+    except IndexError:
+      raise NotImplementedError(argv)
+    if flag not in ('-s', '-u'):
+      raise NotImplementedError(flag)
+
+    status = 0
+    for name in argv[2:]:
+      if name == 'lastpipe':
+        self.exec_opts.lastpipe = (flag == '-s')
+      else:
+        log('shopt: %s: invalid shell option name', name)
+        status = 1
+    return status
+
   def _Unset(self, argv):
     # mutate self.mem
     # NOTE: sh has DYNAMIC SCOPE, so you need tests for that here.
@@ -437,38 +736,237 @@ class Executor(object):
     # TODO: Some feedback would be nice?
     return 0
 
-  def _EvalHelper(self, code_str):
-    c_parser = self.make_parser(code_str)
+  def _Parse(self, line_reader, desc, arena=None):
+    """
+    Args:
+      line_reader: where to read code from
+      desc: description of the code for parse errors
+      arena: if given, tokens get spans in it, and parse errors are shown
+        with their position
+
+    Returns:
+      The tree, or None if there was a parse error.
+    """
+    c_parser = self.make_parser(line_reader, arena=arena)
     node = c_parser.ParseWholeFile()
     # NOTE: We could model a parse error as an exception, like Python, so we
     # get a traceback.  (This won't be applicable for a static module system.)
     if not node:
-      print('Error parsing code %r' % code_str)
+      if arena:
+        ui.PrintError(c_parser.Error(), arena, sys.stderr)
+      print('Error parsing %s' % desc)
+    # The tree doesn't refer to the parser, so it can be reused right away,
+    # even by an eval nested in this code.
+    parse_lib.ReleaseParser(c_parser)
+    return node
+
+  def _EvalHelper(self, line_reader, desc):
+    node = self._Parse(line_reader, desc)
+    if not node:
       return 1
-    status = self._Execute(node)
+    status = self._Execute(compile.Compile(node))
     return status
 
   def _Eval(self, argv):
     # TODO: in oil, eval shouldn't take multiple args.  For clarity 'eval ls
     # foo' will say "extra arg".
     code_str = argv[1]
-    return self._EvalHelper(code_str)
+    line_reader = reader.StringLineReader(code_str)
+    return self._EvalHelper(line_reader, 'code %r' % code_str)
 
   def _Source(self, argv):
-    with open(argv[1]) as f:
-      code_str = f.read()
-    return self._EvalHelper(code_str)
+    path = argv[1]
+    arena = self.arena
+    if arena:
+      # Lines read after this one are still from the current file.
+      src_index = arena.SourceIndex()
+      try:
+        node = self._ParseSourced(path, arena)
+      finally:
+        arena.RestoreSourceIndex(src_index)
+    else:
+      node = self._ParseSourced(path, None)
+    if not node:
+      return 1
+    if arena:
+      self.sourced_func_defs.extend(cmd_parse.FindFuncDefs(node))
+    return self._Execute(compile.Compile(node))
+
+  def _ParseSourced(self, path, arena):
+    """Returns the tree of a sourced file, or None if there was an error."""
+    node = self.parse_cache and self.parse_cache.Load(path, arena=arena)
+    if node:
+      return node
+
+    mark = arena.Mark() if arena else None
+    try:
+      line_reader = reader.FileLineReader(path, arena=arena)
+    except OSError as e:
+      log('source: %s: %s', path, os.strerror(e.errno))
+      return None
+    node = self._Parse(line_reader, 'file %r' % path, arena=arena)
+    if node and self.parse_cache:
+      self.parse_cache.Save(path, line_reader.file_stat, node, arena=arena,
+                            mark=mark)
+    return node
+
+  def TakeSourcedFuncDefs(self):
+    """Return the FuncDef nodes of files sourced since the last call.
+
+    The spans of sourced files are in the arena after the caller's mark, so it
+    has to keep the ones these functions refer to.
+    """
+    func_defs = self.sourced_func_defs
+    self.sourced_func_defs = []
+    return func_defs
+
+  def _Export(self, argv):
+    # NOTE: This is dynamic, unlike local and readonly.  See id_kind.py.
+    exported = True
+    args = argv[1:]
+    if args and args[0] == '-n':
+      exported = False
+      args = args[1:]
+
+    for arg in args:
+      name, eq, s = arg.partition('=')
+      if eq:
+        # Even in a function, export sets a global.
+        self.mem.SetGlobalString(ast.LeftVar(name), s)
+      self.mem.SetExported(name, exported)
+    return 0
+
+  def _Hash(self, argv):
+    args = argv[1:]
+    if args and args[0] == '-r':
+      self.cmd_hash.Clear()
+      return 0
+
+    if not args:
+      for name, path in self.cmd_hash.Items():
+        print(path)
+      return 0
+
+    status = 0
+    for name in args:
+      if self.cmd_hash.Lookup(name) is None:
+        log('hash: %s: not found', name)
+        status = 1
+    return status
+
+  def _Type(self, argv):
+    status = 0
+    for name in argv[1:]:
+      # Same order as _GetThunkForSimpleCommand.
+      b = self.builtins.Lookup(name)
+      if b is not None and b.special:
+        print('%s is a special shell builtin' % name)
+      elif name in self.funcs:
+        print('%s is a function' % name)
+      elif b is not None:
+        print('%s is a shell builtin' % name)
+      elif self.cmd_hash.IsHashed(name):
+        print('%s is hashed (%s)' % (name, self.cmd_hash.Lookup(name)))
+      else:
+        path = self.cmd_hash.Lookup(name)
+        if path is None:
+          log('type: %s: not found', name)
+          status = 1
+        else:
+          print('%s is %s' % (name, path))
+    return status
+
+  def _Command(self, argv):
+    args = argv[1:]
+    if args and args[0] == '-v':
+      status = 0
+      for name in args[1:]:
+        if self.builtins.Lookup(name) is not None or name in self.funcs:
+          print(name)
+          continue
+        path = self.cmd_hash.Lookup(name)
+        if path is None:
+          status = 1
+        else:
+          print(path)
+      return status
+
+    if not args:
+      return 0
+
+    # Run a builtin or external command, skipping functions.  Redirects were
+    # already applied to this process.
+    b = self.builtins.Lookup(args[0])
+    if b is not None:
+      return self.RunBuiltin(b.builtin_id, args)
+    thunk = self._GetExternalThunk(args, None)
+    if not thunk.IsExternal():
+      return thunk.RunInParent()  # not found
+    return Process(thunk, fd_state=self.fd_state).Run()
 
   def _Exec(self, argv):
     # Either execute command with redirects, or apply redirects in this shell.
     # NOTE: Redirects were processed earlier.
     argv = argv[1:]
     if argv:
-      thunk = ExternalThunk(argv)
-      thunk.RunInParent()  # never returns
+      thunk = self._GetExternalThunk(argv, None)
+      if self.capture_depth and thunk.IsExternal():
+        # In a command sub running in this process, exec only ends the command
+        # sub, so don't replace the shell.
+        sys.exit(Process(thunk, fd_state=self.fd_state).Run())
+      # Never returns.  If the command isn't found, the shell exits with 127.
+      sys.exit(thunk.RunInParent())
     else:
       return 0
 
+  def _Jobs(self, argv):
+    states = [(pid, 'Done') for pid in self.job_statuses]
+    for pid, job in self.jobs.items():
+      states.append((pid, 'Running' if job.Poll() is None else 'Done'))
+    for pid, state in sorted(states):
+      print('%d %s' % (pid, state))
+    return 0
+
+  def _Wait(self, argv):
+    args = argv[1:]
+    if args and args[0] == '-n':
+      # Wait for the next job to finish, and return its status.
+      if self.job_statuses:
+        pid = next(iter(self.job_statuses))  # the first one that finished
+        return self.job_statuses.pop(pid)
+      if not self.jobs:
+        return 127
+      JOB_STATE.WaitUntil(lambda: self._FirstDone() is not None)
+      pid = self._FirstDone()
+      if pid is None:  # shouldn't happen
+        return 127
+      return self._WaitForJob(self.jobs.pop(pid))
+
+    if not args:
+      # Wait for all jobs.  The status is 0, like other shells.
+      for pid, job in sorted(self.jobs.items()):
+        self._WaitForJob(job)
+      self.jobs.clear()
+      self.job_statuses.clear()
+      return 0
+
+    status = 0
+    for arg in args:
+      try:
+        pid = int(arg)
+      except ValueError:
+        log('wait: %r: invalid pid', arg)
+        return 1
+      job = self.jobs.pop(pid, None)
+      if job is not None:
+        status = self._WaitForJob(job)
+      elif pid in self.job_statuses:
+        status = self.job_statuses.pop(pid)
+      else:
+        log('wait: pid %d is not a child of this shell', pid)
+        status = 127
+    return status  # of the last one
+
   def _Cd(self, argv):
     # TODO: Parse flags, error checking, etc.
     dest_dir = argv[1]
@@ -490,75 +988,27 @@ class Executor(object):
     self.mem.SetGlobalString(ast.LeftVar('PWD'), dest_dir)
     return 0
 
-  def RunBuiltin(self, builtin_id, argv):
-    restore_fd_state = True
+  def _Exit(self, argv):
+    try:
+      code = int(argv[1])
+    except IndexError:
+      code = 0
+    except ValueError as e:
+      print("Invalid argument %r" % argv[1], file=sys.stderr)
+      code = 1  # Runtime Error
+    # TODO: Should this be turned into our own SystemExit exception?
+    sys.exit(code)
 
+  def RunBuiltin(self, builtin_id, argv):
     # TODO: Just test Type() == COMMAND word, and then if it's a command word,
     # type IsBuiltin().  And then builtins are NOT tokens!  Keywords might be
     # tokens, but builtins aren't.
-
-    # TODO: figure out a quicker dispatch mechanism.  Just make a table of
-    # builtins I guess.
-    if builtin_id == EBuiltin.READ:
-      status = self._Read(argv)
-
-    elif builtin_id == EBuiltin.ECHO:
-      status = self._Echo(argv)
-
-    elif builtin_id == EBuiltin.CD:
-      status = self._Cd(argv)
-
-    elif builtin_id == EBuiltin.PUSHD:
-      status = self.dir_stack.Pushd(argv)
-
-    elif builtin_id == EBuiltin.POPD:
-      status = self.dir_stack.Popd(argv)
-
-    elif builtin_id == EBuiltin.EXIT:
-      try:
-        code = int(argv[1])
-      except IndexError:
-        code = 0
-      except ValueError as e:
-        print("Invalid argument %r" % argv[1], file=sys.stderr)
-        code = 1  # Runtime Error
-      # TODO: Should this be turned into our own SystemExit exception?
-      sys.exit(code)
-
-    elif builtin_id in (EBuiltin.SOURCE, EBuiltin.DOT):
-      status = self._Source(argv)
-
-    elif builtin_id == EBuiltin.TRAP:
-      status = self._Trap(argv)
-
-    elif builtin_id == EBuiltin.EVAL:
-      status = self._Eval(argv)
-
-    elif builtin_id == EBuiltin.EXEC:
-      status = self._Exec(argv)  # may never return
-      restore_fd_state = False
-
-    elif builtin_id == EBuiltin.SET:
-      status = self._Set(argv)
-
-    elif builtin_id == EBuiltin.COMPLETE:
-      status = self._Complete(argv)
-
-    elif builtin_id == EBuiltin.COMPGEN:
-      status = self._CompGen(argv)
-
-    elif builtin_id == EBuiltin.DEBUG_LINE:
-      status = self.builtins.DebugLine(argv)
-
-    else:
-      raise AssertionError('Unhandled builtin: %d' % builtin_id)
-
+    status = self.builtin_funcs[builtin_id](argv)
     assert isinstance(status, int)
     return status
 
   def RunFunc(self, func_node, argv):
     """Called by FuncThunk."""
-    func_body = func_node.body
     # TODO: Call func with $@, $1, etc.
 
     self.mem.Push(argv[1:])
@@ -566,7 +1016,7 @@ class Executor(object):
     # Redirects still valid for functions.
     # Here doc causes a pipe and Process(SubProgramThunk).
     try:
-      status = self._Execute(func_body)
+      status = self._GetFuncBody(func_node)()
     except _ControlFlow as e:
       if e.IsReturn():
         status = e.ReturnValue()
@@ -598,25 +1048,36 @@ class Executor(object):
     """
     assert argv, "Need at least one arugment"
 
-    # TODO: respect the special builtin order too
-
-    builtin_id = self.builtins.Resolve(argv[0])
-    if builtin_id != EBuiltin.NONE:
-      return BuiltinThunk(self, builtin_id, argv)
+    # Special builtins, then functions, then other builtins, then $PATH.
+    b = self.builtins.Lookup(argv[0])
+    if b is not None and b.special:
+      return BuiltinThunk(self, b.builtin_id, argv)
 
     func_node = self.funcs.get(argv[0])
     if func_node is not None:
       return FuncThunk(self, func_node, argv)
 
-    return ExternalThunk(argv, more_env)
+    if b is not None:
+      return BuiltinThunk(self, b.builtin_id, argv)
+
+    return self._GetExternalThunk(argv, more_env)
+
+  def _GetExternalThunk(self, argv, more_env):
+    path = self.cmd_hash.Lookup(argv[0])
+    if path is None:
+      return CommandNotFoundThunk(argv)
+    return ExternalThunk(argv, more_env, self.mem.GetExported(), path)
 
   def _GetProcessForNode(self, node):
     """
     Assume we will run the node in another process.  Return a process.
+
+    Args:
+      node: ovm.command
     """
+    redir_nodes = []
     if node.tag == command_e.SimpleCommand:
-      words = braces.BraceExpandWords(node.words)
-      argv = self.ev.EvalWordSequence(words)
+      argv = self._EvalArgs(node.args)
       if argv is None:
         err = self.ev.Error()
         raise AssertionError("Error evaluating words: %s" % err)
@@ -625,6 +1086,7 @@ class Executor(object):
         # TODO: proper error
         raise AssertionError()
       thunk = self._GetThunkForSimpleCommand(argv, more_env)
+      redir_nodes = node.redirects
 
     elif node.tag == command_e.ControlFlow:
       # TODO: Raise _FatalError
@@ -635,14 +1097,129 @@ class Executor(object):
       # NOTE: This could be done at parse time too.
       raise AssertionError('Invalid control flow %s' % node)
 
+    elif node.tag == command_e.Redirect:
+      # Apply them in the child process.
+      thunk = SubProgramThunk(self, node.child)
+      redir_nodes = node.redirects
+
     else:
       thunk = SubProgramThunk(self, node)
 
-    redirects = self._EvalRedirects(node)
+    redirects = self._EvalRedirects(redir_nodes)
     p = Process(thunk, fd_state=self.fd_state, redirects=redirects)
     return p
 
-  def _EvalRedirects(self, node):
+  def _CanCaptureInProcess(self, code):
+    """Whether a command sub can run in this process instead of forking.
+
+    True for a simple command that calls a builtin or a function.  The first
+    word has to be constant, so we know that without evaluating it.
+    """
+    if code.tag != command_e.SimpleCommand:
+      return False
+    if code.args.tag == args_e.ConstArgs:
+      if not code.args.strs:
+        return False  # e.g. $(< file)
+      name = code.args.strs[0]
+    else:
+      name = compile.FoldWord(code.args.words[0])
+      if name is None:
+        return False
+    return name in self.funcs or self.builtins.Lookup(name) is not None
+
+  def _GetCaptureFile(self):
+    """Returns a temp file for stdout at the current capture depth.
+
+    A pipe could fill up before we read it, and the files are reused so we
+    don't create one per command sub.
+    """
+    if self.capture_depth == len(self.capture_files):
+      self.capture_files.append(tempfile.TemporaryFile())
+    return self.capture_files[self.capture_depth].fileno()
+
+  def _CaptureInProcess(self, code):
+    """Run a command sub in this process, and return its stdout.
+
+    It runs like it would in a subshell.  The state it could change is saved
+    and restored afterward: variables, the working directory, options,
+    functions, traps, the directory stack, jobs and errors.  'exit' ends only
+    the command sub.
+    """
+    fd = self._GetCaptureFile()
+    saved_mem = self.mem.Snapshot()
+    saved_cwd = os.getcwd()
+    saved_opts = dict(vars(self.exec_opts))
+    saved_funcs = dict(self.funcs)
+    saved_traps = self.traps
+    saved_dirs = self.dir_stack.dir_stack
+    saved_jobs = self.jobs, self.job_statuses
+    saved_error = self.traceback, self.traceback_msg, list(self.error_stack)
+    num_frames = len(self.fd_state.stack)
+
+    self.traps = dict(saved_traps)
+    self.dir_stack.dir_stack = list(saved_dirs)
+    self.jobs = {}  # A subshell has no jobs to wait for.
+    self.job_statuses = {}
+
+    sys.stdout.flush()
+    self.fd_state.PushFrame()
+    self.capture_depth += 1
+    try:
+      self.fd_state.SaveAndDup(fd, 1)
+      try:
+        self._ExecuteAndCatch(code)
+      except SystemExit:
+        pass  # exit builtin
+      sys.stdout.flush()
+    finally:
+      self.capture_depth -= 1
+      # Frames may be left over if there was an exception.
+      while len(self.fd_state.stack) > num_frames:
+        self.fd_state.PopAndRestore()
+
+      self.mem.Restore(saved_mem)
+      if os.getcwd() != saved_cwd:
+        os.chdir(saved_cwd)
+      vars(self.exec_opts).update(saved_opts)
+      # Other code has a reference to self.funcs, so restore it in place.
+      self.funcs.clear()
+      self.funcs.update(saved_funcs)
+      self.traps = saved_traps
+      self.dir_stack.dir_stack = saved_dirs
+      # Nobody can wait for the command sub's jobs.
+      for job in self.jobs.values():
+        procs = job.procs if isinstance(job, Pipeline) else [job]
+        for p in procs:
+          JOB_STATE.Forget(p.pid)
+      self.jobs, self.job_statuses = saved_jobs
+      self.traceback, self.traceback_msg, self.error_stack = saved_error
+
+    chunks = []
+    os.lseek(fd, 0, os.SEEK_SET)
+    while True:
+      byte_str = os.read(fd, 4096)
+      if not byte_str:
+        break
+      chunks.append(byte_str)
+    os.lseek(fd, 0, os.SEEK_SET)
+    os.ftruncate(fd, 0)
+    return b''.join(chunks).decode('utf-8')
+
+  def RunCommandSub(self, node):
+    """Run the ast.command in $(...), and return its stdout."""
+    code = compile.Compile(node)
+    if self._CanCaptureInProcess(code):
+      return self._CaptureInProcess(code)
+
+    p = self._GetProcessForNode(code)
+    # NOTE: We could do an optimization for pipelines.  Pick the last
+    # process element, and do pi.procs[-1].CaptureOutput()
+    stdout = []
+    p.CaptureOutput(stdout)
+    p.Run()
+    return ''.join(stdout)
+
+  def _EvalRedirects(self, redir_nodes):
     """Evaluate redirect nodes to concrete objects.
 
     We have to do this every time, because you could have something like:
@@ -653,16 +1230,12 @@ class Executor(object):
 
     Does it makes sense to just have RedirectNode.Eval?  Nah I think the
     Redirect() abstraction in process.py is useful.  It has a lot of methods.
-    """
-    # No redirects
-    if node.tag in (
-        command_e.NoOp, command_e.Assignment, command_e.ControlFlow,
-        command_e.Pipeline, command_e.AndOr, command_e.CommandList,
-        command_e.Sentence):
-      return []
 
+    Args:
+      redir_nodes: list of ast.redir
+    """
     redirects = []
-    for n in node.redirects:
+    for n in redir_nodes:
       redir_type = REDIR_TYPE[n.op_id]
       if redir_type == RedirType.Path:
         # NOTE: no globbing.  You can write to a file called '*.py'.
@@ -721,42 +1294,84 @@ class Executor(object):
     Returns:
       A dictionary of strings to strings
 
-    Side effect: sets local variables so bindings can reference each other.
-      Hm.  Is this wrong?
+    The bindings are set in a temporary scope so they can reference each
+    other.  They're only passed to the command, not left in the shell.
     """
     result = {}
-    for env_pair in more_env:
-      name = env_pair.name
-      rhs = env_pair.val
+    self.mem.Push(self.mem.GetArgv())
+    try:
+      for env_pair in more_env:
+        name = env_pair.name
+        rhs = env_pair.val
 
-      ok, val = self.ev.EvalWordToString(rhs)
-      if not ok:
-        raise AssertionError
+        ok, val = self.ev.EvalWordToString(rhs)
+        if not ok:
+          raise AssertionError
 
-      # Set each var so the next one can reference it.  Example:
-      # FOO=1 BAR=$FOO ls /
-      self.mem.SetSimpleVar(name, val)
-      # TODO: Need to pop bindings for simple commands.  Need a stack.
+        # Set each var so the next one can reference it.  Example:
+        # FOO=1 BAR=$FOO ls /
+        self.mem.SetSimpleVar(name, val)
 
-      result[name] = val.s
+        result[name] = val.s
+    finally:
+      self.mem.Pop()
     return result
 
+  def _EvalArgs(self, args):
+    """Evaluate the words of a command or for loop.
+
+    Args:
+      args: ovm.args
+
+    Returns:
+      argv: list of strings, or None if there was an eval error
+    """
+    if args.tag == args_e.ConstArgs:
+      return list(args.strs)  # folded at compile time
+    return self.ev.EvalWordSequence(args.words)
+
+  def _RunLastPipe(self, pi, last):
+    """Run the last stage of a pipeline in this process, for lastpipe.
+
+    It saves a fork, and variables it sets are visible afterward, e.g. in
+    'seq 3 | while read i; do last=$i; done'.
+
+    Returns:
+      A list of statuses, like Pipeline.Run().
+    """
+    r = pi.AddLastPipe()
+    pi.Start()
+    try:
+      self.fd_state.PushFrame()
+      try:
+        r.ApplyInParent(self.fd_state)
+        status = self._Execute(last)
+      finally:
+        # Close our end of the pipe before waiting, so writers don't block.
+        self.fd_state.PopAndRestore()
+    finally:
+      pipe_status = pi.Wait()
+    pipe_status.append(status)
+    return pipe_status
+
   def _RunPipeline(self, node):
     # TODO: Also check for "echo" and "read".  Turn them into HereDocRedirect()
     # and p.CaptureOutput()
 
-    # NOTE: First or last one can use the "main" shell thread.  Doesn't have to
-    # run in subshell.  Although I guess it's simpler if it always does.
+    # NOTE: First or last one can use the "main" shell thread.  With lastpipe,
+    # the last one does.
     pi = Pipeline()
 
-    for child in node.children:
-      p = self._GetProcessForNode(child)
-      pi.Add(p)
-
-    #print(pi)
-
-    # TODO: Set PipeStatus() in self.mem
-    pipe_status = pi.Run()
+    if self.exec_opts.lastpipe:
+      for child in node.children[:-1]:
+        pi.Add(self._GetProcessForNode(child))
+      pipe_status = self._RunLastPipe(pi, node.children[-1])
+    else:
+      for child in node.children:
+        p = self._GetProcessForNode(child)
+        pi.Add(p)
+      # TODO: Set PipeStatus() in self.mem
+      pipe_status = pi.Run()
     #log('pipe_status %s', pipe_status)
 
     if self.exec_opts.pipefail:
@@ -768,20 +1383,162 @@ class Executor(object):
     else:
       status = pipe_status[-1]  # last one determines status
 
+    if node.negated:
+      status = 0 if status != 0 else 1
     return status
 
-  def _Execute(self, node):
+  def _MaxJobs(self):
+    """Returns the limit on running background jobs, or 0 for no limit.
+
+    It's opt-in: OSH_MAX_JOBS=8 makes & block while 8 jobs are running.
     """
+    val = self.mem.Get('OSH_MAX_JOBS')
+    if val.tag == value_e.Str and val.s.isdigit():
+      return int(val.s)
+    return 0
+
+  def _PruneJobs(self):
+    """Move the statuses of finished jobs out of self.jobs.
+
+    Then self.jobs only has running jobs, so checking OSH_MAX_JOBS doesn't
+    poll every job that was ever started.
+    """
+    done = [pid for pid, job in self.jobs.items() if job.Poll() is not None]
+    for pid in done:
+      self.job_statuses[pid] = self._WaitForJob(self.jobs.pop(pid))
+
+  def _NumRunning(self):
+    self._PruneJobs()
+    return len(self.jobs)
+
+  def _StartJob(self, node):
+    """Start a command in the background, for &.  Returns a status."""
+    max_jobs = self._MaxJobs()
+    if max_jobs:
+      JOB_STATE.WaitUntil(lambda: self._NumRunning() < max_jobs)
+
+    if node.tag == command_e.Pipeline:
+      job = Pipeline()
+      for child in node.children:
+        job.Add(self._GetProcessForNode(child))
+    else:
+      job = self._GetProcessForNode(node)
+    pid = job.Start()
+    self.jobs[pid] = job
+    self.mem.last_job_pid = pid
+    return 0
+
+  def _FirstDone(self):
+    """Returns the PID of the first job that's done, or None."""
+    for pid, job in self.jobs.items():  # in the order they were started
+      if job.Poll() is not None:
+        return pid
+    return None
+
+  def _WaitForJob(self, job):
+    status = job.Wait()
+    if isinstance(job, Pipeline):
+      # TODO: pipefail and negation, like _RunPipeline
+      status = status[-1]
+    return status
+
+  def _RunSimpleCommand(self, argv, more_env, redirects):
+    """Run an evaluated simple command, in this process if possible."""
+    if redirects is False:
+      self.error_stack.extend(self.ev.Error())
+      raise _FatalError()
+
+    thunk = self._GetThunkForSimpleCommand(argv, more_env)
+
+    # Don't waste a process if we'd launch one anyway.
+    if thunk.IsExternal():
+      p = Process(thunk, fd_state=self.fd_state, redirects=redirects)
+      return p.Run()
+
+    # Internal.  Prefix bindings are visible while it runs, and then undone.
+    if more_env:
+      temp = self.mem.SetTemp(more_env)
+      try:
+        return self._RunInParent(thunk, redirects)
+      finally:
+        self.mem.RestoreTemp(temp)
+    return self._RunInParent(thunk, redirects)
+
+  def _RunInParent(self, thunk, redirects):
+    if not redirects:  # Common case: no fd state to save and restore.
+      return thunk.RunInParent()
+
+    # NOTE: _EvalRedirects turns LST nodes into core/process.py nodes.  And
+    # then we use polymorphism here.  Does it make sense to use functional
+    # style based on the RedirType?  Might be easier to read.
+
+    self.fd_state.PushFrame()
+    for r in redirects:
+      r.ApplyInParent(self.fd_state)
+
+    status = thunk.RunInParent()
+    restore_fd_state = thunk.ShouldRestoreFdState()
+
+    # Special case for exec 1>&2 (with no args): we permanently change the
+    # fd state.  BUT we don't want to restore later.
+    # TODO: Instead of this, maybe r.ApplyPermaent(self.fd_state)?
+    if restore_fd_state:
+      self.fd_state.PopAndRestore()
+    else:
+      self.fd_state.PopAndForget()
+    return status
+
+  def _Assign(self, node):
+    pairs = []
+    for pair in node.pairs:
+      # RHS can be a string or array.
+      ok, val = self.ev.EvalWordToAny(pair.rhs)
+      assert isinstance(val, runtime.value), val
+      #log('RHS %s -> %s', pair.rhs, val)
+      if not ok:
+        self.error_stack.extend(self.ev.Error())
+        raise _FatalError()
+      pairs.append((pair.lhs, val))
+
+    flags = 0  # TODO: Calculate from keyword/flags
+    if node.keyword == Id.Assign_Local:
+      self.mem.SetLocal(pairs, flags)
+    else:  # could be readonly/export/etc.
+      self.mem.SetGlobal(pairs, flags)
+
+    # TODO: This should be eval of RHS, unlike bash!
+    return 0
+
+  def _RunRedirected(self, redir_nodes, run):
+    """Run a compound command with redirects applied in this process.
+
     Args:
-      node: of type AstNode
+      redir_nodes: list of ast.redir
+      run: function with no arguments that runs the command
     """
-    redirects = self._EvalRedirects(node)
+    redirects = self._EvalRedirects(redir_nodes)
+    if redirects is False:
+      self.error_stack.extend(self.ev.Error())
+      raise _FatalError()
+
+    self.fd_state.PushFrame()
+    try:
+      for r in redirects:
+        r.ApplyInParent(self.fd_state)
+      return run()
+    finally:
+      self.fd_state.PopAndRestore()
 
+  def _Execute(self, node):
+    """
+    Args:
+      node: ovm.command, from compile.Compile()
+    """
     # TODO: Only eval argv[0] once.  It can have side effects!
     if node.tag == command_e.SimpleCommand:
-      words = braces.BraceExpandWords(node.words)
-      argv = self.ev.EvalWordSequence(words)
+      redirects = self._EvalRedirects(node.redirects)
 
+      argv = self._EvalArgs(node.args)
       if argv is None:
         self.error_stack.extend(self.ev.Error())
         raise _FatalError()
@@ -790,47 +1547,88 @@ class Executor(object):
         print(self.error_stack)
         # TODO: throw exception
         raise AssertionError()
-      thunk = self._GetThunkForSimpleCommand(argv, more_env)
+      status = self._RunSimpleCommand(argv, more_env, redirects)
 
-      # Don't waste a process if we'd launch one anyway.
-      if thunk.IsExternal():
-        p = Process(thunk, fd_state=self.fd_state, redirects=redirects)
-        status = p.Run()
+    elif node.tag == command_e.CommandSeq:
+      status = 0  # for empty list
+      for child in node.children:
+        status = self._Execute(child)  # last status wins
 
-      else:  # Internal
-        #log('ARGV %s', argv)
+    elif node.tag == command_e.AndOr:
+      children = node.children
+      status = self._Execute(children[0])
+      for i, op_id in enumerate(node.ops):
+        if op_id == Id.Op_DAmp:
+          if status == 0:
+            status = self._Execute(children[i + 1])
+        elif op_id == Id.Op_DPipe:
+          if status != 0:
+            status = self._Execute(children[i + 1])
+        else:
+          raise AssertionError(op_id)
 
-        # NOTE: _EvalRedirects turns LST nodes into core/process.py nodes.  And
-        # then we use polymorphism here.  Does it make sense to use functional
-        # style based on the RedirType?  Might be easier to read.
+    elif node.tag in (command_e.Loop, command_e.ForEach):
+      # Run the loop's closure, instead of dispatching on each iteration.  It
+      # checks errexit and sets $? itself.
+      return self._MakeClosure(node)()
 
-        self.fd_state.PushFrame()
-        for r in redirects:
-          r.ApplyInParent(self.fd_state)
 
-        status = thunk.RunInParent()
-        restore_fd_state = thunk.ShouldRestoreFdState()
+    elif node.tag == command_e.If:
+      status = 0
+      for arm in node.arms:
+        if arm.cond is not None:  # else arm has no condition
+          status = self._Execute(arm.cond)
+          if status != 0:
+            continue
+        status = self._Execute(arm.action)
+        break
 
-        # Special case for exec 1>&2 (with no args): we permanently change the
-        # fd state.  BUT we don't want to restore later.
-        # TODO: Instead of this, maybe r.ApplyPermaent(self.fd_state)?
-        if restore_fd_state:
-          self.fd_state.PopAndRestore()
-        else:
-          self.fd_state.PopAndForget()
+    elif node.tag == command_e.Case:
+      ok, val = self.ev.EvalWordToString(node.to_match)
+      assert ok
+      to_match = val.s
 
-    elif node.tag == command_e.Sentence:
-      # TODO: Compile this away.
-      status = self._Execute(node.command)
+      status = 0  # If there are no arms, it should be zero?
+      done = False
+      for arm in node.arms:
+        for pat_word in arm.pat_list:
+          # NOTE: Is it OK that we're evaluating these as we go?
+          ok, pat_val = self.ev.EvalWordToString(pat_word, do_fnmatch=True)
+          assert ok
+          #log('Matching word %r against pattern %r', to_match, pat_val.s)
+          if libc.fnmatch(pat_val.s, to_match):
+            status = self._Execute(arm.action)
+            done = True  # TODO: Parse ;;& and for fallthrough and such?
+        if done:
+          break
+
+    elif node.tag == command_e.Assignment:
+      status = self._Assign(node)
+
+    elif node.tag == command_e.ControlFlow:
+      if node.arg_word:  # Evaluate the argument
+        ok, val = self.ev.EvalWordToString(node.arg_word)
+        if not ok:
+          self.error_stack.extend(self.ev.Error())
+          raise _FatalError()
+        assert val.tag == value_e.Str
+        arg = int(val.s)  # They all take integers
+      else:
+        arg = 0  # return 0, break 0 levels, etc.
+
+      raise _ControlFlow(node.token, arg)
 
     elif node.tag == command_e.Pipeline:
       status = self._RunPipeline(node)
 
     elif node.tag == command_e.Subshell:
       # This makes sure we don't waste a process if we'd launch one anyway.
-      p = self._GetProcessForNode(node.children[0])
+      p = self._GetProcessForNode(node.child)
       status = p.Run()
 
+    elif node.tag == command_e.Fork:
+      status = self._StartJob(node.child)
+
     elif node.tag == command_e.DBracket:
       bool_ev = expr_eval.BoolEvaluator(self.mem, self.ev)
       ok = bool_ev.Eval(node.expr)
@@ -850,160 +1648,28 @@ class Executor(object):
       else:
         raise AssertionError('Error evaluating (( )): %s' % arith_ev.Error())
 
-    elif node.tag == command_e.Assignment:
-      pairs = []
-      for pair in node.pairs:
-        # RHS can be a string or array.
-        ok, val = self.ev.EvalWordToAny(pair.rhs)
-        assert isinstance(val, runtime.value), val
-        #log('RHS %s -> %s', pair.rhs, val)
-        if not ok:
-          self.error_stack.extend(self.ev.Error())
-          raise _FatalError()
-        pairs.append((pair.lhs, val))
-
-      flags = 0  # TODO: Calculate from keyword/flags
-      if node.keyword == Id.Assign_Local:
-        self.mem.SetLocal(pairs, flags)
-      else:  # could be readonly/export/etc.
-        self.mem.SetGlobal(pairs, flags)
-
-      # TODO: This should be eval of RHS, unlike bash!
-      status = 0
-
-    elif node.tag == command_e.ControlFlow:
-      if node.arg_word:  # Evaluate the argument
-        ok, val = self.ev.EvalWordToString(node.arg_word)
-        if not ok:
-          self.error_stack.extend(self.ev.Error())
-          raise _FatalError()
-        assert val.tag == value_e.Str
-        arg = int(val.s)  # They all take integers
-      else:
-        arg = 0  # return 0, break 0 levels, etc.
-
-      raise _ControlFlow(node.token, arg)
-
-    # The only difference between these two is that CommandList has no
-    # redirects.  We already took care of that above.
-    elif node.tag in (command_e.CommandList, command_e.BraceGroup):
-      status = 0  # for empty list
-      for child in node.children:
-        status = self._Execute(child)  # last status wins
-
-    elif node.tag == command_e.AndOr:
-      #print(node.children)
-      left, right = node.children
-      status = self._Execute(left)
-
-      if node.op_id == Id.Op_DPipe:
-        if status != 0:
-          status = self._Execute(right)
-      elif node.op_id == Id.Op_DAmp:
-        if status == 0:
-          status = self._Execute(right)
-      else:
-        raise AssertionError
-
-    elif node.tag in (command_e.While, command_e.Until):
-      # TODO: Compile this out?
-      if node.tag == command_e.While:
-        _DonePredicate = lambda status: status != 0
-      else:
-        _DonePredicate = lambda status: status == 0
-
-      while True:
-        status = self._Execute(node.cond)
-        done = status != 0
-        if _DonePredicate(status):
-          break
-        try:
-          status = self._Execute(node.body)  # last one wins
-        except _ControlFlow as e:
-          if e.IsBreak():
-            status = 0
-            break
-          elif e.IsContinue():
-            status = 0
-            continue
-          else:  # return needs to pop up more
-            raise
-
-    elif node.tag == command_e.ForEach:
-      iter_name = node.iter_name
-      if node.do_arg_iter:
-        iter_list = self.mem.GetArgv()
-      else:
-        words = braces.BraceExpandWords(node.iter_words)
-        iter_list = self.ev.EvalWordSequence(words)
-        # We need word splitting and so forth
-        # NOTE: This expands globs too.  TODO: We should pass in a Globber()
-        # object.
-      status = 0  # in case we don't loop
-      for x in iter_list:
-        self.mem.SetSimpleVar(iter_name, runtime.Str(x))
-
-        try:
-          status = self._Execute(node.body)  # last one wins
-        except _ControlFlow as e:
-          if e.IsBreak():
-            status = 0
-            break
-          elif e.IsContinue():
-            status = 0
-            continue
-          else:  # return needs to pop up more
-            raise
-
-    elif node.tag == command_e.ForExpr:
-      raise NotImplementedError(node.tag)
-
-    elif node.tag == command_e.DoGroup:
-      # Delegate to command list
-      # TODO: This should be compiled out!
-      status = self._Execute(node.child)
+    elif node.tag == command_e.Redirect:
+      child = node.child
+      status = self._RunRedirected(node.redirects,
+                                   lambda: self._Execute(child))
 
     elif node.tag == command_e.FuncDef:
       self.funcs[node.name] = node
       status = 0
 
-    elif node.tag == command_e.If:
-      done = False
-      for arm in node.arms:
-        status = self._Execute(arm.cond)
-        if status == 0:
-          status = self._Execute(arm.action)
-          done = True
-          break
-      # TODO: The compiler should flatten this
-      if not done and node.else_action is not None:
-        status = self._Execute(node.else_action)
-
     elif node.tag == command_e.NoOp:
       status = 0  # make it true
 
-    elif node.tag == command_e.Case:
-      ok, val = self.ev.EvalWordToString(node.to_match)
-      assert ok
-      to_match = val.s
-
-      status = 0  # If there are no arms, it should be zero?
-      done = False
-      for arm in node.arms:
-        for pat_word in arm.pat_list:
-          # NOTE: Is it OK that we're evaluating these as we go?
-          ok, pat_val = self.ev.EvalWordToString(pat_word, do_fnmatch=True)
-          assert ok
-          #log('Matching word %r against pattern %r', to_match, pat_val.s)
-          if libc.fnmatch(pat_val.s, to_match):
-            status = self._Execute(arm.action)
-            done = True  # TODO: Parse ;;& and for fallthrough and such?
-        if done:
-          break
+    elif node.tag == command_e.ForExpr:
+      raise NotImplementedError(node.tag)
 
     else:
       raise AssertionError(node.tag)
 
+    return self._FinishCommand(status)
+
+  def _FinishCommand(self, status):
+    """Check errexit and set $? after a command.  Returns the status."""
     if self.exec_opts.errexit:
       if status != 0:
         # TODO: token should be set to what?  Is it node.begin_word and
@@ -1020,21 +1686,250 @@ class Executor(object):
     self.mem.last_status = status
     return status
 
-  def Execute(self, node):
-    """Execute a top level LST node."""
+  def _GetFuncBody(self, func_node):
+    """Return the closure for a function body, compiled on the first call."""
+    if func_node.body_closure is None:
+      func_node.body_closure = self._MakeClosure(func_node.body)
+    return func_node.body_closure
+
+  def _MakeClosure(self, node):
+    """Compile an ovm node to a Python closure that executes it.
+
+    Loop and function bodies are compiled once, instead of going through
+    _Execute() on every iteration or call.  Dispatch on node.tag, constant
+    argv, evaluator construction, and checks for redirects happen here.
+    Nodes that are executed at most once fall back on _Execute().
+
+    Args:
+      node: ovm.command
+
+    Returns:
+      A function with no arguments that returns the exit status.
+    """
+    # Loops are compiled once and cached on the node, since _Execute() may run
+    # the same one many times.
+    if node.tag in (command_e.Loop, command_e.ForEach):
+      if node.closure is not None:
+        return node.closure
+
+    finish = self._FinishCommand
+
+    if node.tag == command_e.SimpleCommand:
+      args = node.args
+      redir_nodes = node.redirects
+      env_pairs = node.more_env
+      eval_args = self._EvalArgs
+      run_simple = self._RunSimpleCommand
+
+      def run():
+        redirects = self._EvalRedirects(redir_nodes) if redir_nodes else []
+        argv = eval_args(args)
+        if argv is None:
+          self.error_stack.extend(self.ev.Error())
+          raise _FatalError()
+        more_env = self._EvalEnv(env_pairs) if env_pairs else {}
+        return finish(run_simple(argv, more_env, redirects))
+      return run
+
+    if node.tag == command_e.CommandSeq:
+      children = [self._MakeClosure(child) for child in node.children]
+
+      def run():
+        status = 0  # for empty list
+        for child in children:
+          status = child()  # last status wins
+        return finish(status)
+      return run
+
+    if node.tag == command_e.AndOr:
+      first = self._MakeClosure(node.children[0])
+      rest = []  # (run if the status is 0, closure)
+      for op_id, child in zip(node.ops, node.children[1:]):
+        if op_id not in (Id.Op_DAmp, Id.Op_DPipe):
+          raise AssertionError(op_id)
+        rest.append((op_id == Id.Op_DAmp, self._MakeClosure(child)))
+
+      def run():
+        status = first()
+        for if_zero, child in rest:
+          if (status == 0) == if_zero:
+            status = child()
+        return finish(status)
+      return run
+
+    if node.tag == command_e.Loop:
+      cond = self._MakeClosure(node.cond)
+      body = self._MakeClosure(node.body)
+      until = node.until
+
+      def run():
+        status = 0  # if the body never runs, like other shells
+        while True:
+          if (cond() == 0) == until:
+            break
+          try:
+            status = body()
+          except _ControlFlow as e:
+            if e.IsBreak():
+              status = 0
+              break
+            elif e.IsContinue():
+              status = 0
+            else:  # return needs to pop up more
+              raise
+        return finish(status)
+      node.closure = run
+      return run
+
+    if node.tag == command_e.ForEach:
+      iter_name = node.iter_name
+      iter_args = node.iter_args
+      body = self._MakeClosure(node.body)
+      set_var = self.mem.SetSimpleVar
+      Str = runtime.Str
+
+      def run():
+        if iter_args is None:
+          iter_list = self.mem.GetArgv()
+        else:
+          iter_list = self._EvalArgs(iter_args)
+          # We need word splitting and so forth
+          # NOTE: This expands globs too.  TODO: We should pass in a Globber()
+          # object.
+        status = 0  # in case we don't loop
+        for x in iter_list:
+          set_var(iter_name, Str(x))
+          try:
+            status = body()  # last one wins
+          except _ControlFlow as e:
+            if e.IsBreak():
+              status = 0
+              break
+            elif e.IsContinue():
+              status = 0
+            else:  # return needs to pop up more
+              raise
+        return finish(status)
+      node.closure = run
+      return run
+
+    if node.tag == command_e.If:
+      # The else arm has no condition.
+      arms = [(self._MakeClosure(arm.cond) if arm.cond is not None else None,
+               self._MakeClosure(arm.action)) for arm in node.arms]
+
+      def run():
+        status = 0
+        for cond, action in arms:
+          if cond is not None:
+            status = cond()
+            if status != 0:
+              continue
+          status = action()
+          break
+        return finish(status)
+      return run
+
+    if node.tag == command_e.Case:
+      to_match_word = node.to_match
+      arms = [(arm.pat_list, self._MakeClosure(arm.action))
+              for arm in node.arms]
+
+      def run():
+        ok, val = self.ev.EvalWordToString(to_match_word)
+        assert ok
+        to_match = val.s
+
+        status = 0  # If there are no arms, it should be zero?
+        for pat_list, action in arms:
+          done = False
+          for pat_word in pat_list:
+            ok, pat_val = self.ev.EvalWordToString(pat_word, do_fnmatch=True)
+            assert ok
+            if libc.fnmatch(pat_val.s, to_match):
+              status = action()
+              done = True  # TODO: Parse ;;& and for fallthrough and such?
+          if done:
+            break
+        return finish(status)
+      return run
+
+    if node.tag == command_e.DBracket:
+      # Eval() only sets the result at the end, so the evaluator can be reused,
+      # even by nested [[ ]] in command subs.
+      bool_ev = expr_eval.BoolEvaluator(self.mem, self.ev)
+      expr = node.expr
+
+      def run():
+        if not bool_ev.Eval(expr):
+          raise AssertionError('Error evaluating boolean: %s' % bool_ev.Error())
+        return finish(0 if bool_ev.Result() else 1)
+      return run
+
+    if node.tag == command_e.DParen:
+      arith_ev = expr_eval.ArithEvaluator(self.mem, self.ev)
+      child = node.child
+
+      def run():
+        if not arith_ev.Eval(child):
+          raise AssertionError('Error evaluating (( )): %s' % arith_ev.Error())
+        # Negate the value: non-zero in arithmetic is true, which is zero in
+        # shell land
+        return finish(0 if arith_ev.Result() != 0 else 1)
+      return run
+
+    if node.tag == command_e.Redirect:
+      redir_nodes = node.redirects
+      child = self._MakeClosure(node.child)
+      return lambda: finish(self._RunRedirected(redir_nodes, child))
+
+    if node.tag == command_e.Assignment:
+      return lambda: finish(self._Assign(node))
+
+    if node.tag == command_e.NoOp:
+      return lambda: finish(0)
+
+    # ControlFlow raises, and Pipeline, Subshell, etc. fork anyway.
+    return lambda: self._Execute(node)
+
+  def _ExecuteAndCatch(self, code):
     # Use exceptions internally, but exit codes externally.
+    is_fatal = False
     try:
-      status = self._Execute(node)
+      status = self._Execute(code)
     except _ControlFlow as e:
       # TODO: Make this error message better.
       print('Break/continue/return bubbled up to top level', file=sys.stderr)
-      status = 1 
+      status = 1
+      # A script stops here, like it did when the whole file was one node.
+      is_fatal = True
     except _FatalError:
       # TODO: Nicer runtime error message.
       print(self.error_stack, file=sys.stderr)
       status = 1
+      is_fatal = True
 
     # TODO: Hook this up
     #print('break / continue can only be used inside loop')
     #status = 129  # TODO: Fix this.  Use correct macros
+    return status, is_fatal
+
+  def ExecuteAndCatch(self, node):
+    """Execute a top level LST node.
+
+    Returns:
+      status: exit code
+      is_fatal: whether there was a fatal error, so the caller shouldn't
+        execute any more top level nodes.
+    """
+    return self._ExecuteAndCatch(compile.Compile(node))
+
+  def Execute(self, node):
+    """Execute a top level LST node."""
+    status, _ = self.ExecuteAndCatch(node)
+    return status
+
+  def ExecuteCompiled(self, code):
+    """Execute an ovm node, e.g. in a subshell."""
+    status, _ = self._ExecuteAndCatch(code)
     return status
@@ -10,17 +10,24 @@ cmd_exec_test.py: Tests for cmd_exec.py
 """
 
 import os
+import shutil
+import tempfile
+import time
 import unittest
 
+from core import alloc
 from core.builtin import Builtins
 from core import cmd_exec  # module under test
+from core import compile
 from core.cmd_exec import *
 from core.id_kind import Id
+from core import process
 from core import ui
 from core import word_eval
 from core import runtime
 
 from osh import ast_ as ast
+from osh import parse_cache
 from osh import parse_lib
 
 
@@ -38,7 +45,7 @@ def InitCommandParser(code_str):
   return c_parser
 
 
-def InitExecutor():
+def InitExecutor(arena=None):
   mem = cmd_exec.Mem('', [])
   status_line = ui.NullStatusLine()
   builtins = Builtins(status_line)
@@ -46,7 +53,7 @@ def InitExecutor():
   comp_funcs = {}
   exec_opts = cmd_exec.ExecOpts()
   return cmd_exec.Executor(mem, builtins, funcs, comp_funcs, exec_opts,
-                           parse_lib.MakeParserForExecutor)
+                           parse_lib.MakeParserForExecutor, arena=arena)
 
 
 def InitEvaluator():
@@ -123,9 +130,9 @@ class ExecutorTest(unittest.TestCase):
     node3.words = [w3, w4]
 
     p = Pipeline()
-    p.Add(Process(SubProgramThunk(ex, node1)))
-    p.Add(Process(SubProgramThunk(ex, node2)))
-    p.Add(Process(SubProgramThunk(ex, node3)))
+    p.Add(Process(SubProgramThunk(ex, compile.Compile(node1))))
+    p.Add(Process(SubProgramThunk(ex, compile.Compile(node2))))
+    p.Add(Process(SubProgramThunk(ex, compile.Compile(node3))))
 
     print(p.Run())
 
@@ -212,6 +219,380 @@ class RedirectTest(unittest.TestCase):
     print('FDs AFTER', os.listdir('/dev/fd'))
 
 
+def _Run(ex, code_str):
+  c_parser = InitCommandParser(code_str)
+  node = c_parser.ParseWholeFile()
+  assert node, c_parser.Error()
+  return ex.Execute(node)
+
+
+class ClosureTest(unittest.TestCase):
+
+  def testLoops(self):
+    ex = InitExecutor()
+    status = _Run(ex, """
+for x in a b c d; do
+  if [[ $x == b ]]; then
+    continue
+  elif [[ $x == d ]]; then
+    break
+  fi
+  out=$out$x
+done
+""")
+    self.assertEqual(0, status)
+    self.assertEqual('ac', ex.mem.Get('out').s)
+
+    status = _Run(ex, 'while [[ $out != acx ]]; do out=${out}x; done')
+    self.assertEqual(0, status)  # not the status of the condition
+    self.assertEqual('acx', ex.mem.Get('out').s)
+
+    _Run(ex, 'until [[ $out == acx ]]; do out=; done')
+    self.assertEqual('acx', ex.mem.Get('out').s)
+
+    # Status of the last command in the body.
+    status = _Run(ex, 'for x in 1 2; do [[ $x == 1 ]]; done')
+    self.assertEqual(1, status)
+
+  def testLoopCompiledOnce(self):
+    ex = InitExecutor()
+    c_parser = InitCommandParser('for x in 1 2; do n=$n$x; done')
+    code = compile.Compile(c_parser.ParseCommandLine())
+    ex._Execute(code)
+    run = code.closure
+    self.assertTrue(run is not None)
+    ex._Execute(code)
+    self.assertTrue(run is code.closure)
+    self.assertEqual('1212', ex.mem.Get('n').s)
+
+  def testTopLevelControlFlow(self):
+    # The shell stops running a script at a top level break.
+    ex = InitExecutor()
+    c_parser = InitCommandParser('break')
+    node = c_parser.ParseCommandLine()
+    self.assertEqual((1, True), ex.ExecuteAndCatch(node))
+
+  def testFunc(self):
+    ex = InitExecutor()
+    status = _Run(ex, """
+f() {
+  for x in 1 2 3; do
+    case $x in
+      2) return 5 ;;
+    esac
+    (( 1 )) && n=$n$x || n=never
+  done
+}
+f; f
+""")
+    self.assertEqual(5, status)
+    self.assertEqual('11', ex.mem.Get('n').s)
+    # The body was compiled once, on the first call, and cached on the node.
+    body = ex.funcs['f'].body_closure
+    self.assertTrue(body is not None)
+    _Run(ex, 'f')
+    self.assertTrue(body is ex.funcs['f'].body_closure)
+
+
+class BuiltinTest(unittest.TestCase):
+
+  def testOrder(self):
+    ex = InitExecutor()
+    # Functions can redefine regular builtins, but not special ones.
+    status = _Run(ex, """
+cd() { x=func; }
+eval() { y=func; }
+cd /
+eval 'y=builtin'
+""")
+    self.assertEqual(0, status)
+    self.assertEqual('func', ex.mem.Get('x').s)
+    self.assertEqual('builtin', ex.mem.Get('y').s)
+
+  def testExport(self):
+    ex = InitExecutor()
+    status = _Run(ex, """
+f() { export GLOBAL=X; }
+f
+export -n PWD
+""")
+    self.assertEqual(0, status)
+    self.assertEqual('X', ex.mem.Get('GLOBAL').s)
+    env = ex.mem.GetExported()
+    self.assertEqual('X', env['GLOBAL'])
+    self.assertFalse('PWD' in env)
+
+  def testPrefixBinding(self):
+    # FOO=x cmd only sets FOO for cmd.
+    ex = InitExecutor()
+    old_home = ex.mem.GetExported()['HOME']
+    status = _Run(ex, 'HOME=/x FOO=$HOME/y true')
+    self.assertEqual(0, status)
+    env = ex.mem.GetExported()
+    self.assertEqual(old_home, env['HOME'])
+    self.assertFalse('FOO' in env)
+    self.assertEqual(value_e.Undef, ex.mem.Get('FOO').tag)
+
+    # Bindings can refer to earlier ones.
+    more_env = ex._EvalEnv(
+        InitCommandParser('HOME=/x FOO=$HOME/y true').ParseCommandLine()
+        .more_env)
+    self.assertEqual({'HOME': '/x', 'FOO': '/x/y'}, more_env)
+
+    # A function sees the binding while it runs.
+    _Run(ex, 'f() { out=$FOO; }; FOO=x f')
+    self.assertEqual('x', ex.mem.Get('out').s)
+    self.assertEqual(value_e.Undef, ex.mem.Get('FOO').tag)
+    self.assertFalse('FOO' in ex.mem.GetExported())
+
+
+class SourceTest(unittest.TestCase):
+
+  def testArena(self):
+    tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmp_dir)
+    path = os.path.join(tmp_dir, 'lib.sh')
+    with open(path, 'w') as f:
+      f.write('f() {\n  echo hi\n}\n')
+
+    arena = alloc.Pool().NewArena()
+    arena.AddSourcePath('<test>')
+    ex = InitExecutor(arena=arena)
+    ex.parse_cache = parse_cache.ParseCache(os.path.join(tmp_dir, 'cache'))
+    self.assertEqual(0, _Run(ex, 'source %s' % path))
+
+    # The sourced lines and spans are in the arena, and later lines are from
+    # the outer file again.
+    self.assertEqual(['<test>', path], arena.src_paths)
+    self.assertEqual(0, arena.SourceIndex())
+    num_spans = arena.NumSpans()
+    self.assertTrue(num_spans > 0)
+    func_defs = ex.TakeSourcedFuncDefs()
+    self.assertEqual(['f'], [func_def.name for func_def in func_defs])
+    self.assertEqual([], ex.TakeSourcedFuncDefs())
+
+    # The cache entry has the spans too.
+    arena2 = alloc.Pool().NewArena()
+    self.assertTrue(ex.parse_cache.Load(path, arena=arena2))
+    self.assertEqual(num_spans, arena2.NumSpans())
+
+    # Loading from the cache also adds them.
+    self.assertEqual(0, _Run(ex, 'source %s' % path))
+    self.assertEqual(2 * num_spans, arena.NumSpans())
+    self.assertEqual(0, arena.SourceIndex())
+
+    # Lines of another file are attributed to it.
+    path2 = os.path.join(tmp_dir, 'lib2.sh')
+    with open(path2, 'w') as f:
+      f.write('x=1\n')
+    self.assertEqual(0, _Run(ex, 'source %s' % path2))
+    line_id = arena.GetLineSpan(arena.NumSpans() - 1).line_id
+    self.assertEqual((path2, 0), arena.GetDebugInfo(line_id))
+
+
+class CommandHashTest(unittest.TestCase):
+
+  def testLookup(self):
+    mem = cmd_exec.Mem('', [], environ={'PATH': '/nonexistent:/bin'})
+    h = cmd_exec.CommandHash(mem)
+    self.assertEqual('/bin/sh', h.Lookup('sh'))
+    self.assertEqual(True, h.IsHashed('sh'))
+    self.assertEqual(['/bin/sh'], [path for _, path in h.Items()])
+
+    # Failures aren't cached.  Paths with / aren't searched.
+    self.assertEqual(None, h.Lookup('nonexistent-command'))
+    self.assertEqual(False, h.IsHashed('nonexistent-command'))
+    self.assertEqual('./foo', h.Lookup('./foo'))
+
+    # Assigning to PATH invalidates the table.
+    mem.SetGlobalString(ast.LeftVar('PATH'), '/nonexistent')
+    self.assertEqual(False, h.IsHashed('sh'))
+    self.assertEqual(None, h.Lookup('sh'))
+
+    mem.SetGlobalString(ast.LeftVar('PATH'), '/bin')
+    h.Lookup('sh')
+    h.Clear()
+    self.assertEqual(False, h.IsHashed('sh'))
+
+
+class SpawnTest(unittest.TestCase):
+
+  def testSpawn(self):
+    path = '/tmp/spawn_test.txt'
+    fd_state = FdState()
+    thunk = ExternalThunk(['echo', 'spawned'], path='/bin/echo')
+    p = Process(thunk, fd_state=fd_state,
+                redirects=[FilenameRedirect(Id.Redir_Great, -1, path),
+                           DescriptorRedirect(Id.Redir_GreatAnd, 2, 1)])
+    actions = p._GetSpawnActions()
+    self.assertEqual(2, len(actions))
+    self.assertEqual(0, p.Run())
+    with open(path) as f:
+      self.assertEqual('spawned\n', f.read())
+
+    # Without a resolved path, we fork and search $PATH.
+    p = Process(ExternalThunk(['true']), fd_state=fd_state)
+    self.assertEqual(None, p._GetSpawnActions())
+    self.assertEqual(0, p.Run())
+
+    # Internal thunks run Python in the child.
+    ex = InitExecutor()
+    p = Process(SubProgramThunk(ex, None), fd_state=fd_state)
+    self.assertEqual(None, p._GetSpawnActions())
+
+
+class JobTest(unittest.TestCase):
+
+  def testPipelineStatus(self):
+    # Statuses are in order, even though the first process exits last.
+    pi = Pipeline()
+    fd_state = FdState()
+    pi.Add(Process(ExternalThunk(['sh', '-c', 'sleep 0.1; exit 3']),
+                   fd_state=fd_state))
+    pi.Add(Process(ExternalThunk(['sh', '-c', 'exit 4']), fd_state=fd_state))
+    pi.Add(Process(ExternalThunk(['true']), fd_state=fd_state))
+    self.assertEqual([3, 4, 0], pi.Run())
+
+  def testWait(self):
+    ex = InitExecutor()
+    _Run(ex, 'sh -c "exit 3" & x=$!; ( exit 4 ) & y=$!')
+    self.assertEqual(2, len(ex.jobs))
+    self.assertEqual(4, _Run(ex, 'wait $y'))
+    self.assertEqual(3, _Run(ex, 'wait $x'))
+    self.assertEqual(127, _Run(ex, 'wait $x'))  # already waited for
+
+    # A child reaped by the SIGCHLD handler.
+    p = Process(ExternalThunk(['sh', '-c', 'exit 5']), fd_state=FdState())
+    pid = p.Start()
+    _, status = os.waitpid(pid, 0)
+    process.JOB_STATE.statuses[pid] = process._DecodeStatus(status)
+    self.assertEqual(5, p.Poll())
+    self.assertEqual(5, p.Wait())
+
+  def testStatusesDropped(self):
+    job_state = process.JOB_STATE
+    # The here doc writer for a builtin is waited for when its redirects are
+    # undone.
+    ex = InitExecutor()
+    _Run(ex, 'read x <<EOF\nhi\nEOF\n')
+    self.assertEqual('hi', ex.mem.Get('x').s)
+    self.assertEqual(set(), job_state.pids)
+    self.assertEqual({}, job_state.statuses)
+
+    # A child that nobody waits for.
+    pid = os.fork()
+    if pid == 0:
+      os._exit(0)
+    _, status = os.waitpid(pid, 0)
+    job_state._Save(pid, status)
+    self.assertEqual({}, job_state.statuses)
+
+  def testWaitNext(self):
+    ex = InitExecutor()
+    _Run(ex, 'sleep 0.2 & ( sleep 0.1; exit 4 ) &')
+    self.assertEqual(4, _Run(ex, 'wait -n'))
+    self.assertEqual(0, _Run(ex, 'wait -n'))
+    self.assertEqual(127, _Run(ex, 'wait -n'))  # no jobs
+
+  def testMaxJobs(self):
+    ex = InitExecutor()
+    start = time.time()
+    _Run(ex, 'OSH_MAX_JOBS=2; for i in 1 2 3; do sleep 0.2 & done')
+    # The third one waited for a slot.
+    self.assertTrue(time.time() - start >= 0.2)
+    self.assertTrue(ex._NumRunning() <= 2)
+    # The first job to finish was moved out of the table, but its status is
+    # kept for 'wait'.
+    self.assertEqual(3, len(ex.jobs) + len(ex.job_statuses))
+    self.assertTrue(ex.job_statuses)
+    self.assertEqual(0, _Run(ex, 'wait'))
+    self.assertEqual(0, len(ex.jobs))
+    self.assertEqual(0, len(ex.job_statuses))
+
+    # 'wait $pid' and 'wait -n' return the status of a pruned job.
+    _Run(ex, 'sh -c "exit 3" & x=$!; sh -c "exit 4" & y=$!')
+    process.JOB_STATE.WaitUntil(lambda: ex._NumRunning() == 0)
+    self.assertEqual(0, len(ex.jobs))
+    self.assertEqual(4, _Run(ex, 'wait $y'))
+    self.assertEqual(3, _Run(ex, 'wait -n'))
+    self.assertEqual(127, _Run(ex, 'wait $x'))
+
+
+class LastPipeTest(unittest.TestCase):
+
+  def testLastPipe(self):
+    ex = InitExecutor()
+    _Run(ex, 'echo a | read x')
+    self.assertEqual(runtime.value_e.Undef, ex.mem.Get('x').tag)  # forked
+
+    _Run(ex, 'shopt -s lastpipe')
+    status = _Run(ex, 'seq 3 | while read i; do last=$i; done')
+    self.assertEqual(0, status)
+    self.assertEqual('3', ex.mem.Get('last').s)
+
+    self.assertEqual(1, _Run(ex, 'true | false'))
+    self.assertEqual(0, _Run(ex, 'false | true'))
+
+    # stdin is restored.
+    stdin_ino = os.fstat(0).st_ino
+    _Run(ex, 'echo b | { read y; }')
+    self.assertEqual('b', ex.mem.Get('y').s)
+    self.assertEqual(stdin_ino, os.fstat(0).st_ino)
+
+  def testReadLine(self):
+    # read doesn't consume more than a line, from a file or a pipe.
+    path = '/tmp/read_line_test.txt'
+    with open(path, 'w') as f:
+      f.write('a\nb\n')
+    fd = os.open(path, os.O_RDONLY)
+    self.assertEqual('a\n', cmd_exec._ReadLine(fd))
+    self.assertEqual(b'b\n', os.read(fd, 100))
+    os.close(fd)
+
+    r, w = os.pipe()
+    os.write(w, b'c\nd')
+    os.close(w)
+    self.assertEqual('c\n', cmd_exec._ReadLine(r))
+    self.assertEqual('d', cmd_exec._ReadLine(r))
+    self.assertEqual('', cmd_exec._ReadLine(r))
+    os.close(r)
+
+
+class CommandSubTest(unittest.TestCase):
+
+  def testInProcess(self):
+    ex = InitExecutor()
+    _Run(ex, 'f() { x=changed; cd /; echo "f $1"; }; x=orig')
+    cwd = os.getcwd()
+
+    _Run(ex, 'out=$(f arg)')
+    self.assertEqual('f arg', ex.mem.Get('out').s)
+    # Changes are undone, like in a subshell.
+    self.assertEqual('orig', ex.mem.Get('x').s)
+    self.assertEqual(cwd, os.getcwd())
+    self.assertEqual(0, ex.capture_depth)
+
+    # exit only ends the command sub.
+    _Run(ex, 'g() { echo a; exit 3; echo b; }; out=$(g)')
+    self.assertEqual('a', ex.mem.Get('out').s)
+
+    # Nested, and with external commands writing to the same stdout.
+    _Run(ex, 'out=$(echo "<$(echo inner)>")')
+    self.assertEqual('<inner>', ex.mem.Get('out').s)
+    _Run(ex, 'h() { echo a; sh -c "echo b"; }; out=$(h)')
+    self.assertEqual('a\nb', ex.mem.Get('out').s)
+
+  def testCanCapture(self):
+    ex = InitExecutor()
+    _Run(ex, 'f() { echo; }')
+    for code_str, expected in [
+        ('f x', True), ('echo $x', True), ('"f" x', True),
+        ('ls', False), ('$x', False), ('f; f', False), ('f | f', False)]:
+      c_parser = InitCommandParser(code_str)
+      code = compile.Compile(c_parser.ParseWholeFile())
+      self.assertEqual(expected, ex._CanCaptureInProcess(code), code_str)
+
+
 class MemTest(unittest.TestCase):
 
   def testGet(self):
@@ -221,6 +602,77 @@ class MemTest(unittest.TestCase):
     mem.Pop()
     print(mem.Get('NONEXISTENT'))
 
+  def testScopes(self):
+    mem = cmd_exec.Mem('', [], environ={'HOME': '/home/andy'})
+    self.assertEqual('/home/andy', mem.Get('HOME').s)
+    self.assertEqual(runtime.value_e.Undef, mem.Get('x').tag)
+
+    mem.SetGlobalString(ast.LeftVar('x'), 'global')
+    mem.Push([])
+    mem.SetLocal([(ast.LeftVar('x'), runtime.Str('local'))], 0)
+    mem.SetSimpleVar('y', runtime.Str('local'))
+    self.assertEqual('local', mem.Get('x').s)
+
+    # Dynamic scope: locals of callers are visible.
+    mem.Push([])
+    self.assertEqual('local', mem.Get('x').s)
+    # Setting a global doesn't unshadow the local.
+    mem.SetGlobalString(ast.LeftVar('x'), 'global2')
+    self.assertEqual('local', mem.Get('x').s)
+    mem.Pop()
+
+    mem.Pop()
+    self.assertEqual('global2', mem.Get('x').s)
+    self.assertEqual(runtime.value_e.Undef, mem.Get('y').tag)
+
+    # Variables set after a call go in the global scope.
+    mem.SetSimpleVar('z', runtime.Str('z'))
+    self.assertEqual(True, mem.GetGlobal('z')[0])
+
+  def testExported(self):
+    mem = cmd_exec.Mem('', [], environ={'HOME': '/home/andy'})
+    env = mem.GetExported()
+    self.assertEqual('/home/andy', env['HOME'])
+
+    # Cached until an exported variable changes.
+    mem.SetGlobalString(ast.LeftVar('x'), 'x')
+    self.assertTrue(env is mem.GetExported())
+    self.assertFalse('x' in env)
+
+    # Assigning keeps it exported.
+    mem.SetGlobalString(ast.LeftVar('HOME'), '/')
+    env = mem.GetExported()
+    self.assertEqual('/', env['HOME'])
+
+    # A local that shadows an exported variable is exported.
+    mem.Push([])
+    mem.SetLocal([(ast.LeftVar('HOME'), runtime.Str('/tmp'))], 0)
+    self.assertEqual('/tmp', mem.GetExported()['HOME'])
+    mem.Pop()
+    self.assertEqual('/', mem.GetExported()['HOME'])
+
+    mem.SetExported('x', True)
+    self.assertEqual('x', mem.GetExported()['x'])
+    mem.SetExported('x', False)
+    self.assertFalse('x' in mem.GetExported())
+
+  def testSnapshot(self):
+    mem = cmd_exec.Mem('', ['a'], environ={})
+    mem.SetGlobalString(ast.LeftVar('x'), 'x')
+    snapshot = mem.Snapshot()
+
+    mem.SetGlobalString(ast.LeftVar('x'), 'changed')
+    mem.SetGlobalString(ast.LeftVar('y'), 'y')
+    mem.Push(['b'])
+    mem.SetLocal([(ast.LeftVar('x'), runtime.Str('local'))], 0)
+
+    mem.Restore(snapshot)
+    self.assertEqual('x', mem.Get('x').s)
+    self.assertEqual(runtime.value_e.Undef, mem.Get('y').tag)
+    self.assertEqual(['a'], mem.GetArgv())
+    mem.SetGlobalString(ast.LeftVar('z'), 'z')
+    self.assertEqual('z', mem.Get('z').s)
+
 
 class ExpansionTest(unittest.TestCase):
 
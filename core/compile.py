@@ -1,10 +1,28 @@
+#!/usr/bin/env python3
 """
 compile.py: osh.asdl -> ovm.asdl
 
-Things the compiler should do:
+The executor runs the output, so it doesn't have to deal with nodes that only
+exist to preserve syntax.  What the compiler does:
+
+- AndOr is parsed with right recursion.  It's flattened into a list, which is
+  executed left to right: a && b || c is (a && b) || c, like other shells.
+
+- DoGroup/BraceGroup/CommandList are compiled to CommandSeq, and nested ones
+  are merged.  Their redirects, and those of other compound commands, go in a
+  separate Redirect node.
+
+- Sentence is compiled away, or to Fork() if it ends with &.
+
+- while/until are compiled to Loop.
 
-- AndOr is parsed with right recursion?  So expand that into a list?  Or
-  execute with left recursion?
+- else_action in If is compiled to a last arm without a condition.
+
+- constant folding: words made only of literals and quotes are folded to
+  strings, after brace expansion.  NOTE: Unquoted literals aren't split with
+  $IFS then, like other shells.
+
+Things the compiler should do:
 
 - assignments need to be desugared into a lot of differrent things.
   - for now everything is Dynamic?  ONLY hash tables.
@@ -12,42 +30,204 @@ Things the compiler should do:
   - oil will have a proper compiler I think.  It can do stack analysis.
     Because it requires "global" and so forth.
 
-- while/until compiled to same thing.
-  - maybe
-
-- DoGroup/BraceGroup compiled to same thing
-  - CommandList might be removed later
-
-- Sentence is compiled to Fork(), or nothing for ;
-
-- else_action in If should be compiled uniformly
 - might want to also compile case/if to same thing
 
 - [[ ]] and arith languages will have grouping parens for printing.  Eliminate
   those and use tree structure.
 
-- constant folding:
-  - especially of literal strings, concatenating escapes, etc.
+- constant folding of escapes in here docs, etc.
 
 - maybe compile differently based on module-level :option
 
 - not sure if redirects need to be separate into primitive push/pop
-
-
-
-
 """
 
-import sys
-
-
-def main(argv):
-  print 'Hello from compile.py'
-
-
-if __name__ == '__main__':
-  try:
-    main(sys.argv)
-  except RuntimeError as e:
-    print >>sys.stderr, 'FATAL: %s' % e
-    sys.exit(1)
+import re
+
+from core import braces
+from core import ovm
+from core.id_kind import Id
+
+from osh import ast_ as ast
+
+command_e = ast.command_e
+word_e = ast.word_e
+word_part_e = ast.word_part_e
+
+# Unquoted literals with these are globbed at runtime.
+_GLOB_CHARS_RE = re.compile(r'[*?[]')
+
+
+def _FoldPart(part, quoted):
+  """Return the value of a word part made of literals, or None."""
+  if part.tag == word_part_e.LiteralPart:
+    s = part.token.val
+    if not quoted and _GLOB_CHARS_RE.search(s):
+      return None
+    return s
+
+  if part.tag == word_part_e.EscapedLiteralPart:
+    return part.token.val[1]  # e.g. \*
+
+  if part.tag == word_part_e.SingleQuotedPart:
+    return ''.join(t.val for t in part.tokens)
+
+  if part.tag == word_part_e.DoubleQuotedPart:
+    strs = []
+    for p in part.parts:
+      s = _FoldPart(p, True)
+      if s is None:
+        return None
+      strs.append(s)
+    return ''.join(strs)
+
+  return None  # substitutions, etc.
+
+
+def FoldWord(w):
+  """Return the string a word always evaluates to, or None."""
+  if w.tag != word_e.CompoundWord or not w.parts:
+    return None
+  strs = []
+  for part in w.parts:
+    s = _FoldPart(part, False)
+    if s is None:
+      return None
+    strs.append(s)
+  return ''.join(strs)
+
+
+def _CompileWords(words):
+  """
+  Returns:
+    ovm.args, with braces expanded, and folded if possible.
+  """
+  words = braces.BraceExpandWords(words)
+  strs = []
+  for w in words:
+    s = FoldWord(w)
+    if s is None:
+      return ovm.WordArgs(words)
+    strs.append(s)
+  return ovm.ConstArgs(strs)
+
+
+def _CompileSeq(children):
+  """Compile a list of commands to a CommandSeq, merging nested ones."""
+  out = []
+  for child in children:
+    c = Compile(child)
+    if c.tag == ovm.command_e.CommandSeq:
+      out.extend(c.children)
+    else:
+      out.append(c)
+  if len(out) == 1:
+    return out[0]
+  return ovm.CommandSeq(out)
+
+
+def _FlattenAndOr(node, children, ops):
+  for i, child in enumerate(node.children):
+    if i != 0:
+      ops.append(node.op_id)
+    if child.tag == command_e.AndOr:
+      _FlattenAndOr(child, children, ops)
+    else:
+      children.append(Compile(child))
+
+
+def _WithRedirects(node, c):
+  if node.redirects:
+    return ovm.Redirect(c, node.redirects)
+  return c
+
+
+def Compile(node):
+  """
+  Args:
+    node: ast.command
+
+  Returns:
+    ovm.command
+  """
+  if node.tag == command_e.SimpleCommand:
+    return ovm.SimpleCommand(_CompileWords(node.words), node.redirects,
+                             node.more_env)
+
+  if node.tag == command_e.Sentence:
+    if node.terminator.id == Id.Op_Amp:
+      return ovm.Fork(Compile(node.command))
+    return Compile(node.command)
+
+  if node.tag == command_e.CommandList:
+    return _CompileSeq(node.children)
+
+  if node.tag == command_e.BraceGroup:
+    return _WithRedirects(node, _CompileSeq(node.children))
+
+  if node.tag == command_e.DoGroup:
+    return _WithRedirects(node, _CompileSeq([node.child]))
+
+  if node.tag == command_e.AndOr:
+    children = []
+    ops = []
+    _FlattenAndOr(node, children, ops)
+    return ovm.AndOr(children, ops)
+
+  if node.tag in (command_e.While, command_e.Until):
+    c = ovm.Loop(Compile(node.cond), Compile(node.body),
+                 node.tag == command_e.Until)
+    return _WithRedirects(node, c)
+
+  if node.tag == command_e.If:
+    arms = [ovm.if_arm(Compile(arm.cond), Compile(arm.action))
+            for arm in node.arms]
+    if node.else_action is not None:
+      arms.append(ovm.if_arm(None, Compile(node.else_action)))
+    return _WithRedirects(node, ovm.If(arms))
+
+  if node.tag == command_e.ForEach:
+    if node.do_arg_iter:
+      iter_args = None
+    else:
+      iter_args = _CompileWords(node.iter_words)
+    c = ovm.ForEach(node.iter_name, iter_args, Compile(node.body))
+    return _WithRedirects(node, c)
+
+  if node.tag == command_e.Case:
+    arms = [ovm.case_arm(arm.pat_list, Compile(arm.action))
+            for arm in node.arms]
+    return _WithRedirects(node, ovm.Case(node.to_match, arms))
+
+  if node.tag == command_e.Pipeline:
+    return ovm.Pipeline([Compile(child) for child in node.children],
+                        node.negated)
+
+  if node.tag == command_e.Subshell:
+    return _WithRedirects(node, ovm.Subshell(_CompileSeq(node.children)))
+
+  if node.tag == command_e.DBracket:
+    return _WithRedirects(node, ovm.DBracket(node.expr))
+
+  if node.tag == command_e.DParen:
+    return _WithRedirects(node, ovm.DParen(node.child))
+
+  if node.tag == command_e.Assignment:
+    return ovm.Assignment(node.keyword, node.pairs)
+
+  if node.tag == command_e.ControlFlow:
+    return ovm.ControlFlow(node.token, node.arg_word)
+
+  if node.tag == command_e.FuncDef:
+    # Redirects apply each time the function is called.
+    return ovm.FuncDef(node.name, _WithRedirects(node, Compile(node.body)))
+
+  if node.tag == command_e.ForExpr:
+    body = Compile(node.body) if node.body is not None else None
+    c = ovm.ForExpr(node.init, node.cond, node.update, body)
+    return _WithRedirects(node, c)
+
+  if node.tag == command_e.NoOp:
+    return ovm.NoOp()
+
+  raise AssertionError(node.tag)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+compile_test.py: Tests for compile.py
+"""
+
+import unittest
+
+from core import compile  # module under test
+from core import ovm
+from core.id_kind import Id
+
+from osh import cmd_parse_test
+
+command_e = ovm.command_e
+args_e = ovm.args_e
+
+
+def _Compile(code_str):
+  _, c_parser = cmd_parse_test.InitCommandParser(code_str)
+  node = c_parser.ParseWholeFile()
+  assert node, code_str
+  code = compile.Compile(node)
+  print(code)
+  return code
+
+
+class CompileTest(unittest.TestCase):
+
+  def testConstantFolding(self):
+    code = _Compile("echo a 'b c' \"d\" e\\*f {g,h}i")
+    self.assertEqual(command_e.SimpleCommand, code.tag)
+    self.assertEqual(args_e.ConstArgs, code.args.tag)
+    self.assertEqual(['echo', 'a', 'b c', 'd', 'e*f', 'gi', 'hi'],
+                     code.args.strs)
+
+    # Substitutions and globs are evaluated at runtime.
+    for code_str in ('echo $x', 'echo *.py', 'echo "$x"', 'echo ~'):
+      code = _Compile(code_str)
+      self.assertEqual(args_e.WordArgs, code.args.tag, code_str)
+
+  def testAndOr(self):
+    code = _Compile('a && b || c && d')
+    self.assertEqual(command_e.AndOr, code.tag)
+    self.assertEqual(4, len(code.children))
+    self.assertEqual([Id.Op_DAmp, Id.Op_DPipe, Id.Op_DAmp], code.ops)
+
+  def testCommandSeq(self):
+    code = _Compile('a; { b; c; }; d')
+    self.assertEqual(command_e.CommandSeq, code.tag)
+    self.assertEqual(4, len(code.children))
+
+    code = _Compile('for i in 1 2; do a; b; done')
+    self.assertEqual(command_e.ForEach, code.tag)
+    self.assertEqual(['1', '2'], code.iter_args.strs)
+    self.assertEqual(command_e.CommandSeq, code.body.tag)
+    self.assertEqual(2, len(code.body.children))
+
+  def testLoop(self):
+    code = _Compile('while a; do b; done')
+    self.assertEqual(command_e.Loop, code.tag)
+    self.assertEqual(False, code.until)
+
+    code = _Compile('until a; do b; done')
+    self.assertEqual(command_e.Loop, code.tag)
+    self.assertEqual(True, code.until)
+
+  def testIf(self):
+    code = _Compile('if a; then b; elif c; then d; else e; fi')
+    self.assertEqual(command_e.If, code.tag)
+    self.assertEqual(3, len(code.arms))
+    self.assertEqual(None, code.arms[2].cond)
+
+  def testFork(self):
+    code = _Compile('a & b')
+    self.assertEqual(command_e.CommandSeq, code.tag)
+    self.assertEqual(command_e.Fork, code.children[0].tag)
+    self.assertEqual(command_e.SimpleCommand, code.children[0].child.tag)
+    self.assertEqual(command_e.SimpleCommand, code.children[1].tag)
+
+    code = _Compile('a; b')
+    self.assertEqual(command_e.SimpleCommand, code.children[0].tag)
+
+  def testRedirect(self):
+    code = _Compile('{ a; b; } > out.txt')
+    self.assertEqual(command_e.Redirect, code.tag)
+    self.assertEqual(command_e.CommandSeq, code.child.tag)
+
+    # Function redirects apply to each call.
+    code = _Compile('f() { a; } > out.txt')
+    self.assertEqual(command_e.FuncDef, code.tag)
+    self.assertEqual(command_e.Redirect, code.body.tag)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -581,6 +581,7 @@ class RootCompleter(object):
     w_parser, c_parser = self.make_parser(buf)
     comp_type, prefix, comp_words = _GetCompletionType(
         w_parser, c_parser, self.ev, status_lines)
+    parse_lib.ReleaseParser(c_parser)
 
     comp_type, prefix, comp_words = _GetCompletionType1(self.parser, buf)
 
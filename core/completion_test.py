@@ -12,6 +12,7 @@ completion_test.py: Tests for completion.py
 import unittest
 
 from core import cmd_exec
+from core import compile
 from core import lexer
 from core import word_eval
 from core import ui
@@ -59,6 +60,7 @@ class CompletionTest(unittest.TestCase):
   def testShellFuncExecution(self):
     ex = cmd_exec_test.InitExecutor()
     func_node = ast.FuncDef()
+    func_node.name = 'myfunc'
 
     c1 = ast.CompoundWord()
     t1 = ast.token(Id.Lit_Chars, 'f1')
@@ -79,7 +81,7 @@ class CompletionTest(unittest.TestCase):
 
     func_node.body = body_node
 
-    a = completion.ShellFuncAction(ex, func_node)
+    a = completion.ShellFuncAction(ex, compile.Compile(func_node))
     matches = (list(a.Matches([], 0, 'f')))
     self.assertEqual(['f1 ', 'f2 '], matches)
 
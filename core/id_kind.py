@@ -9,42 +9,42 @@
 id_kind.py - Id and Kind definitions, used for Token, Word, Nodes, etc.
 """
 
+import hashlib
+import importlib
+
 from core import util
 
 
-_ID_TO_KIND = {}  # type: dict
+_ID_TO_KIND = [None]  # type: list  # Id value -> Kind; 0 is unused
 
 def LookupKind(id_):
   return _ID_TO_KIND[id_]
 
 
-_ID_NAMES = {}  # type: dict
+_ID_NAMES = [None]  # type: list  # Id value -> name; 0 is unused
 
 def IdName(id_):
   return _ID_NAMES[id_]
 
 
-class Id(object):
+class Id(int):
   """Token and op type.
 
   The evaluator must consider all Ids.
-  """
-  def __init__(self, enum_value):
-    self.enum_value = enum_value
 
-  def __eq__(self, other):
-    # NOTE: We need to compare to ints too because of the ID hash tables.  They
-    # are keyed by index, and then an equality test happens.
-    if isinstance(other, int):
-      return self.enum_value == other
-
-    return self.enum_value == other.enum_value
+  It's an int, so comparisons, hashing, and the LookupKind()/IdName() list
+  indexing happen in C.  Only __repr__ is ours.
+  """
+  __slots__ = ()
 
-  def __hash__(self):
-    return hash(self.enum_value)
+  @property
+  def enum_value(self):
+    return int(self)
 
   def __repr__(self):
-    return IdName(self.enum_value)
+    return _ID_NAMES[self]
+
+  __str__ = __repr__
 
 
 class Kind(object):
@@ -58,8 +58,8 @@ class IdSpec(object):
   def __init__(self, token_names, kind_lookup, bool_ops):
     self.id_enum = Id
     self.kind_enum = Kind
-    self.token_names = token_names  # integer -> string Id
-    self.kind_lookup = kind_lookup  # Id -> Kind
+    self.token_names = token_names  # list: integer -> string Id
+    self.kind_lookup = kind_lookup  # list: Id -> Kind
 
     self.kind_sizes = []  # stats
 
@@ -77,8 +77,8 @@ class IdSpec(object):
     self.token_index += 1  # leave out 0 I guess?
     id_val = Id(self.token_index)
     setattr(self.id_enum, token_name, id_val)
-    self.token_names[self.token_index] = token_name
-    self.kind_lookup[self.token_index] = self.kind_index
+    self.token_names.append(token_name)
+    self.kind_lookup.append(self.kind_index)
     return id_val
 
   def _AddKind(self, kind_name):
@@ -141,6 +141,32 @@ class IdSpec(object):
   def AddBoolOp(self, id_, arg_type):
     self.bool_ops[id_] = arg_type
 
+  def LoadTable(self, table):
+    """Fill in the spec from the constants that id_kind_gen.py generated.
+
+    This gives the same result as the Add*() calls, without running them.
+    """
+    ids = []
+    for i, token_name in enumerate(table.ID_NAMES):
+      self.token_index = i + 1
+      id_val = Id(self.token_index)
+      setattr(self.id_enum, token_name, id_val)
+      self.token_names.append(token_name)
+      self.kind_lookup.append(table.ID_KINDS[i])
+      ids.append(id_val)
+
+    for i, kind_name in enumerate(table.KIND_NAMES):
+      setattr(self.kind_enum, kind_name, i)
+    self.kind_index = len(table.KIND_NAMES)
+    self.kind_sizes.extend(table.KIND_SIZES)
+
+    for kind, pairs in table.LEXER_PAIRS.items():
+      self.lexer_pairs[kind] = [
+          (False, char_pat, ids[id_val - 1]) for char_pat, id_val in pairs]
+
+    for id_val, type_name in table.BOOL_OPS.items():
+      self.AddBoolOp(ids[id_val - 1], getattr(OperandType, type_name))
+
 
 def _AddKinds(spec):
   # TODO: Unknown_Tok is OK, but Undefined_Id is better
@@ -405,10 +431,31 @@ def _AddBoolKinds(spec):
 #
 
 
+def SourceDigest():
+  """Identifies this file, which the generated table must match."""
+  with open(__file__, 'rb') as f:
+    return hashlib.sha1(f.read()).hexdigest()
+
+
+def _ImportTable():
+  """Return the table generated by './build.sh py-asdl', or None."""
+  try:
+    table = importlib.import_module('_devbuild.gen.id_kind_table')
+  except ImportError:
+    return None
+  if table.SOURCE_DIGEST != SourceDigest():
+    return None  # this file changed since
+  return table
+
+
 ID_SPEC = IdSpec(_ID_NAMES, _ID_TO_KIND, BOOL_OPS)
 
-_AddKinds(ID_SPEC)
-_AddBoolKinds(ID_SPEC)  # must come second
+_table = _ImportTable()
+if _table:
+  ID_SPEC.LoadTable(_table)
+else:
+  _AddKinds(ID_SPEC)
+  _AddBoolKinds(ID_SPEC)  # must come second
 
 # Debug
 _kind_sizes = ID_SPEC.kind_sizes
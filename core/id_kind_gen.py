@@ -12,6 +12,7 @@ id_kind_gen.py - Code generation for id_kind.py.
 import sys
 
 from asdl.gen_cpp import FormatLines
+from core import id_kind
 from core.id_kind import Id, Kind, LookupKind
 
 
@@ -75,6 +76,63 @@ def GenCppCode(kind_names, id_names, f, id_labels=None, kind_labels=None):
   }
   """)
 
+def GenPyTable(spec, f):
+  """Write the tables of an IdSpec as Python constants.
+
+  id_kind.py loads them instead of building the spec, if they're up to date.
+  """
+  Emit('"""', f)
+  Emit('Generated by core/id_kind_gen.py from core/id_kind.py.  Don\'t edit.',
+       f)
+  Emit('"""', f)
+  Emit('', f)
+  Emit('SOURCE_DIGEST = %r' % id_kind.SourceDigest(), f)
+  Emit('', f)
+
+  # Id values start at 1, and kinds at 0.
+  num_ids = len(spec.token_names) - 1
+  Emit('ID_NAMES = (', f)
+  for i in range(1, num_ids + 1):
+    Emit('%r,' % spec.token_names[i], f, 1)
+  Emit(')', f)
+  Emit('', f)
+
+  Emit('ID_KINDS = (', f)
+  kinds = [str(spec.kind_lookup[i]) for i in range(1, num_ids + 1)]
+  Emit(', '.join(kinds), f, 1)
+  Emit(')', f)
+  Emit('', f)
+
+  kind_names = sorted(
+      (k, name) for name, k in vars(spec.kind_enum).items()
+      if name[0].isupper())
+  Emit('KIND_NAMES = (', f)
+  for _, name in kind_names:
+    Emit('%r,' % name, f, 1)
+  Emit(')', f)
+  Emit('', f)
+
+  Emit('KIND_SIZES = %r' % (spec.kind_sizes, ), f)
+  Emit('', f)
+
+  # Kind -> [(regex, Id value), ...]
+  Emit('LEXER_PAIRS = {', f)
+  for kind, pairs in sorted(spec.lexer_pairs.items()):
+    Emit('%d: [' % kind, f, 1)
+    for _, char_pat, id_val in pairs:
+      Emit('(%r, %d),' % (char_pat, id_val.enum_value), f, 2)
+    Emit('],', f, 1)
+  Emit('}', f)
+  Emit('', f)
+
+  # Id value -> OperandType name
+  Emit('BOOL_OPS = {', f)
+  for id_val, arg_type in sorted(spec.bool_ops.items(),
+                                 key=lambda p: p[0].enum_value):
+    Emit('%d: %r,' % (id_val.enum_value, arg_type.name), f, 1)
+  Emit('}', f)
+
+
 def main(argv):
   try:
     action = argv[1]
@@ -149,6 +207,9 @@ def main(argv):
     GenCppCode(kind_names, id_names, sys.stdout,
                id_labels=id_labels, kind_labels=kind_labels)
 
+  elif action == 'py':
+    GenPyTable(id_kind.ID_SPEC, sys.stdout)
+
   else:
     raise RuntimeError('Invalid action %r' % action)
 
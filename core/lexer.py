@@ -10,6 +10,10 @@ lexer.py - Library for lexing.
 """
 
 import re
+try:
+  from re import _parser as sre_parse  # Python 3.11+
+except ImportError:
+  import sre_parse
 
 from core import util
 from core.id_kind import Id, IdName
@@ -52,18 +56,189 @@ def FindLongestMatch(re_list, s, pos):
   return end_index, tok_type, tok_val
 
 
+def _ClassHas(items, code):
+  """Does a parsed character class [...] contain the character?"""
+  negate = False
+  found = False
+  for op, arg in items:
+    if op == sre_parse.NEGATE:
+      negate = True
+    elif op == sre_parse.LITERAL:
+      found = found or arg == code
+    elif op == sre_parse.RANGE:
+      found = found or arg[0] <= code <= arg[1]
+    else:
+      return True  # e.g. \w; don't bother, since False positives are OK
+  return found != negate
+
+
+def _FirstChar(items, code):
+  """Can a parsed regex start with the given character?
+
+  Args:
+    items: list of (op, arg) pairs from sre_parse
+    code: ord() of a character, or -1 for the end of the line
+
+  Returns:
+    (can_start, can_be_empty).  Unknown constructs return True, because
+    the caller still runs the real regex on each candidate.
+  """
+  for op, arg in items:
+    if op == sre_parse.LITERAL:
+      can_start, can_be_empty = (arg == code), False
+    elif op == sre_parse.NOT_LITERAL:
+      can_start, can_be_empty = (arg != code), False
+    elif op == sre_parse.ANY:
+      can_start, can_be_empty = (code != ord('\n')), False
+    elif op == sre_parse.IN:
+      can_start, can_be_empty = _ClassHas(arg, code), False
+    elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+      min_count, _, sub = arg
+      can_start, can_be_empty = _FirstChar(sub, code)
+      can_be_empty = can_be_empty or min_count == 0
+    elif op == sre_parse.SUBPATTERN:
+      can_start, can_be_empty = _FirstChar(arg[-1], code)
+    elif op == sre_parse.BRANCH:
+      results = [_FirstChar(alt, code) for alt in arg[1]]
+      can_start = any(r[0] for r in results)
+      can_be_empty = any(r[1] for r in results)
+    else:
+      return True, True
+
+    if can_start:
+      return True, can_be_empty
+    if not can_be_empty:
+      return False, False
+  return False, True
+
+
+def _CompileLookaheads(pats, tok_types):
+  """Compile patterns into a single regex that tries all of them.
+
+  Each pattern is wrapped in an optional lookahead containing one capturing
+  group:
+
+      (?:(?=(pat0)))?(?:(?=(pat1)))?...
+
+  The lookaheads don't consume input, so ONE call to match() tries every
+  pattern at the same position, and group i+1 records where pattern i ended
+  (or (-1, -1) if it didn't match).
+  """
+  regex = re.compile(''.join('(?:(?=(%s)))?' % pat for pat in pats))
+  # Group numbers are used to look up the token Id, so patterns can't have
+  # their own capturing groups.
+  assert regex.groups == len(tok_types), pats
+  return regex, tok_types
+
+
+class CombinedMatcher(object):
+  """All the patterns of one lex mode, matched with one regex call per token.
+
+  The regex to use is chosen by the character at the current position: only
+  patterns that can start with that character are included.  This is a
+  one-level DFA on top of the regex engine, e.g. in OUTER mode, 'e' selects
+  esac/else/elif/Lit_Chars/Lit_VarLike/Lit_Other rather than all 75 patterns.
+  """
+
+  def __init__(self, pat_list):
+    self.pats = []
+    self.parsed = []
+    self.tok_types = []
+    for is_regex, pat, token_id in pat_list:
+      if not is_regex:
+        pat = re.escape(pat)  # turn $ into \$
+      self.pats.append(pat)
+      self.parsed.append(list(sre_parse.parse(pat)))
+      self.tok_types.append(token_id)
+
+    self.by_char = {}  # first character -> (regex, token Ids)
+
+  def Dispatch(self, c):
+    """Return the (regex, token Ids) pair for lines with c at the position."""
+    try:
+      return self.by_char[c]
+    except KeyError:
+      pass
+
+    code = ord(c) if c else -1
+    pats = []
+    tok_types = []
+    for pat, parsed, tok_type in zip(self.pats, self.parsed, self.tok_types):
+      can_start, can_be_empty = _FirstChar(parsed, code)
+      if can_start or can_be_empty:
+        pats.append(pat)
+        tok_types.append(tok_type)
+
+    result = _CompileLookaheads(pats, tok_types)
+    self.by_char[c] = result
+    return result
+
+
+def CompileCombined(pat_list):
+  """Compile all patterns of a lex mode for FindLongestMatchCombined."""
+  return CombinedMatcher(pat_list)
+
+
+def FindLongestMatchCombined(matcher, s, pos):
+  """Like FindLongestMatch, but takes the output of CompileCombined.
+
+  Every group that matched has a span (pos, end), and every other group has
+  (-1, -1).  So the max() of the spans has the longest end, and index() finds
+  the FIRST group with that span, which gives the same tie-breaking as
+  FindLongestMatch.
+  """
+  regex, tok_types = matcher.Dispatch(s[pos : pos + 1])
+  regs = regex.match(s, pos).regs  # every part is optional, so always matches
+  best = max(regs[1:], default=(-1, -1))
+  if best[0] == -1:
+    raise AssertionError('no match at position %d: %r' % (pos, s))
+  end_index = best[1]
+  tok_type = tok_types[regs.index(best, 1) - 1]
+  return end_index, tok_type, s[pos:end_index]
+
+
+# A lexer engine is a pair of (compile a pattern list, find the longest match
+# with the compiled form).  'list' is the original engine, which calls match()
+# once per pattern; core/lexer_bench.py compares them.
+ENGINES = {
+    'list': (CompileAll, FindLongestMatch),
+    'combined': (CompileCombined, FindLongestMatchCombined),
+}
+
+
+# (id(lexer_def), engine) -> (lexer_def, compiled lexer_def).  The lexer_def
+# is kept alive so its id() can't be reused.
+_compiled_lexer_defs = {}
+
+
+def CompileLexerDef(lexer_def, engine='combined'):
+  """Compile every lex mode of a lexer definition, once per process.
+
+  Returns:
+    dict of lex_mode -> compiled patterns, for the engine's match function.
+  """
+  key = (id(lexer_def), engine)
+  try:
+    _, compiled = _compiled_lexer_defs[key]
+  except KeyError:
+    compile_func, _ = ENGINES[engine]
+    compiled = {}
+    for state, pat_list in lexer_def.items():
+      compiled[state] = compile_func(pat_list)
+    _compiled_lexer_defs[key] = (lexer_def, compiled)
+  return compiled
+
+
 class LineLexer(object):
-  def __init__(self, lexer_def, line, arena=None):
-    # Compile all regexes
-    self.lexer_def = {}
+  def __init__(self, lexer_def, line, arena=None, engine='combined'):
+    # Compiled regexes are shared by all instances.
+    self.lexer_def = CompileLexerDef(lexer_def, engine)
+    _, self.find_longest_match = ENGINES[engine]
     self.arena = arena
 
     self.arena_skip = False  # For MaybeUnreadOne
     self.last_span_id = -1  # For MaybeUnreadOne
 
-    for state, pat_list in lexer_def.items():
-      self.lexer_def[state] = CompileAll(pat_list)
-
     self.Reset(line, -1)  # Invalid arena index to start
 
   def Reset(self, line, line_id):
@@ -93,7 +268,7 @@ class LineLexer(object):
         return t
 
       re_list = self.lexer_def[lex_mode]
-      end_index, tok_type, tok_val = FindLongestMatch(
+      end_index, tok_type, tok_val = self.find_longest_match(
           re_list, self.line, pos)
       # NOTE: Instead of hard-coding this token, we could pass it in.  This one
       # only appears in OUTER state!  LookAhead(lex_mode, past_token_type)
@@ -112,7 +287,7 @@ class LineLexer(object):
 
     re_list = self.lexer_def[lex_mode]
 
-    end_index, tok_type, tok_val = FindLongestMatch(
+    end_index, tok_type, tok_val = self.find_longest_match(
         re_list, self.line, self.line_pos)
 
     # NOTE: tok_val is redundant, but even in osh.asdl we have some separation
@@ -121,7 +296,6 @@ class LineLexer(object):
 
     # TODO: Add this back once arena is threaded everywhere
     #assert self.line_id != -1
-    line_span = ast.line_span(self.line_id, self.line_pos, len(tok_val))
 
     # NOTE: We're putting the arena hook in LineLexer and not Lexer because we
     # want it to be "low level".  The only thing fabricated here is a newline
@@ -133,7 +307,8 @@ class LineLexer(object):
         span_id = self.last_span_id
         self.arena_skip = False
       else:
-        span_id = self.arena.AddLineSpan(line_span)
+        span_id = self.arena.AddLineSpan(
+            self.line_id, self.line_pos, len(tok_val))
         self.last_span_id = span_id
     else:
       # Completion parser might not have arena?
@@ -164,6 +339,15 @@ class Lexer(object):
     self.line_id = -1  # Invalid one
     self.translation_stack = []
 
+  def ResetInputObjects(self, line_reader):
+    """Start reading from a new line reader, so the Lexer can be reused."""
+    self.line_lexer.Reset('', -1)  # AtEnd() is true
+    self.line_lexer.arena_skip = False
+    self.line_lexer.last_span_id = -1
+    self.line_reader = line_reader
+    self.was_line_cont = False
+    self.translation_stack = []
+
   def MaybeUnreadOne(self):
     return self.line_lexer.MaybeUnreadOne()
 
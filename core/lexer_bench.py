@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+lexer_bench.py - Compare the lexer engines in core/lexer.py.
+
+Usage:
+  core/lexer_bench.py FILE...
+
+Each file is parsed once, recording the (line, position, lex mode) of every
+token the parser asks for.  Then each engine replays those requests, so both
+are timed on exactly the same token stream.  The results are also checked
+against each other.
+"""
+
+import sys
+import time
+
+from core import lexer
+from core import reader
+from core import util
+
+from osh import cmd_parse
+from osh import lex
+from osh import word_parse
+
+log = util.log
+
+
+class _RecordingLineLexer(lexer.LineLexer):
+  """A LineLexer that saves the arguments of every match it does."""
+
+  def __init__(self, lexer_def, line, requests):
+    lexer.LineLexer.__init__(self, lexer_def, line)
+    self.requests = requests
+
+  def Read(self, lex_mode):
+    self.requests.append((self.line, self.line_pos, lex_mode))
+    return lexer.LineLexer.Read(self, lex_mode)
+
+
+def RecordRequests(path):
+  """Parse a file and return the list of (line, pos, lex_mode) requests."""
+  with open(path) as f:
+    contents = f.read()
+
+  requests = []
+  line_reader = reader.StringLineReader(contents)
+  line_lexer = _RecordingLineLexer(lex.LEXER_DEF, '', requests)
+  lx = lexer.Lexer(line_lexer, line_reader)
+  w_parser = word_parse.WordParser(lx, line_reader)
+  c_parser = cmd_parse.CommandParser(w_parser, lx, line_reader)
+  # The tokens lexed before a parse failure are still useful for timing.
+  try:
+    node = c_parser.ParseWholeFile()
+  except Exception as e:
+    log('%s: parser raised %s (lexed %d tokens anyway)', path, e,
+        len(requests))
+  else:
+    if not node:
+      log('%s: parse error (lexed %d tokens anyway)', path, len(requests))
+  return requests
+
+
+def TimeEngine(engine, requests):
+  """Returns (elapsed seconds, list of results)."""
+  compile_func, find_longest_match = lexer.ENGINES[engine]
+  compiled = dict(
+      (mode, compile_func(pat_list))
+      for mode, pat_list in lex.LEXER_DEF.items())
+
+  results = []
+  start = time.time()
+  for line, pos, lex_mode in requests:
+    results.append(find_longest_match(compiled[lex_mode], line, pos))
+  elapsed = time.time() - start
+  return elapsed, results
+
+
+def main(argv):
+  paths = argv[1:]
+  if not paths:
+    raise RuntimeError('Usage: lexer_bench.py FILE...')
+
+  requests = []
+  for path in paths:
+    requests.extend(RecordRequests(path))
+  log('%d files, %d tokens', len(paths), len(requests))
+
+  expected = None
+  for engine in sorted(lexer.ENGINES):
+    elapsed, results = TimeEngine(engine, requests)
+    if expected is None:
+      expected = results
+    elif results != expected:
+      raise RuntimeError('Engine %r returned different tokens' % engine)
+    print('%-10s %8.3f s  %10.0f tokens/sec' %
+          (engine, elapsed, len(requests) / elapsed))
+
+
+if __name__ == '__main__':
+  try:
+    main(sys.argv)
+  except RuntimeError as e:
+    print('FATAL: %s' % e, file=sys.stderr)
+    sys.exit(1)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+core/ovm.py -- Parse ovm.asdl and dynamically create classes on this module.
+
+Similar to osh/ast_.py.  core/compile.py lowers osh.asdl commands to these
+nodes.
+"""
+
+import os
+import sys
+
+from asdl import py_meta
+from asdl import asdl_ as asdl
+
+from core.id_kind import Id
+from osh import ast_ as ast
+
+
+def _AppTypes():
+  # osh.asdl nodes that ovm.asdl refers to.  Keep in sync with the py-asdl
+  # step in build.sh.
+  return {
+      'id': asdl.UserType(Id),
+      'osh_word': asdl.UserType(ast.word),
+      'osh_redir': asdl.UserType(ast.redir),
+      'osh_env_pair': asdl.UserType(ast.env_pair),
+      'osh_assign_pair': asdl.UserType(ast.assign_pair),
+      'osh_token': asdl.UserType(ast.token),
+      'osh_arith_expr': asdl.UserType(ast.arith_expr),
+      'osh_bool_expr': asdl.UserType(ast.bool_expr),
+      # Python functions have no importable class, so any object is allowed.
+      'closure': asdl.UserType(object),
+  }
+
+
+def _ParseAndMakeTypes(schema_path, root):
+  module = asdl.parse(schema_path)
+
+  app_types = _AppTypes()
+
+  # Check for type errors
+  if not asdl.check(module, app_types):
+    raise AssertionError('ASDL file is invalid')
+  py_meta.MakeTypes(module, root, app_types)
+
+
+schema_path = os.path.join(os.path.dirname(__file__), '../ovm/ovm.asdl')
+
+root = sys.modules[__name__]
+
+# Like osh/ast_.py.
+_gen = None
+if not py_meta.CHECK_TYPES:
+  _gen = py_meta.ImportGenerated('_devbuild.gen.ovm_asdl', schema_path)
+if _gen:
+  for _name in _gen.__all__:
+    setattr(root, _name, getattr(_gen, _name))
+else:
+  _ParseAndMakeTypes(schema_path, root)
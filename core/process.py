@@ -12,16 +12,22 @@ descriptors.
 
 import fcntl
 import os
+import signal
 import sys
 
 from core.util import log
 from core.id_kind import REDIR_DEFAULT_FD
 
+# posix_spawn() starts external commands without forking the interpreter.
+# It's not available on all platforms; we fall back on fork() and exec().
+_HAVE_SPAWN = hasattr(os, 'posix_spawn')
+
 
 class _FdFrame:
   def __init__(self):
     self.saved = []
     self.need_close = []
+    self.need_wait = []  # Process instances, e.g. here doc writers
 
   def __repr__(self):
     return '<_FdFrame %s %s>' % (self.saved, self.need_close)
@@ -76,6 +82,10 @@ class FdState:
   def NeedClose(self, fd):
     self.cur_frame.need_close.append(fd)
 
+  def NeedWait(self, proc):
+    """Wait for a process when the frame is popped."""
+    self.cur_frame.need_wait.append(proc)
+
   def PopAndRestore(self):
     frame = self.stack.pop()
     #log('< Pop %s', frame)
@@ -93,6 +103,10 @@ class FdState:
         log('Error closing descriptor %d: %s', fd, e)
         raise
 
+    # After closing, so a writer blocked on a full pipe gets EPIPE.
+    for proc in frame.need_wait:
+      proc.Wait()
+
   def PopAndForget(self):
     self.stack.pop()
 
@@ -109,6 +123,13 @@ class Redirect(object):
   def ApplyInChild(self):
     raise NotImplementedError(self.__class__.__name__)
 
+  def SpawnActions(self):
+    """Return posix_spawn() file actions that do what ApplyInChild() does.
+
+    Returns None if it has to run Python code in the child.
+    """
+    return None
+
   def BeforeFork(self, fd_state):
     pass
 
@@ -120,10 +141,19 @@ class ReadPipeRedirect(Redirect):
   def __init__(self, fd):
     Redirect.__init__(self, fd)
 
+  def ApplyInParent(self, fd_state):
+    """For the last stage of a pipeline with lastpipe."""
+    fd_state.SaveAndDup(self.fd, 0)
+    fd_state.NeedClose(self.fd)
+
   def ApplyInChild(self):
     os.dup2(self.fd, 0)
     os.close(self.fd)  # close after dup
 
+  def SpawnActions(self):
+    return [(os.POSIX_SPAWN_DUP2, self.fd, 0),
+            (os.POSIX_SPAWN_CLOSE, self.fd)]
+
   def AfterForkInParent(self):
     os.close(self.fd)
 
@@ -136,6 +166,10 @@ class WritePipeRedirect(Redirect):
     os.dup2(self.fd, 1)
     os.close(self.fd)  # close after dup
 
+  def SpawnActions(self):
+    return [(os.POSIX_SPAWN_DUP2, self.fd, 1),
+            (os.POSIX_SPAWN_CLOSE, self.fd)]
+
   def AfterForkInParent(self):
     os.close(self.fd)
 
@@ -161,6 +195,11 @@ class FilenameRedirect(UserRedirect):
     os.dup2(target_fd, self.fd)
     os.close(target_fd)
 
+  def SpawnActions(self):
+    # Opens the file directly on self.fd.  0o777 is the os.open() default.
+    return [(os.POSIX_SPAWN_OPEN, self.fd, self.filename,
+             os.O_CREAT | os.O_RDWR | os.O_TRUNC, 0o777)]
+
   def ApplyInParent(self, fd_state):
     target_fd = os.open(self.filename, os.O_CREAT | os.O_RDWR | os.O_TRUNC)
     #log('fd %d - target fd %d', self.fd, target_fd)
@@ -176,6 +215,11 @@ class DescriptorRedirect(UserRedirect):
   def ApplyInChild(self):
     os.dup2(self.target_fd, self.fd)
 
+  def SpawnActions(self):
+    if self.target_fd == self.fd:  # e.g. 2>&2, dup2() does nothing
+      return []
+    return [(os.POSIX_SPAWN_DUP2, self.target_fd, self.fd)]
+
   def ApplyInParent(self, fd_state):
     fd_state.SaveAndDup(self.target_fd, self.fd)
 
@@ -201,7 +245,9 @@ class HereDocRedirect(UserRedirect):
     if start_process:
       #print('starting here doc helper process')
       self.here_proc = Process(thunk)
-      self.here_proc.Start()  # who waits for this guy?
+      # Waited for in AfterForkInParent(), or when the fd_state frame is
+      # popped.
+      self.here_proc.Start()
 
       # here proc is not going to read.  Or really you don't have to worry
       # about this?
@@ -227,6 +273,10 @@ class HereDocRedirect(UserRedirect):
     #print('CLOSING', self.w)
     os.close(self.w)  # child is not going to write
 
+  def SpawnActions(self):
+    return [(os.POSIX_SPAWN_DUP2, self.r, 0),  # TODO: self.fd
+            (os.POSIX_SPAWN_CLOSE, self.w)]
+
   def AfterForkInParent(self):  # applying in child
     os.close(self.r)  # parent isn't going to read or write
     os.close(self.w)
@@ -242,6 +292,12 @@ class HereDocRedirect(UserRedirect):
     #print('!! ApplyInParent')
     self._CreatePipeAndMaybeProcess(fd_state)
     fd_state.SaveAndDup(self.r, 0)  # dup stdin.  TODO: self.fd
+    fd_state.NeedClose(self.r)
+    if self.here_proc:
+      # Only the writer process writes, so reading to EOF works, e.g. in
+      # 'while read' loops.
+      os.close(self.w)
+      fd_state.NeedWait(self.here_proc)
 
 
 class CommandSubRedirect(Redirect):
@@ -273,6 +329,10 @@ class CommandSubRedirect(Redirect):
     os.dup2(self.w, 1)
     os.close(self.r)  # child is not going read
 
+  def SpawnActions(self):
+    return [(os.POSIX_SPAWN_DUP2, self.w, 1),
+            (os.POSIX_SPAWN_CLOSE, self.r)]
+
   def AfterForkInParent(self):
     os.close(self.w)  # not going to read
     while True:
@@ -292,17 +352,18 @@ class Thunk(object):
 
   def RunInChild(self):
     """Never returns."""
-    self.RunInParent()
-
-    # TODO: How do we communicate a bad status to the parent process?  It
-    # waits?  Signal?
-    # The problem is that a subshell cannot fail!
-    sys.exit(0)  # This is required
+    # The parent gets the status with waitpid(), e.g. for ( exit 3 ) and
+    # pipelines.
+    sys.exit(self.RunInParent())  # This is required
 
   def IsExternal(self):
     """Test if a thunk represents an external process (ExternalThunk)."""
     return False
 
+  def CanSpawn(self):
+    """Whether Spawn() can start it without running Python in a child."""
+    return False
+
   def ShouldRestoreFdState(self):
     """Default is to restore."""
     return True
@@ -311,23 +372,67 @@ class Thunk(object):
 class ExternalThunk(Thunk):
   """An external executable."""
 
-  def __init__(self, argv, more_env=None):
+  def __init__(self, argv, more_env=None, environ=None, path=None):
+    """
+    Args:
+      argv: list of strings
+      more_env: dict of prefix bindings, e.g. FOO=bar cmd
+      environ: dict of exported variables, from Mem.GetExported().
+        os.environ by default.
+      path: absolute path resolved by the shell's CommandHash.  If it's None,
+        execvpe() searches $PATH in the child.
+    """
     self.argv = argv
-    self.more_env = more_env or {}
+    self.more_env = more_env
+    self.environ = os.environ if environ is None else environ
+    self.path = path
 
   def IsExternal(self):
     return True
 
+  def CanSpawn(self):
+    return _HAVE_SPAWN and self.path is not None
+
+  def _GetEnv(self):
+    # Only copy the environment if there are prefix bindings.
+    env = self.environ
+    if self.more_env:
+      env = dict(env)
+      env.update(self.more_env)
+    return env
+
+  def Spawn(self, file_actions, sigmask):
+    """Start the command with posix_spawn().
+
+    Args:
+      file_actions: from Redirect.SpawnActions()
+      sigmask: signal mask for the command
+
+    Returns:
+      The PID.  Raises OSError, e.g. if self.path no longer exists.
+    """
+    # Python ignores SIGPIPE, and commands shouldn't inherit that.
+    return os.posix_spawn(self.path, self.argv, self._GetEnv(),
+                          file_actions=file_actions,
+                          setsigdef=(signal.SIGPIPE,), setsigmask=sigmask)
+
   def RunInParent(self):
     """
     An ExternalThunk is run in parent for the exec builtin.
     """
     # TODO: If there is an error, like the file isn't executable, then we
     # should exit, and the parent will reap it.  Should it capture stderr?
+    env = self._GetEnv()
 
-    # NOTE: Do we have to do this?
-    env = dict(os.environ)
-    env.update(self.more_env)
+    if self.path is not None:
+      try:
+        os.execve(self.path, self.argv, env)
+      except FileNotFoundError:
+        pass  # The hash table is stale.  Search $PATH like bash.
+      except OSError as e:
+        log('Unexpected error in execve(%r, %r, ...): %s', self.path,
+            self.argv, e)
+        sys.exit(126)  # e.g. not executable
 
     try:
       os.execvpe(self.argv[0], self.argv, env)
@@ -339,15 +444,33 @@ class ExternalThunk(Thunk):
     # no return
 
 
+class CommandNotFoundThunk(Thunk):
+  """A command that isn't a builtin, function, or file in $PATH.
+
+  It's reported in the parent, without forking.
+  """
+  def __init__(self, argv):
+    self.argv = argv
+
+  def RunInParent(self):
+    log('%s: command not found', self.argv[0])
+    return 127
+
+
 class SubProgramThunk(Thunk):
   """A subprogram that can be executed in another process."""
 
   def __init__(self, ex, node):
+    """
+    Args:
+      ex: Executor
+      node: ovm.command
+    """
     self.ex = ex
     self.node = node
 
   def RunInParent(self):
-    return self.ex.Execute(self.node)
+    return self.ex.ExecuteCompiled(self.node)
 
 
 # NOTE: We need BuiltinThunk and FuncThunk to maintain the invariant that words
@@ -402,7 +525,10 @@ class HereDocWriterThunk(Thunk):
 
   def RunInParent(self):
     byte_str = self.body_str.encode('utf-8')
-    os.write(self.w, byte_str)
+    try:
+      os.write(self.w, byte_str)
+    except BrokenPipeError:
+      pass  # e.g. 'read' doesn't read the whole doc
     # Don't bother to close, since the process will die
     #os.close(self.w)
 
@@ -459,6 +585,7 @@ class Process(object):
     self.redirects = redirects or []
 
     self.inputs = []
+    self.pid = -1  # set by Start()
 
   def __repr__(self):
     return '<Process %s>' % self.thunk
@@ -469,43 +596,104 @@ class Process(object):
   def CaptureOutput(self, var):
     self.redirects.append(CommandSubRedirect(var))
 
+  def _GetSpawnActions(self):
+    """
+    Returns:
+      posix_spawn() file actions for all redirects, or None if we have to
+      fork.
+    """
+    if not self.thunk.CanSpawn():
+      return None
+    file_actions = []
+    for r in self.redirects:
+      actions = r.SpawnActions()
+      if actions is None:
+        return None
+      file_actions.extend(actions)
+    return file_actions
+
+  def _Spawn(self, sigmask):
+    """Try to start an external command without forking.
+
+    Returns:
+      The PID, or None if it wasn't started.
+    """
+    file_actions = self._GetSpawnActions()
+    if file_actions is None:
+      return None
+    try:
+      return self.thunk.Spawn(file_actions, sigmask)
+    except OSError:
+      # e.g. a stale hash table entry, or a redirect to a file we can't
+      # open.  Fork, so the child searches $PATH and reports errors like
+      # before.
+      return None
+
   def Start(self):
     """
     Start a process.
+
+    Returns:
+      The PID.
     """
     for r in self.redirects:
       r.BeforeFork(self.fd_state)
 
-    pid = os.fork()
-    if pid < 0:
-      # When does this happen?
-      raise RuntimeError('Fatal error in os.fork()')
-
-    elif pid == 0:  # child
-      # NOTE: We never call RestoreAll().  It doesn't really matter since
-      # the process is torn down.
-      for r in self.redirects:
-        r.ApplyInChild()
-
-      self.thunk.RunInChild()
-      # Never returns
+    # Block SIGCHLD until JOB_STATE knows the PID, so the handler doesn't
+    # reap the child first and drop its status.
+    old_mask = signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGCHLD])
+    try:
+      pid = self._StartChild(old_mask)
+      JOB_STATE.Track(pid)
+    finally:
+      signal.pthread_sigmask(signal.SIG_SETMASK, old_mask)
 
+    self.pid = pid
     for r in self.redirects:  # here docs
       r.AfterForkInParent()
+    return pid
+
+  def _StartChild(self, sigmask):
+    """Spawn or fork the child, with the given signal mask.  Returns the PID."""
+    # Most external commands don't need to fork this (big) process.
+    pid = self._Spawn(sigmask)
+    if pid is None:
+      pid = os.fork()
+      if pid < 0:
+        # When does this happen?
+        raise RuntimeError('Fatal error in os.fork()')
+
+      elif pid == 0:  # child
+        signal.pthread_sigmask(signal.SIG_SETMASK, sigmask)
+        # NOTE: We never call RestoreAll().  It doesn't really matter since
+        # the process is torn down.
+        for r in self.redirects:
+          r.ApplyInChild()
+
+        try:
+          self.thunk.RunInChild()
+          # Never returns
+        except SystemExit as e:
+          # Exit right here, so the child doesn't unwind through the parent's
+          # stack frames, e.g. a test runner.
+          code = e.code
+          if code is None:
+            code = 0
+          elif not isinstance(code, int):
+            code = 1
+          sys.stdout.flush()
+          sys.stderr.flush()
+          os._exit(code)
+
+    return pid
 
-  # TODO: Should be a free function.  Not using self!
   def Wait(self):
-    # NOTE: Need to check errors
-    wait_pid, status = os.wait()
-
-    # TODO: change status in more cases.
-    if os.WIFSIGNALED(status):
-      pass
-    elif os.WIFEXITED(status):
-      status = os.WEXITSTATUS(status)
-      #log('exit status: %s', status)
+    """Wait for this process, not any child.  Returns its status."""
+    return JOB_STATE.WaitPid(self.pid)
 
-    return status
+  def Poll(self):
+    """Returns the status, or None if it's still running."""
+    return JOB_STATE.Poll(self.pid)
 
   def Run(self):
     self.Start()
@@ -552,6 +740,16 @@ class Pipeline(object):
 
     self.procs.append(p)
 
+  def AddLastPipe(self):
+    """Pipe the last process to a stage that runs in this process.
+
+    Returns:
+      A ReadPipeRedirect to apply with ApplyInParent().
+    """
+    r, w = os.pipe()
+    self.procs[-1].AddRedirect(WritePipeRedirect(w))
+    return ReadPipeRedirect(r)
+
   def CaptureOutput(self, var):
     """Add output var.
 
@@ -562,21 +760,142 @@ class Pipeline(object):
     """
     self.procs[-1].CaptureOutput(var)
 
-  def Run(self):
+  def Start(self):
+    """
+    Returns:
+      The PID of the last process, e.g. for $!
+    """
     for p in self.procs:
       #print('start', p)
       p.Start()
-      # TODO: Return pid
-
-    pipe_status = []
+    return self.procs[-1].pid
 
+  def Wait(self):
+    """
+    Returns:
+      A list of statuses, in the order of the processes.
+    """
     # TODO: Could do some sort of garbage collection here  too.
-    for p in self.procs:
-      # BUG: This doesn't do things in order!  It just calls os.wait()!
-      # Need to key off wait_pid
+    return [p.Wait() for p in self.procs]
+
+  def Poll(self):
+    """Returns the status of the last process, or None if any is running."""
+    statuses = [p.Poll() for p in self.procs]
+    if None in statuses:
+      return None
+    return statuses[-1]
+
+  def Run(self):
+    self.Start()
+    return self.Wait()
+
+
+def _DecodeStatus(status):
+  """Turn a waitpid() status into a shell exit status."""
+  if os.WIFSIGNALED(status):
+    return 128 + os.WTERMSIG(status)  # like other shells
+  if os.WIFEXITED(status):
+    return os.WEXITSTATUS(status)
+  return status  # TODO: stopped
+
+
+class JobState(object):
+  """Exit statuses of child processes, keyed by PID.
+
+  We wait with waitpid() for a specific PID, so that a here doc writer or a
+  background job doesn't steal the status of another process.  The SIGCHLD
+  handler reaps background jobs when they exit, and saves their status for
+  WaitPid() and Poll().
+
+  Only statuses of children that Process.Start() tracked are saved, and
+  WaitPid() and Forget() drop them, so they don't pile up.
+
+  There's one per process, JOB_STATE, because waitpid() and signals are
+  process-wide.
+  """
+  def __init__(self):
+    self.statuses = {}  # pid -> status, reaped but not waited for
+    self.pids = set()  # children that someone will wait for
+
+  def InitSigChld(self):
+    """Reap children when they exit.  Called by the shell's main()."""
+    signal.signal(signal.SIGCHLD, self._OnSigChld)
+
+  def _OnSigChld(self, sig_num, unused_frame):
+    while True:
+      try:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+      except ChildProcessError:
+        break
+      if pid == 0:  # others are still running
+        break
+      self._Save(pid, status)
+
+  def _Save(self, pid, status):
+    if pid in self.pids:
+      self.statuses[pid] = _DecodeStatus(status)
+
+  def Track(self, pid):
+    """Save the status of this child when it's reaped."""
+    self.pids.add(pid)
+
+  def Forget(self, pid):
+    """Nobody will wait for this child, so don't save its status."""
+    self.pids.discard(pid)
+    self.statuses.pop(pid, None)
+
+  def WaitPid(self, pid):
+    """Block until a child exits, and return its status."""
+    try:
+      while True:
+        status = self.statuses.pop(pid, None)
+        if status is not None:
+          return status
+        try:
+          _, status = os.waitpid(pid, 0)
+        except ChildProcessError:
+          # The SIGCHLD handler can reap it while we're blocked.
+          if pid in self.statuses:
+            continue
+          raise
+        return _DecodeStatus(status)
+    finally:
+      self.pids.discard(pid)
+
+  def WaitUntil(self, pred):
+    """Reap children until pred() is true, or there are no more children.
+
+    SIGCHLD is blocked, so the handler can't reap a child while we're blocked
+    in waitpid() for another one.
+    """
+    old_mask = signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGCHLD])
+    try:
+      while not pred():
+        try:
+          pid, status = os.waitpid(-1, 0)
+        except ChildProcessError:
+          break
+        self._Save(pid, status)
+    finally:
+      signal.pthread_sigmask(signal.SIG_SETMASK, old_mask)
+
+  def Poll(self, pid):
+    """Returns the status of a child, or None if it's still running.
+
+    The status is kept, so a later WaitPid() returns it too.
+    """
+    status = self.statuses.get(pid)
+    if status is not None:
+      return status
+    try:
+      wait_pid, status = os.waitpid(pid, os.WNOHANG)
+    except ChildProcessError:
+      return self.statuses.get(pid)  # reaped by the handler just now
+    if wait_pid == 0:
+      return None
+    status = _DecodeStatus(status)
+    self.statuses[pid] = status
+    return status
 
-      status = p.Wait()
-      #log('Process %s returned status %s', p, status)
-      pipe_status.append(status)
 
-    return pipe_status
+JOB_STATE = JobState()
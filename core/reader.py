@@ -9,15 +9,47 @@
 reader.py - Read lines of input.
 """
 
+import mmap
+import os
+import stat
+
+
+def DecodeLineAt(buf, pos):
+  """Decode the line starting at a byte offset in a file's contents.
+
+  Used by FileLineReader, and by Arena to reload lines it didn't keep.
+
+  Args:
+    buf: bytes or mmap
+    pos: offset of the line start; must be less than len(buf)
+
+  Returns:
+    (line, offset of the next line)
+  """
+  end = buf.find(b'\n', pos)
+  end = len(buf) if end == -1 else end + 1
+
+  line = buf[pos:end].decode('utf-8')
+  # Like Python's universal newlines, which open() in text mode used to do.
+  if line.endswith('\r\n'):
+    line = line[:-2] + '\n'
+  # The last line should be passed to the Lexer with a '\n', even if it didn't
+  # have one.
+  elif not line.endswith('\n'):
+    line += '\n'
+  return line, end
+
+
 class _Reader(object):
   def __init__(self, arena):
     self.arena = arena
     self.line_num = 0  # physical line number
+    self.line_offset = -1  # byte offset of the line in a file, if known
 
   def GetLine(self):
     line = self._GetLine()
     if self.arena:
-      line_id = self.arena.AddLine(line, self.line_num)
+      line_id = self.arena.AddLine(line, self.line_num, self.line_offset)
     else:
       line_id = -1
     self.line_num += 1
@@ -45,11 +77,12 @@ class InteractiveLineReader(_Reader):
     return ret
 
   def Reset(self):
-    """Call this after command execution, to free memory taken up by the lines,
-    and reset prompt string back to PS1.
+    """Call this after command execution, to reset the prompt string back to
+    PS1.
+
+    Lines aren't stored here; the interactive loop frees them from the arena.
     """
     self.prompt_str = self.ps1
-    # free vector...
 
 
 class StringLineReader(_Reader):
@@ -78,6 +111,95 @@ class StringLineReader(_Reader):
     return line
 
 
+class StreamLineReader(_Reader):
+  """For script files and stdin, without reading them up front.
+
+  Lines are read one at a time, so the batch loop can execute the first
+  command before the rest of the input exists (e.g. cat script | osh).
+  """
+
+  def __init__(self, f, arena=None):
+    """
+    Args:
+      f: file object opened in text mode
+    """
+    _Reader.__init__(self, arena)
+    self.f = f
+
+  def _GetLine(self):
+    line = self.f.readline()
+    if not line:
+      return None
+
+    # Like StringLineReader, give the last line a '\n'.
+    if not line.endswith('\n'):
+      line += '\n'
+    return line
+
+
+class FileLineReader(_Reader):
+  """For script files, source and oilrc.
+
+  A regular file is mmap'd and each line is decoded only when the lexer asks
+  for it, so a big sourced library costs almost nothing until it's parsed.
+  Other files, like pipes and /dev/stdin, are read all at once.
+  """
+
+  def __init__(self, path, arena=None):
+    """
+    Args:
+      path: file to read.  Raises OSError if it can't be opened.  It's added
+        to the arena as a source path.
+    """
+    _Reader.__init__(self, arena)
+    with open(path, 'rb') as f:
+      st = os.fstat(f.fileno())
+      is_regular = stat.S_ISREG(st.st_mode)
+      if not is_regular:
+        self.buf = f.read()  # e.g. source /dev/stdin, or osh <(echo ls)
+      elif st.st_size == 0:
+        self.buf = b''  # can't mmap an empty file
+      else:
+        # The map has its own reference to the file, so f can be closed.
+        self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    self.pos = 0
+
+    # Only regular files can be read again to recover lines, or cached.
+    self.is_regular = is_regular
+    self.file_stat = (st.st_size, st.st_mtime_ns) if is_regular else None
+    if arena:
+      if is_regular:
+        arena.AddSourceFile(path, st.st_size, st.st_mtime_ns)
+      else:
+        arena.AddSourcePath(path)
+
+  def _GetLine(self):
+    buf = self.buf
+    if buf is None:
+      return None
+    pos = self.pos
+    if pos >= len(buf):  # EOF, or the file was truncated before pos
+      if isinstance(buf, mmap.mmap):
+        buf.close()
+      self.buf = None
+      self.line_offset = -1
+      return None
+
+    if isinstance(buf, mmap.mmap):
+      size = buf.size()  # fstat() the file
+      if size < len(buf):
+        # The file was truncated, e.g. by the script itself.  Touching the
+        # pages past the end would raise SIGBUS, so copy what's left.
+        self.buf = buf[:size]
+        buf.close()
+        return self._GetLine()
+
+    line, self.pos = DecodeLineAt(buf, pos)
+    if self.is_regular:
+      self.line_offset = pos
+    return line
+
+
 # C++ ownership notes:
 # - used for file input (including source)
 # - used for -c arg (NUL terminated, likely no newline)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+reader_test.py: Tests for reader.py
+"""
+
+import os
+import tempfile
+import unittest
+
+from core import alloc
+from core import reader  # module under test
+
+
+def _ReadAll(r):
+  lines = []
+  while True:
+    _, line = r.GetLine()
+    if line is None:
+      break
+    lines.append(line)
+  return lines
+
+
+class FileLineReaderTest(unittest.TestCase):
+
+  def _MakeFile(self, contents):
+    fd, path = tempfile.mkstemp()
+    os.write(fd, contents)
+    os.close(fd)
+    self.addCleanup(os.remove, path)
+    return path
+
+  def testRead(self):
+    path = self._MakeFile(b'echo 1\r\necho \xce\xbb\n\nls')
+    r = reader.FileLineReader(path)
+    self.assertEqual(
+        ['echo 1\n', 'echo λ\n', '\n', 'ls\n'], _ReadAll(r))
+
+    # Another read gives EOF
+    self.assertEqual((-1, None), r.GetLine())
+
+  def testEmpty(self):
+    r = reader.FileLineReader(self._MakeFile(b''))
+    self.assertEqual([], _ReadAll(r))
+
+  def testPipe(self):
+    # A pipe has st_size 0, but isn't empty.
+    r_fd, w_fd = os.pipe()
+    os.write(w_fd, b'echo hi\n')
+    os.close(w_fd)
+    r = reader.FileLineReader('/dev/fd/%d' % r_fd)
+    os.close(r_fd)
+    self.assertEqual(['echo hi\n'], _ReadAll(r))
+
+  def testTruncated(self):
+    path = self._MakeFile(b'a\n' + b'b' * 10000 + b'\n')
+    r = reader.FileLineReader(path)
+    self.assertEqual('a\n', r.GetLine()[1])
+    with open(path, 'wb'):
+      pass
+    # EOF instead of SIGBUS.
+    self.assertEqual((-1, None), r.GetLine())
+
+  def testArena(self):
+    arena = alloc.Pool().NewArena()
+    path = self._MakeFile(b'a\nb\n')
+    r = reader.FileLineReader(path, arena=arena)
+    self.assertEqual((0, 'a\n'), r.GetLine())
+    self.assertEqual((1, 'b\n'), r.GetLine())
+    self.assertEqual('b\n', arena.GetLine(1))
+    self.assertEqual((path, 1), arena.GetDebugInfo(1))
+
+  def testReloadLines(self):
+    arena = alloc.Pool(retain_file_lines=False).NewArena()
+    path = self._MakeFile(b'echo 1\r\necho 2')
+    r = reader.FileLineReader(path, arena=arena)
+    self.assertEqual(['echo 1\n', 'echo 2\n'], _ReadAll(r))
+    self.assertEqual([None, None], arena.lines[:2])
+
+    # Lines are read from disk again, the same way.
+    self.assertEqual('echo 2\n', arena.GetLine(1))
+    self.assertEqual('echo 1\n', arena.GetLine(0))
+
+    # Strings are always retained.
+    arena.AddSourcePath('<test>')
+    r = reader.StringLineReader('echo 3\n', arena=arena)
+    line_id, _ = r.GetLine()
+    self.assertEqual('echo 3\n', arena.lines[line_id])
+
+  def testReloadChangedFile(self):
+    arena = alloc.Pool(retain_file_lines=False).NewArena()
+    path = self._MakeFile(b'echo 1\n')
+    r = reader.FileLineReader(path, arena=arena)
+    _ReadAll(r)
+    with open(path, 'wb') as f:
+      f.write(b'echo 12345\n')
+    self.assertEqual('<%s changed on disk>\n' % path, arena.GetLine(0))
+
+    # The file is checked on every reload, not just the first one.
+    path = self._MakeFile(b'echo 1\necho 2\n')
+    r = reader.FileLineReader(path, arena=arena)
+    r.GetLine()
+    line_id, _ = r.GetLine()
+    self.assertEqual('echo 2\n', arena.GetLine(line_id))
+    with open(path, 'r+b') as f:
+      f.truncate(3)
+    self.assertEqual('<%s changed on disk>\n' % path, arena.GetLine(line_id))
+
+  def testMissing(self):
+    self.assertRaises(OSError, reader.FileLineReader, '/nonexistent/file')
+
+
+if __name__ == '__main__':
+  unittest.main()
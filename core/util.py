@@ -50,27 +50,26 @@ def GetHomeDir():
     return e.pw_dir
 
 
-class _EnumValue(object):
-  """A unique name."""
-  def __init__(self, namespace, name, value):
+class _EnumValue(int):
+  """A unique name with an integer value.
+
+  It's an int, so hashing and comparison don't run Python code.  That matters
+  for LexMode, which is looked up in the lexer on every token.
+  """
+  def __new__(cls, namespace, name, value):
+    self = int.__new__(cls, value)
     self.namespace = namespace
     self.name = name
-    self.value = value
+    return self
+
+  @property
+  def value(self):
+    return int(self)
 
   def __repr__(self):
-    return '<%s.%s %s>' % (self.namespace, self.name, self.value)
-
-  def __hash__(self):
-    # Needed for the LEXER_DEF dictionary
-    return hash(self.name)
-
-  def __eq__(self, other):
-    if isinstance(other, int):
-      return self.value == other
-    elif isinstance(other, _EnumValue):
-      return self is other
-    else:
-      raise ValueError('%r is not comparable with %r' % (self, other))
+    return '<%s.%s %s>' % (self.namespace, self.name, int(self))
+
+  __str__ = __repr__
 
 
 class Enum(object):
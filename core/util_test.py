@@ -67,12 +67,8 @@ class EnumTest(unittest.TestCase):
 
     self.assertEqual(Color.red, 0)
     self.assertEqual(Color.blue, 4)
-    try:
-      print(Color.blue == '')
-    except ValueError as e:
-      pass
-    else:
-      self.fail("Expected error")
+    self.assertNotEqual(Color.blue, '')
+    self.assertEqual('x', {4: 'x'}[Color.blue])  # hashes like an int
 
 
 if __name__ == '__main__':
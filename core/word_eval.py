@@ -340,6 +340,10 @@ class _WordPartEvaluator:
       # External commands need WIFEXITED test.  What about subshells?
       return runtime.Str(str(self.mem.last_status)), False
 
+    elif op_id == Id.VSub_Bang:  # $!
+      pid = self.mem.last_job_pid
+      return runtime.Str('' if pid is None else str(pid)), False
+
     elif op_id == Id.VSub_Pound:  # $#
       argv = self.mem.GetArgv()
       s = str(len(argv))
@@ -1066,12 +1070,7 @@ class _NormalPartEvaluator(_WordPartEvaluator):
     self.ex = ex
 
   def _EvalCommandSub(self, node, quoted):
-    p = self.ex._GetProcessForNode(node)
-    # NOTE: We could do an optimization for pipelines.  Pick the last
-    # process element, and do pi.procs[-1].CaptureOutput()
-    stdout = []
-    p.CaptureOutput(stdout)
-    status = p.Run()
+    stdout = self.ex.RunCommandSub(node)
 
     # Runtime errors:
     # what if the command sub was "echo foo > $@".  That is invalid.  Then
@@ -1080,7 +1079,7 @@ class _NormalPartEvaluator(_WordPartEvaluator):
 
     # I think $() does a strip basically?
     # argv $(echo ' hi')$(echo bye) -> hibye
-    s = ''.join(stdout).strip()
+    s = stdout.strip()
     return runtime.StringPartValue(s, not quoted, not quoted)
 
 
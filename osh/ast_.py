@@ -138,9 +138,17 @@ def _ParseAndMakeTypes(schema_path, root):
   py_meta.MakeTypes(module, root, app_types)
 
 
-bin_dir = os.path.dirname(os.path.abspath(sys.argv[0]))  # ~/git/oil/bin
-schema_path = os.path.join(bin_dir, '../osh/osh.asdl')  # ~/git/oil/osh
+schema_path = os.path.join(os.path.dirname(__file__), 'osh.asdl')
 
 root = sys.modules[__name__]
 
-_ParseAndMakeTypes(schema_path, root)
+# Fast classes come from the module that './build.sh py-asdl' generates, if
+# it's up to date.  Checked classes are always made at runtime.
+_gen = None
+if not py_meta.CHECK_TYPES:
+  _gen = py_meta.ImportGenerated('_devbuild.gen.osh_asdl', schema_path)
+if _gen:
+  for _name in _gen.__all__:
+    setattr(root, _name, getattr(_gen, _name))
+else:
+  _ParseAndMakeTypes(schema_path, root)
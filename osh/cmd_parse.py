@@ -88,6 +88,58 @@ def _GetHereDocsToFill(node):
   return here_docs
 
 
+def FindFuncDefs(node):
+  """Return the FuncDef nodes in a command tree, in order.
+
+  The caller may free the arena lines of a command after executing it, unless
+  it defined functions that can be called later.  (Functions defined in a
+  command sub are never called by this shell, so we don't look in words.)
+  """
+  if node.tag == command_e.FuncDef:
+    return [node]
+
+  if node.tag in (
+      command_e.NoOp, command_e.SimpleCommand, command_e.Assignment,
+      command_e.ControlFlow, command_e.DParen, command_e.DBracket):
+    return []
+
+  func_defs = []
+
+  if node.tag == command_e.If:
+    for arm in node.arms:
+      func_defs.extend(FindFuncDefs(arm.cond))
+      func_defs.extend(FindFuncDefs(arm.action))
+    if node.else_action:
+      func_defs.extend(FindFuncDefs(node.else_action))
+
+  elif node.tag == command_e.Case:
+    for arm in node.arms:
+      func_defs.extend(FindFuncDefs(arm.action))
+
+  elif node.tag == command_e.ForEach:
+    func_defs.extend(FindFuncDefs(node.body))
+
+  elif node.tag == command_e.ForExpr:
+    if node.body:
+      func_defs.extend(FindFuncDefs(node.body))
+
+  elif node.tag in (command_e.While, command_e.Until):
+    func_defs.extend(FindFuncDefs(node.cond))
+    func_defs.extend(FindFuncDefs(node.body))
+
+  elif node.tag == command_e.DoGroup:
+    func_defs.extend(FindFuncDefs(node.child))
+
+  elif node.tag == command_e.Sentence:
+    func_defs.extend(FindFuncDefs(node.command))
+
+  else:
+    for child in node.children:
+      func_defs.extend(FindFuncDefs(child))
+
+  return func_defs
+
+
 class CommandParser(object):
   """
   Args:
@@ -102,6 +154,14 @@ class CommandParser(object):
 
     self.Reset()
 
+  def ResetInputObjects(self, line_reader):
+    """Parse from a new line reader, so all the parser objects can be reused.
+    """
+    self.line_reader = line_reader
+    self.lexer.ResetInputObjects(line_reader)
+    self.w_parser.ResetInputObjects(line_reader)
+    self.Reset()
+
   def Reset(self):
     self.error_stack = []
     self.completion_stack = []
@@ -230,7 +290,9 @@ class CommandParser(object):
         word = w_parser.ReadHereDocBody()
         if not word:
           self.AddErrorContext('Error reading here doc body: %s', w_parser.Error())
+          parse_lib.ReleaseParser(w_parser)
           return False
+        parse_lib.ReleaseParser(w_parser)
         h.arg_word = word
         h.was_filled = True
       else:
@@ -1378,12 +1440,17 @@ class CommandParser(object):
 
         if not self._Peek(): return None
         if self.c_id == Id.Op_Newline:
+          # Read ALL here docs so far.  cat <<EOF; echo hi <newline>
+          for c in children:
+            self._MaybeReadHereDocs(c)
           self._MaybeReadHereDocs(child)
           done = True
         elif self.c_id == Id.Eof_Real:
           done = True
 
       elif self.c_id == Id.Op_Newline:
+        for c in children:
+          self._MaybeReadHereDocs(c)
         self._MaybeReadHereDocs(child)
         done = True
 
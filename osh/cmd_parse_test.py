@@ -14,8 +14,9 @@ from core.alloc import Pool
 from core import word
 
 from osh import ast_ as ast
+from osh import cmd_parse  # module under test
 from osh import parse_lib
-from osh.cmd_parse import CommandParser  # module under test
+from osh.cmd_parse import CommandParser
 from osh.word_parse import WordParser
 
 command_e = ast.command_e
@@ -293,6 +294,22 @@ EOF2
     assertHereDocToken(self, 'PIPE A1\n', node.children[0])
     assertHereDocToken(self, 'PIPE B1\n', node.children[1])
 
+  def testHereDocsInCommandLine(self):
+    # ParseCommandLine, which the shell uses to execute one line at a time.
+    # Here docs of all children are read at the newline.
+    node = assertParseCommandLine(self, """\
+cat <<EOF1; echo two; cat <<EOF2
+one
+1
+EOF1
+three
+3
+EOF2
+""")
+    self.assertEqual(3, len(node.children))
+    assertHereDocToken(self, 'one\n', node.children[0].command)
+    assertHereDocToken(self, 'three\n', node.children[2])
+
   def testHereDocInAndOrChain(self):
     # || command AFTER here doc
     node = assertParseCommandLine(self, """\
@@ -1156,6 +1173,27 @@ echo $(( 0x$foo ))
 """)
 
 
+class FindFuncDefsTest(unittest.TestCase):
+
+  def testFindFuncDefs(self):
+    node = assertParseCommandList(self, 'echo hi; ls | wc -l')
+    self.assertEqual([], cmd_parse.FindFuncDefs(node))
+
+    node = assertParseCommandList(self,
+        'f() { echo f; }; if true; then g() { echo g; }; fi')
+    names = [n.name for n in cmd_parse.FindFuncDefs(node)]
+    self.assertEqual(['f', 'g'], names)
+
+    node = assertParseCommandList(self,
+        'while true; do h() { echo h; }; done && (i() { echo i; })')
+    names = [n.name for n in cmd_parse.FindFuncDefs(node)]
+    self.assertEqual(['h', 'i'], names)
+
+    # Defined in another process, so not found
+    node = assertParseCommandList(self, 'echo $(f() { echo f; }; f)')
+    self.assertEqual([], cmd_parse.FindFuncDefs(node))
+
+
 class ErrorLocationsTest(unittest.TestCase):
 
   def testCommand(self):
@@ -54,11 +54,12 @@ def PrintAsOil(arena, node, debug_spans):
   #print node
   #print(spans)
   if debug_spans:
-    for i, span in enumerate(arena.spans):
+    for i in range(arena.NumSpans()):
+      span = arena.GetLineSpan(i)
       line = arena.GetLine(span.line_id)
       piece = line[span.col : span.col + span.length]
       print('%5d %r' % (i, piece), file=sys.stderr)
-    print('(%d spans)' % len(arena.spans), file=sys.stderr)
+    print('(%d spans)' % arena.NumSpans(), file=sys.stderr)
 
   cursor = Cursor(arena, sys.stdout)
   fixer = OilPrinter(cursor, arena, sys.stdout)
@@ -222,7 +223,7 @@ class OilPrinter:
 
   def End(self):
     """Make sure we print until the end of the file."""
-    end_id = len(self.arena.spans)
+    end_id = self.arena.NumSpans()
     self.cursor.PrintUntil(end_id)
 
   def DoRedirect(self, node, local_symbols):
@@ -7,6 +7,7 @@ import unittest
 
 from core.id_kind import Id, Kind, LookupKind
 from core.lexer import CompileAll, Lexer, LineLexer, FindLongestMatch
+from core.lexer import CompileCombined, FindLongestMatchCombined
 from core.test_lib import TokensEqual
 
 from osh import parse_lib
@@ -192,6 +193,46 @@ class FunctionTest(unittest.TestCase):
     self.assertEqual(tok_val, '"')
 
 
+class CombinedEngineTest(unittest.TestCase):
+
+  def testSameAsList(self):
+    lines = [
+        'ls /home/ && echo "$HOME" ${a:-b} $((1 + 2)) >&2 2>>out\n',
+        'foreach for fi=done do_it [[ -z $x ]] <<- <<< <(sort) >|f\n',
+        "echo $'a\\n' 'sq' `cmd` \\\n",
+        '${#a[@]} ${a/b/c} ${a%%x} ${!name} 0x1f 64#a @ # a+=1\n',
+        'café\t\r=x # comment é\n',
+        '',
+        '\0',
+    ]
+    for lex_mode, pat_list in LEXER_DEF.items():
+      re_list = CompileAll(pat_list)
+      combined = CompileCombined(pat_list)
+      for line in lines:
+        for pos in range(len(line)):
+          try:
+            expected = FindLongestMatch(re_list, line, pos)
+          except AssertionError:
+            self.assertRaises(
+                AssertionError, FindLongestMatchCombined, combined, line, pos)
+            continue
+          actual = FindLongestMatchCombined(combined, line, pos)
+          self.assertEqual(expected, actual, (lex_mode, line, pos))
+
+  def testNoMatch(self):
+    combined = CompileCombined(LEXER_DEF[LexMode.SQ])
+    self.assertRaises(
+        AssertionError, FindLongestMatchCombined, combined, "'", 1)
+
+  def testListEngine(self):
+    l = LineLexer(LEXER_DEF, 'for x', engine='list')
+    self.assertTokensEqual(
+        ast.token(Id.KW_For, 'for'), l.Read(LexMode.OUTER))
+
+  def assertTokensEqual(self, left, right):
+    self.assertTrue(TokensEqual(left, right))
+
+
 class RegexTest(unittest.TestCase):
 
   def testOuter(self):
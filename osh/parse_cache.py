@@ -0,0 +1,186 @@
+"""
+parse_cache.py - Cache the command trees of sourced files on disk.
+
+Shells source the same big files (bash-completion, rc files) on every
+startup, and lexing and parsing them dominates startup time.  We save the
+tree in oheap format, keyed by the file's real path, size, and mtime, and the
+version of the parser.
+
+Each cache file has a header, then the arena lines and spans of the file (so
+error messages still point at the source), then the oheap-encoded tree.  The
+text of lines isn't stored; the arena reads it from the file when needed.
+
+It's opt-in, since nothing evicts old cache files:
+
+  export OSH_PARSE_CACHE=~/.cache/osh/parse
+
+There's one file per sourced path, and it's overwritten when the file
+changes, so the directory only grows with the number of distinct files.
+Delete it to reclaim the space.
+"""
+
+import array
+import hashlib
+import io
+import os
+import struct
+
+from asdl import decode
+from asdl import encode
+from core import alloc
+from core import braces
+from core import id_kind
+from core import lexer
+from osh import ast_ as ast
+from osh import arith_parse
+from osh import bool_parse
+from osh import cmd_parse
+from osh import lex
+from osh import word_parse
+
+_MAGIC = b'OSHPC\x01\0\0'
+
+# magic, version digest, file size, file mtime (ns), first span ID, number of
+# lines, number of spans
+_HEADER = struct.Struct('=8s20sqqiii')
+
+# Arrays after the header, in order, with their types.
+_ARRAY_TYPES = ('i', 'q', 'i', 'i', 'i')
+
+_version = None
+
+
+def _OshVersion():
+  """Digest of everything the encoded trees depend on.
+
+  That's the schema, the Id numbering, and the parser source.
+  """
+  global _version
+  if _version is None:
+    h = hashlib.sha1()
+    with open(ast.schema_path, 'rb') as f:
+      h.update(f.read())
+    for id_val, name in enumerate(id_kind._ID_NAMES[1:], 1):
+      h.update(('%d %s\n' % (id_val, name)).encode('utf-8'))
+    for module in (lexer, lex, word_parse, cmd_parse, arith_parse, bool_parse,
+                   braces):
+      with open(module.__file__, 'rb') as f:
+        h.update(f.read())
+    _version = h.digest()
+  return _version
+
+
+def DefaultDir():
+  """Return the cache directory, or None if caching is disabled.
+
+  Caching is enabled by setting $OSH_PARSE_CACHE to a directory.  It's off
+  when the variable is unset or empty.
+  """
+  return os.getenv('OSH_PARSE_CACHE') or None
+
+
+class ParseCache(object):
+  """Cache of command trees, one file per source path."""
+
+  def __init__(self, cache_dir):
+    self.cache_dir = cache_dir
+    # The 24 bit widths decode fastest.  (Varints are 35% smaller, but
+    # cache files are small anyway after dedup.)
+    self.enc = encode.Params()
+
+  def _CachePath(self, path):
+    real_path = os.path.realpath(path)
+    digest = hashlib.sha1(real_path.encode('utf-8')).hexdigest()
+    return os.path.join(self.cache_dir, digest)
+
+  def Load(self, path, arena=None):
+    """Return the cached tree for a file, or None if it's not cached.
+
+    Args:
+      path: file to be sourced
+      arena: if given, the file and its lines and spans are added to it,
+        like FileLineReader and the lexer would
+    """
+    try:
+      st = os.stat(path)
+      with open(self._CachePath(path), 'rb') as f:
+        contents = f.read()
+    except OSError:
+      return None
+
+    if len(contents) < _HEADER.size:
+      return None
+    (magic, version, size, mtime_ns, span_mark, num_lines,
+     num_spans) = _HEADER.unpack_from(contents)
+    if (magic != _MAGIC or version != _OshVersion() or size != st.st_size or
+        mtime_ns != st.st_mtime_ns):
+      return None
+
+    pos = _HEADER.size
+    arrays = []
+    for typecode, n in zip(_ARRAY_TYPES, (num_lines, num_lines, num_spans,
+                                          num_spans, num_spans)):
+      a = array.array(typecode)
+      end = pos + a.itemsize * n
+      a.frombytes(contents[pos:end])
+      arrays.append(a)
+      pos = end
+
+    # Without an arena, decode lazily, so the bodies of functions that are
+    # never called are never decoded.  With one, all span IDs are shifted
+    # anyway.  (Lazy decoding only finds corruption later, but cache files are
+    # written atomically.)
+    try:
+      node = decode.DecodeRoot(
+          contents[pos:], ast.command.DESCRIPTOR, ast, lazy=arena is None)
+    except (decode.Error, IndexError, KeyError, ValueError):
+      return None  # truncated or corrupt; it will be overwritten
+
+    if arena:
+      arena.AddSourceFile(path, size, mtime_ns)
+      span_base = arena.AddSpans(*arrays)
+      alloc.ShiftSpanIds([node], span_base - span_mark)
+    return node
+
+  def Save(self, path, file_stat, node, arena=None, mark=None):
+    """Save the tree parsed from a file.
+
+    Args:
+      path: file that was sourced
+      file_stat: (size, mtime_ns) of the file when it was read, from
+        FileLineReader
+      node: the tree
+      arena, mark: if given, the lines and spans since the mark are saved
+    """
+    if file_stat is None:  # not a regular file
+      return
+    size, mtime_ns = file_stat
+
+    if arena:
+      arrays = arena.GetSpans(mark)
+      span_mark = mark[1]
+    else:
+      arrays = tuple(array.array(typecode) for typecode in _ARRAY_TYPES)
+      span_mark = 0
+
+    f = io.BytesIO()
+    f.write(_HEADER.pack(_MAGIC, _OshVersion(), size, mtime_ns, span_mark,
+                         len(arrays[0]), len(arrays[2])))
+    for a in arrays:
+      f.write(a.tobytes())
+
+    # Long && chains and deeply nested functions are fine; EncodeTree()
+    # doesn't recurse.
+    encode.EncodeTree(node, self.enc, f, dedup=True)
+
+    # Write to a temp file and rename it, so concurrent shells never read a
+    # partial file.
+    cache_path = self._CachePath(path)
+    tmp_path = '%s.%d' % (cache_path, os.getpid())
+    try:
+      os.makedirs(self.cache_dir, exist_ok=True)
+      with open(tmp_path, 'wb') as out:
+        out.write(f.getvalue())
+      os.replace(tmp_path, cache_path)
+    except OSError:
+      pass  # The cache is optional.
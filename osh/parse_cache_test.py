@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+parse_cache_test.py: Tests for parse_cache.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from core import alloc
+from core import reader
+
+from osh import ast_ as ast
+from osh import parse_lib
+from osh import parse_cache  # module under test
+
+
+CODE = '''\
+f() {
+  echo "$1" ${x:-default} $((1 + 2))
+}
+for i in a b; do f $i >&2; done
+cat <<EOF
+here $x
+EOF
+'''
+
+
+def _Tokens(node, tokens):
+  """Collect the tokens in a tree."""
+  if isinstance(node, ast.token):
+    tokens.append(node)
+    return
+  for name in node.FIELDS:
+    val = getattr(node, name, None)
+    if isinstance(val, list):
+      for v in val:
+        if hasattr(v, 'FIELDS'):
+          _Tokens(v, tokens)
+    elif hasattr(val, 'FIELDS'):
+      _Tokens(val, tokens)
+
+
+class ParseCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.tmp_dir)
+    self.cache = parse_cache.ParseCache(os.path.join(self.tmp_dir, 'cache'))
+    self.path = os.path.join(self.tmp_dir, 'lib.sh')
+    with open(self.path, 'w') as f:
+      f.write(CODE)
+
+  def _ParseAndSave(self, arena):
+    mark = arena.Mark()
+    line_reader = reader.FileLineReader(self.path, arena=arena)
+    _, c_parser = parse_lib.MakeParserForTop(line_reader, arena=arena)
+    node = c_parser.ParseWholeFile()
+    self.assertTrue(node)
+    self.cache.Save(self.path, line_reader.file_stat, node, arena=arena,
+                    mark=mark)
+    return node
+
+  def testRoundTrip(self):
+    self.assertEqual(None, self.cache.Load(self.path))
+
+    arena = alloc.Pool().NewArena()
+    expected = self._ParseAndSave(arena)
+
+    # Load into an arena that already has something in it, so span IDs are
+    # shifted.
+    arena2 = alloc.Pool(retain_file_lines=False).NewArena()
+    arena2.AddSourcePath('<test>')
+    arena2.AddLine('echo hi\n', 1)
+    arena2.AddLineSpan(0, 0, 4)
+
+    node = self.cache.Load(self.path, arena=arena2)
+    alloc.ShiftSpanIds([expected], 1)
+    self.assertEqual(expected, node)
+
+    tokens = []
+    _Tokens(node, tokens)
+    self.assertTrue(tokens)
+    for tok in tokens:
+      if tok.span_id == -1:  # e.g. here doc bodies aren't in the arena
+        continue
+      span = arena2.GetLineSpan(tok.span_id)
+      self.assertEqual(tok.val, alloc.SpanValue(span, arena2))
+
+    line_id = arena2.GetLineSpan(tokens[0].span_id).line_id
+    path, _ = arena2.GetDebugInfo(line_id)
+    self.assertEqual(self.path, path)
+
+  def testWithoutArena(self):
+    line_reader = reader.FileLineReader(self.path)
+    _, c_parser = parse_lib.MakeParserForTop(line_reader)
+    expected = c_parser.ParseWholeFile()
+    self.cache.Save(self.path, line_reader.file_stat, expected)
+    self.assertEqual(expected, self.cache.Load(self.path))
+
+  def testInvalidation(self):
+    self._ParseAndSave(alloc.Pool().NewArena())
+    self.assertTrue(self.cache.Load(self.path))
+
+    with open(self.path, 'a') as f:
+      f.write('echo more\n')
+    self.assertEqual(None, self.cache.Load(self.path))
+
+    # Corrupt cache files are misses.
+    self._ParseAndSave(alloc.Pool().NewArena())
+    cache_path = self.cache._CachePath(self.path)
+    with open(cache_path, 'r+b') as f:
+      f.truncate(os.path.getsize(cache_path) - 8)
+    self.assertEqual(None, self.cache.Load(self.path))
+
+  def testDefaultDir(self):
+    old = os.environ.get('OSH_PARSE_CACHE')
+    try:
+      os.environ.pop('OSH_PARSE_CACHE', None)
+      self.assertEqual(None, parse_cache.DefaultDir())  # opt-in
+      os.environ['OSH_PARSE_CACHE'] = ''
+      self.assertEqual(None, parse_cache.DefaultDir())
+      os.environ['OSH_PARSE_CACHE'] = '/tmp/c'
+      self.assertEqual('/tmp/c', parse_cache.DefaultDir())
+    finally:
+      if old is None:
+        del os.environ['OSH_PARSE_CACHE']
+      else:
+        os.environ['OSH_PARSE_CACHE'] = old
+
+
+if __name__ == '__main__':
+  unittest.main()
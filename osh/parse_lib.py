@@ -36,34 +36,78 @@ def MakeParserForTop(line_reader, arena=None):
   return w_parser, c_parser
 
 
-# TODO: We could reuse w_parser with Reset() each time.  That's what the REPL
-# does.
-# But LineLexer and Lexer are also stateful!  So that might not be worth it.
-# Hm the REPL only does line_reader.Reset()?
+class ParserPool(object):
+  """Reusable parser objects for eval, source, here docs and completion.
+
+  A CommandParser owns a WordParser, Lexer and LineLexer, so it's the unit of
+  reuse.  Parsers nest (e.g. a here doc inside eval'd code), so Acquire()
+  creates a new one when none are free.  The pool only grows to the maximum
+  nesting depth.
+
+  Parse trees don't refer to the parser objects, so a parser can be released
+  as soon as the caller is done looking at its results.
+  """
+  def __init__(self):
+    self.free = []  # CommandParser instances not in use
+    self.owners = {}  # WordParser -> CommandParser that owns it
+
+  def Acquire(self, line_reader, arena=None):
+    """Returns a (WordParser, CommandParser) pair reading from line_reader.
+
+    Tokens get spans in the arena, if one is given.
+    """
+    if self.free:
+      c_parser = self.free.pop()
+      c_parser.ResetInputObjects(line_reader)
+      c_parser.lexer.line_lexer.arena = arena
+    else:
+      # AtEnd() is true
+      line_lexer = lexer.LineLexer(lex.LEXER_DEF, '', arena=arena)
+      lx = lexer.Lexer(line_lexer, line_reader)
+      w_parser = word_parse.WordParser(lx, line_reader)
+      c_parser = cmd_parse.CommandParser(w_parser, lx, line_reader)
+      self.owners[w_parser] = c_parser
+    return c_parser.w_parser, c_parser
+
+  def Release(self, parser):
+    """
+    Args:
+      parser: CommandParser or WordParser returned by Acquire()
+    """
+    c_parser = self.owners.get(parser, parser)
+    self.free.append(c_parser)
+
+
+_POOL = ParserPool()
+
+
 def MakeParserForCompletion(code_str):
   """Parser for partial lines."""
   # NOTE: We don't need to use a arena here?  Or we need a "scratch arena" that
   # doesn't interfere with the rest of the program.
   line_reader = reader.StringLineReader(code_str)
-  line_lexer = lexer.LineLexer(lex.LEXER_DEF, '')  # AtEnd() is true
-  lx = lexer.Lexer(line_lexer, line_reader)
-  w_parser = word_parse.WordParser(lx, line_reader)
-  c_parser = cmd_parse.CommandParser(w_parser, lx, line_reader)
-  return w_parser, c_parser
+  return _POOL.Acquire(line_reader)
 
 
-def MakeParserForExecutor(code_str):
+def MakeParserForExecutor(line_reader, arena=None):
   """Parser for source / eval."""
-  _, c_parser = MakeParserForCompletion(code_str)
+  _, c_parser = _POOL.Acquire(line_reader, arena=arena)
   return c_parser
 
 
 # TODO: This has to take an arena so it gets the spans.
 def MakeWordParserForHereDoc(lines):
   line_reader = reader.VirtualLineReader(lines)
-  line_lexer = lexer.LineLexer(lex.LEXER_DEF, '')
-  lx = lexer.Lexer(line_lexer, line_reader)
-  return word_parse.WordParser(lx, line_reader)
+  w_parser, _ = _POOL.Acquire(line_reader)
+  return w_parser
+
+
+def ReleaseParser(parser):
+  """Return a parser from one of the functions above, so it can be reused.
+
+  Don't call this for parsers that you might still read from.
+  """
+  _POOL.Release(parser)
 
 
 def MakeParserForCommandSub(line_reader, lexer):
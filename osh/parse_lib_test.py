@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+parse_lib_test.py: Tests for parse_lib.py
+"""
+
+import unittest
+
+from core import lexer
+from core import reader
+from core.id_kind import Id
+
+from osh import ast_ as ast
+from osh import lex
+from osh import parse_lib  # module under test
+
+command_e = ast.command_e
+
+
+class ParserPoolTest(unittest.TestCase):
+
+  def testReuse(self):
+    pool = parse_lib.ParserPool()
+    w_parser, c_parser = pool.Acquire(reader.StringLineReader(
+        'echo $(( 1 +'))
+    self.assertFalse(c_parser.ParseWholeFile())  # leaves lexer state behind
+    pool.Release(c_parser)
+
+    w_parser2, c_parser2 = pool.Acquire(reader.StringLineReader(
+        'echo hi; echo bye'))
+    self.assertIs(c_parser, c_parser2)
+    self.assertIs(w_parser, w_parser2)
+    self.assertEqual([], c_parser2.Error())
+
+    node = c_parser2.ParseWholeFile()
+    self.assertEqual(command_e.CommandList, node.tag)
+    self.assertEqual(2, len(node.children))
+
+  def testNested(self):
+    pool = parse_lib.ParserPool()
+    _, outer = pool.Acquire(reader.StringLineReader('echo outer'))
+    _, inner = pool.Acquire(reader.StringLineReader('echo inner'))
+    self.assertIsNot(outer, inner)
+
+    node = inner.ParseWholeFile()
+    self.assertEqual('inner', node.words[1].parts[0].token.val)
+    node = outer.ParseWholeFile()
+    self.assertEqual('outer', node.words[1].parts[0].token.val)
+
+  def testReleaseWordParser(self):
+    pool = parse_lib.ParserPool()
+    w_parser, c_parser = pool.Acquire(reader.StringLineReader(''))
+    pool.Release(w_parser)
+    _, c_parser2 = pool.Acquire(reader.StringLineReader(''))
+    self.assertIs(c_parser, c_parser2)
+
+  def testCompileOnce(self):
+    l1 = lexer.LineLexer(lex.LEXER_DEF, '')
+    l2 = lexer.LineLexer(lex.LEXER_DEF, '')
+    self.assertIs(l1.lexer_def, l2.lexer_def)
+
+    t = parse_lib.MakeParserForExecutor(
+        reader.StringLineReader('echo'))
+    parse_lib.ReleaseParser(t)
+    self.assertIs(t, parse_lib.MakeParserForExecutor(
+        reader.StringLineReader('ls')))
+
+
+if __name__ == '__main__':
+  unittest.main()
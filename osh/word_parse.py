@@ -92,6 +92,14 @@ class WordParser(object):
     """
     self.next_lex_mode = lex_mode
 
+  def ResetInputObjects(self, line_reader):
+    """Parse from a new line reader, so the WordParser can be reused.
+
+    The Lexer is shared with the CommandParser, which resets it.
+    """
+    self.line_reader = line_reader
+    self.Reset()
+
   def Reset(self, lex_mode=LexMode.OUTER):
     """Called by interactive loop."""
     # For _Peek()
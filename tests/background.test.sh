@@ -32,3 +32,12 @@ for i in 1 2 3; do
 done & wait
 # stdout-json: "1\n2\n3\n"
 # status: 0
+
+### wait -n waits for the next job
+{ sleep 0.05; exit 3; } &
+{ sleep 0.01; exit 4; } &
+wait -n; echo $?
+wait -n; echo $?
+# stdout-json: "4\n3\n"
+# status: 0
+# N-I dash stdout-json: "2\n2\n"
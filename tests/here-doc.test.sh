@@ -270,3 +270,11 @@ fd5
 EOF5
 # stdout-json: "0: 3: fd3\n5: fd5\n"
 
+
+### Here docs for every command on a line with ;
+cat <<EOF1; echo two; cat <<EOF2
+one
+EOF1
+three
+EOF2
+# stdout-json: "one\ntwo\nthree\n"
@@ -21,3 +21,10 @@ echo a | egrep '[0-9]+'
 stdout_stderr.py |& cat
 # stdout-json: "STDERR\nSTDOUT\n"
 # N-I dash/mksh stdout-json: ""
+
+### shopt -s lastpipe keeps variables set in the last stage
+shopt -s lastpipe
+seq 3 | while read i; do last=$i; done
+echo "last=$last"
+# stdout: last=3
+# N-I dash/mksh stdout: last=